@@ -28,4 +28,80 @@ CREATE TABLE IF NOT EXISTS race_data (
 );
 
 CREATE INDEX IF NOT EXISTS race_data_time
-ON race_data(race_id, timestamp);
\ No newline at end of file
+ON race_data(race_id, timestamp);
+
+-- The capture time (seconds since the epoch) of frame 0 of each race's timeline; race_data timestamps count
+-- frames of the aggregator's --timeline-fps from it
+CREATE TABLE IF NOT EXISTS race_clock (
+    race_id INT NOT NULL,
+    epoch REAL NOT NULL,
+    PRIMARY KEY (race_id)
+);
+
+-- Races the aggregator has seen end, with the latest race_data frame committed by then
+CREATE TABLE IF NOT EXISTS race_end (
+    race_id INT NOT NULL,
+    last_frame INT NOT NULL,
+    PRIMARY KEY (race_id)
+);
+
+-- The next race id to allocate, for frame processors whose sink has no Redis server to count on (one row)
+CREATE TABLE IF NOT EXISTS race_sequence (
+    next_id INT NOT NULL
+);
+
+-- The latest row of every player, so the current standings are read without scanning race_data
+CREATE TABLE IF NOT EXISTS race_standings (
+    race_id INT NOT NULL,
+    player_id INT NOT NULL,
+    frame INT NOT NULL,
+    lap INT NOT NULL,
+    position INT NOT NULL,
+    coins INT NOT NULL,
+    item_1 TEXT NOT NULL,
+    item_2 TEXT NOT NULL,
+    PRIMARY KEY (race_id, player_id)
+);
+
+-- value is an INT for lap, position and coins and TEXT for item_1 and item_2, so it is left untyped
+CREATE TABLE IF NOT EXISTS race_intervals (
+    race_id INT NOT NULL,
+    player_id INT NOT NULL,
+    stat TEXT NOT NULL,
+    start_frame INT NOT NULL,
+    end_frame INT,
+    value NOT NULL,
+    PRIMARY KEY (race_id, player_id, stat, start_frame)
+);
+
+CREATE INDEX IF NOT EXISTS race_intervals_time
+ON race_intervals(race_id, start_frame);
+
+-- Rollups kept current by the aggregator, see mk8cv/aggregator/rollups.py
+CREATE TABLE IF NOT EXISTS race_laps (
+    race_id INT NOT NULL,
+    player_id INT NOT NULL,
+    lap INT NOT NULL,
+    start_frame INT NOT NULL,
+    end_frame INT,
+    coins_min INT NOT NULL,
+    coins_max INT NOT NULL,
+    PRIMARY KEY (race_id, player_id, lap)
+);
+
+CREATE TABLE IF NOT EXISTS race_position_time (
+    race_id INT NOT NULL,
+    player_id INT NOT NULL,
+    position INT NOT NULL,
+    frames INT NOT NULL,
+    PRIMARY KEY (race_id, player_id, position)
+);
+
+CREATE TABLE IF NOT EXISTS race_items (
+    race_id INT NOT NULL,
+    player_id INT NOT NULL,
+    item TEXT NOT NULL,
+    pickups INT NOT NULL,
+    uses INT NOT NULL,
+    PRIMARY KEY (race_id, player_id, item)
+);
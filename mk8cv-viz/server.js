@@ -94,22 +94,13 @@ async function sendRacerMetadata(ws, raceId) {
 async function sendActiveRaceData(ws, raceId) {
     console.log(`sending race update for raceId: ${raceId}`)
     try {
-        // Get latest positions for active race
+        // Get latest positions for active race, kept by the aggregator one row per player
         db.all(`
-            WITH LatestTimestamps AS (
-                SELECT player_id, MAX(timestamp) as max_timestamp
-                FROM race_data
-                WHERE race_id = ?
-                GROUP BY player_id
-            )
-            SELECT rd.player_id, rd.position, rd.coins, rd.item_1, rd.item_2
-            FROM race_data rd
-            INNER JOIN LatestTimestamps lt 
-                ON rd.player_id = lt.player_id 
-                AND rd.timestamp = lt.max_timestamp
-            WHERE rd.race_id = ?
-            ORDER BY rd.position
-        `, [raceId, raceId], (err, positions) => {
+            SELECT player_id, position, coins, item_1, item_2
+            FROM race_standings
+            WHERE race_id = ?
+            ORDER BY position
+        `, [raceId], (err, positions) => {
             if (err) {
                 ws.send(JSON.stringify({ type: 'error', message: err.message }));
                 return;
@@ -165,6 +156,29 @@ app.post('/api/racer-update', (req, res) => {
     });
 });
 
+// Intervals of each player's stat overlapping frames [from, to], for drawing timelines
+app.get('/api/intervals', (req, res) => {
+    const { raceId, stat } = req.query;
+    const from = Number(req.query.from ?? 0);
+    const to = Number(req.query.to ?? Number.MAX_SAFE_INTEGER);
+
+    // one primary key range scan per player, instead of every race_data row of the race
+    db.all(`
+        SELECT player_id, start_frame, end_frame, value
+        FROM race_intervals
+        WHERE race_id = ? AND player_id IN (SELECT DISTINCT player_id FROM race_intervals WHERE race_id = ?)
+            AND stat = ? AND start_frame <= ? AND (end_frame IS NULL OR end_frame > ?)
+        ORDER BY player_id, start_frame
+    `, [raceId, raceId, stat, to, from], (err, rows) => {
+        if (err) {
+            console.error('Error fetching intervals:', err);
+            res.status(500).json({ error: err.message });
+            return;
+        }
+        res.json(rows);
+    });
+});
+
 app.get('/api/racer-metadata', (req, res) => {
     console.log('Fetching racer metadata');
 
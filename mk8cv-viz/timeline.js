@@ -0,0 +1,45 @@
+// Loads races exported by `python -m mk8cv.aggregator.timeline`, fetching only the level of detail a view needs
+
+const manifests = new Map();
+const levels = new Map();
+
+async function fetchJson(url) {
+    const response = await fetch(url);
+    if (!response.ok) {
+        throw new Error(`Error fetching ${url}: ${response.status}`);
+    }
+    return response.json();
+}
+
+export async function loadManifest(baseUrl, raceId) {
+    const url = `${baseUrl}/${raceId}/index.json`;
+    if (!manifests.has(url)) {
+        manifests.set(url, fetchJson(url));
+    }
+    return manifests.get(url);
+}
+
+// The runs of every player's stats at the coarsest level still finer than one bucket per pixel,
+// for a view showing `frames` frames across `widthPx` pixels
+export async function loadTimeline(baseUrl, raceId, frames, widthPx) {
+    const manifest = await loadManifest(baseUrl, raceId);
+    const framesPerPixel = frames / widthPx;
+    const level = manifest.levels
+        .filter(level => level.resolution <= framesPerPixel)
+        .reduce((coarsest, level) => level.resolution > coarsest.resolution ? level : coarsest, manifest.levels[0]);
+
+    const url = `${baseUrl}/${raceId}/${level.file}`;
+    if (!levels.has(url)) {
+        levels.set(url, fetchJson(url));
+    }
+    return levels.get(url);
+}
+
+// Converts a stat's columns back to {start, end, value} runs, the last ending at the race's end_frame
+export function toRuns(columns, endFrame) {
+    return columns.start.map((start, i) => ({
+        start: start,
+        end: i + 1 < columns.start.length ? columns.start[i + 1] : endFrame,
+        value: columns.value[i],
+    }));
+}
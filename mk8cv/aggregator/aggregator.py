@@ -1,90 +1,429 @@
 import argparse
-import json
+import asyncio
 import logging
-from typing import Any
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Optional
 
 import redis
 
 from mk8cv.aggregator.anomaly_correction import AnomalyCorrector, SlidingWindowAnomalyCorrector
-from mk8cv.data.state import PlayerState, Item
-from db import Database, SqliteDB
+from mk8cv.aggregator.db import Database, SqliteDB
+from mk8cv.aggregator.hmm import HmmAnomalyCorrector
+from mk8cv.aggregator.reorder import ReorderBuffer, TimelineMerger
+from mk8cv.aggregator.snapshot import encode_snapshot, read_snapshot, write_snapshot
+from mk8cv.aggregator.sources import EventSource, PubSubSource, QueueSource, ShmRingSource, SourceType, \
+    StreamSource, UnixSocketSource
+from mk8cv.aggregator.standings import Standings, StandingsServer
+from mk8cv.data.codec import DeltaDecoder
+from mk8cv.sinks.ipc import DEFAULT_SOCKET_PATH
+from mk8cv.sinks.recording import read_recordings
+from mk8cv.data.state import PlayerState, StateMessage, global_player_id
 
+from multiprocessing import Queue
 import signal
 
 logging.getLogger().setLevel(logging.DEBUG)
 
 
 class EventAggregator:
-    def __init__(self, host: str, port: int, channel: str) -> None:
+    def __init__(self, host: str, port: int, channel: str, source_type: SourceType = SourceType.PUBSUB,
+                 partitions: list[int] = None, group: str = 'aggregators', consumer: str = None,
+                 batch_size: int = 256, socket_path: str = DEFAULT_SOCKET_PATH, rings: int = 2,
+                 state_queue: Queue = None, handle_signals: bool = True, database: Database = None,
+                 reorder: ReorderBuffer = None, standings: Standings = None, merger: TimelineMerger = None,
+                 timeline_fps: float = 60.0, anomaly_corrector: AnomalyCorrector = None, snapshot_path: str = None,
+                 snapshot_interval: float = 5.0) -> None:
         self.host = host
         self.port = port
         self.redis_client = redis.Redis(host=host, port=port, db=0)
         self.channel = channel
-        self.database: Database = SqliteDB()
-        self.anomaly_corrector: AnomalyCorrector = SlidingWindowAnomalyCorrector(self.database, window_size=9);
-        self.previous_state: dict[int, PlayerState] = {} # playerId -> PlayerState
+        self.source_type = source_type
+        self.partitions = partitions or [0]
+        self.group = group
+        self.consumer = consumer
+        self.batch_size = batch_size
+        self.socket_path = socket_path
+        self.rings = rings
+        self.state_queue = state_queue
+        self.database: Database = database or SqliteDB()
+        self.anomaly_corrector: AnomalyCorrector = anomaly_corrector or SlidingWindowAnomalyCorrector(self.database, window_size=9)
+        self.previous_state: dict[tuple[int, int], PlayerState] = {} # (raceId, playerId) -> PlayerState
+        self.decoder = DeltaDecoder()
+        self.reorder = reorder or ReorderBuffer()
+        self.merger = merger or TimelineMerger()
+        self.timeline_fps = timeline_fps
+        self.epochs: dict[int, float] = {}  # race_id -> capture time of the race timeline's frame 0
+        self.device_races: dict[tuple[Any, int], int] = {}  # (source, device_id) -> latest race_id
+        self.standings = standings
+        self.snapshot_path = snapshot_path
+        self.snapshot_interval = snapshot_interval
+        self.offsets: dict[str, Any] = {}  # partition -> position of the last message handled
+        self._last_snapshot = time.monotonic()
         self.running = True
 
-        # Set up signal handlers
-        signal.signal(signal.SIGINT, self._signal_handler)
-        signal.signal(signal.SIGTERM, self._signal_handler)
+        # Set up signal handlers, unless embedded in a program that handles its own
+        if handle_signals:
+            signal.signal(signal.SIGINT, self._signal_handler)
+            signal.signal(signal.SIGTERM, self._signal_handler)
 
     def _signal_handler(self, signum, _):
         """Handle shutdown signals"""
         logging.info(f"Received signal {signum}. Shutting down...")
         self.running = False
 
+    def _open_source(self, channel: str = None) -> EventSource:
+        channel = channel or self.channel
+        match self.source_type:
+            case SourceType.STREAM:
+                return StreamSource(self.redis_client, channel, self.partitions, self.group, self.consumer,
+                                    self.batch_size)
+            case SourceType.UNIX_SOCKET:
+                return UnixSocketSource(self.socket_path)
+            case SourceType.SHARED_MEMORY:
+                return ShmRingSource(channel, self.rings, batch_size=self.batch_size)
+            case SourceType.QUEUE:
+                return QueueSource(self.state_queue)
+            case _:
+                return PubSubSource(self.redis_client, channel)
+
+    def _track_offsets(self, source: EventSource, messages: list[tuple[Any, bytes | StateMessage]]) -> None:
+        for message_id, _ in messages:
+            offset = source.offset(message_id)
+            if offset is not None:
+                self.offsets[offset[0]] = offset[1]
+
+    def _snapshot(self) -> bytes:
+        """
+        Everything the aggregator keeps in memory between messages, as of the last message handled, with the
+        position of that message in each partition.
+        """
+        self._last_snapshot = time.monotonic()
+        return encode_snapshot({
+            'offsets': self.offsets,
+            'decoder': self.decoder,
+            'reorder': self.reorder.snapshot(),
+            'merger': self.merger.snapshot(),
+            'corrector': (type(self.anomaly_corrector).__name__, self.anomaly_corrector.snapshot()),
+            'previous_state': self.previous_state,
+            'epochs': self.epochs,
+            'device_races': self.device_races,
+        })
+
+    def _snapshot_due(self) -> bool:
+        return self.snapshot_path is not None and time.monotonic() - self._last_snapshot >= self.snapshot_interval
+
+    def _restore(self, sources: list[EventSource]) -> None:
+        """Picks up where the last snapshot left off, telling the sources to skip the messages it covers."""
+        state = read_snapshot(self.snapshot_path) if self.snapshot_path is not None else None
+        if state is None:
+            return
+        self.offsets = state['offsets']
+        self.decoder = state['decoder']
+        self.reorder.restore(state['reorder'])
+        self.merger.restore(state['merger'])
+        corrector, history = state['corrector']
+        if corrector == type(self.anomaly_corrector).__name__:
+            self.anomaly_corrector.restore(history)
+        else:
+            logging.warning(f"Snapshot was taken with {corrector}, starting {type(self.anomaly_corrector).__name__} cold")
+        self.previous_state = state['previous_state']
+        self.epochs = state['epochs']
+        self.device_races = state['device_races']
+        for source in sources:
+            source.seek(self.offsets)
+        logging.info(f"Restored {len(self.previous_state)} players from snapshot {self.snapshot_path}")
+
+    def _checkpoint(self) -> None:
+        """Commits everything written so far, then replaces the snapshot with one matching it."""
+        self.database.flush(force=True)
+        write_snapshot(self.snapshot_path, self._snapshot())
+
+    def _handle(self, messages: list[tuple[Any, bytes | StateMessage]]) -> list[Any]:
+        """Decodes and reorders messages, correcting every event released. Returns the ids of messages done with."""
+        done = []
+        for message_id, data in messages:
+            logging.debug(f"Message received {data}")
+            event = data if isinstance(data, StateMessage) else self.decoder.decode(data)
+            if event is None:
+                done.append(message_id)
+            else:
+                done.extend(self._process_released(self.reorder.push(event, message_id)))
+        return done
+
+    def _process_released(self, released: list[tuple[Any, Optional[StateMessage]]]) -> list[Any]:
+        """Merges events released by the reorder buffer into their race's timeline, correcting those merged."""
+        return self._process_merged(self.merger.merge(released))
+
+    def _process_merged(self, merged: list[tuple[Any, Optional[StateMessage]]]) -> list[Any]:
+        ended = []
+        for message_id, event in merged:
+            if event is not None:
+                self._process_event(event)
+                ended.extend(self._track_race(self._source_of(message_id), event))
+        done = [message_id for message_id, _ in merged]
+        for race_id in ended:
+            done.extend(self._end_race(race_id))
+        return done
+
+    def _source_of(self, message_id: Any) -> Any:
+        """Which source a message came from; setups publishing to different sources reuse each other's device ids."""
+        return None
+
+    def _track_race(self, source: Any, event: StateMessage) -> list[int]:
+        """Returns the race the event's device has moved on from, if no device is still in it."""
+        device = (source, event.device_id)
+        previous = self.device_races.get(device)
+        if previous is not None and event.race_id <= previous:
+            return []
+        # race ids are allocated in order, so a device that moved to a later race is done with the earlier one
+        self.device_races[device] = event.race_id
+        if previous is None or previous in self.device_races.values():
+            return []
+        return [previous]
+
+    def _end_race(self, race_id: int) -> list[Any]:
+        """Writes out everything held for a race every device has moved on from, then forgets the race."""
+        logging.info(f"Race {race_id} ended")
+        done = self._process_merged(self.merger.merge(self.reorder.drain(race_id)) + self.merger.drain(race_id))
+        self.previous_state = {key: state for key, state in self.previous_state.items() if key[0] != race_id}
+        self.anomaly_corrector.end_race(race_id)
+        self.epochs.pop(race_id, None)
+        self._forget_race(race_id)
+        return done
+
+    def _forget_race(self, race_id: int) -> None:
+        """Drops what the database and standings keep for an ended race, once its last rows are written."""
+        self.database.end_race(race_id)
+        if self.standings is not None:
+            self.standings.end_race(race_id)
+
+    def _expire(self) -> list[Any]:
+        return self._process_released(self.reorder.expire()) + self._process_merged(self.merger.expire())
+
+    def _drain(self) -> list[Any]:
+        return self._process_released(self.reorder.drain()) + self._process_merged(self.merger.drain())
+
     def listen(self) -> None:
-        logging.info(f"Listening on {self.host}:{self.port} on channel {self.channel}")
-        logging.info(f"redis_client.ping(): {self.redis_client.ping()}")
-        pubsub = self.redis_client.pubsub()
-        pubsub.subscribe(self.channel)
+        if self.source_type in (SourceType.PUBSUB, SourceType.STREAM):
+            logging.info(f"Listening on {self.host}:{self.port} on {self.source_type.value} {self.channel}")
+            logging.info(f"redis_client.ping(): {self.redis_client.ping()}")
+        source = self._open_source()
+        self._restore([source])
 
+        unacked = []
         try:
-            while self.running:
-                message = pubsub.get_message(timeout=1.0)  # Use timeout to check running flag periodically
-                if message and message['type'] == 'message':
-                    logging.debug(f"Message received {message}")
-                    self._process_event(json.loads(message['data']))
+            while self.running and not source.finished:
+                messages = source.read(timeout=1.0)  # Use timeout to check running flag periodically
+                self._track_offsets(source, messages)
+                unacked.extend(self._handle(messages))
+                unacked.extend(self._expire())
+                # only ack once the events are committed, so a crash before the commit re-delivers them; with
+                # snapshots, once a snapshot covers them, so they are re-delivered to the state they left off from
+                if self.snapshot_path is None:
+                    committed = self.database.flush()
+                else:
+                    self.database.flush()
+                    committed = self._snapshot_due()
+                    if committed:
+                        self._checkpoint()
+                if committed and unacked:
+                    source.ack(unacked)
+                    unacked = []
         finally:
             # Clean up
-            pubsub.unsubscribe()
-            pubsub.close()
+            unacked.extend(self._drain())
+            if self.snapshot_path is not None:
+                self._checkpoint()
+            self.database.close()
+            if unacked:
+                source.ack(unacked)
+            source.close()
             self.redis_client.close()
-            logging.info("Cleaned up Redis connections")
+            logging.info("Cleaned up source connections")
+
+    def replay(self, paths: list[str]) -> float:
+        """
+        Feeds recordings through reordering, merging, correction and the database as fast as they can be read,
+        returning the events per second. Held messages are only released by newer ones, never by the clock, so
+        replaying the same recordings always writes the same rows.
+        """
+        events = 0
+        start = time.perf_counter()
+        try:
+            for event in read_recordings(paths):
+                self._process_released(self.reorder.push(event))
+                events += 1
+            self._drain()
+        finally:
+            self.database.close()
+        elapsed = time.perf_counter() - start
+        rate = events / elapsed if elapsed > 0 else 0.0
+        logging.info(f"Replayed {events} events from {len(paths)} recordings in {elapsed:.2f}s ({rate:.0f} events/s)")
+        return rate
 
-    def _process_event(self, event: dict[str, Any]) -> None:
-        race_id = event['race_id']
-        device_id = event['device_id']
-        frame_number = event['frame_number']
+    def _timeline_frame(self, event: StateMessage) -> int:
+        """The frame of the race's timeline, shared by all its devices, the event was captured at."""
+        if event.capture_time is None:
+            return event.frame_number
+        epoch = self.epochs.get(event.race_id)
+        if epoch is None:
+            epoch = self.epochs[event.race_id] = self.database.race_epoch(event.race_id, event.capture_time)
+        return max(0, round((event.capture_time - epoch) * self.timeline_fps))
 
-        for i, key in [(1, "player1_state"), (2, "player2_state")]:
-            player_data = event[key]
-            player_id = device_id * 2 + i
+    def _process_event(self, event: StateMessage) -> None:
+        race_id = event.race_id
+        device_id = event.device_id
+        frame_number = self._timeline_frame(event)
 
-            if player_id not in self.previous_state:
-                self.previous_state[player_id] = None
+        for i, player_state in enumerate(event.player_states, start=1):
+            player_id = global_player_id(device_id, i)
+            # several races can be running at once, so everything a player carries is kept per race
+            key = (race_id, player_id)
 
-            player_state = PlayerState( player_data['position'],
-                                        Item[player_data['item1']],
-                                        Item[player_data['item2']],
-                                        player_data['coins'],
-                                        player_data['lap'])
-            
-            corrected_state = self.anomaly_corrector.correct_anomalies(frame_number, player_id, player_state)
+            if key not in self.previous_state:
+                self.previous_state[key] = None
+
+            corrected_state = self.anomaly_corrector.correct_anomalies(frame_number, key, player_state)
 
             # if corrected_state is not None and differs from the previous_state, publish it and set it as the new previous_state
-            if (corrected_state and self.previous_state[player_id] != corrected_state):
+            if (corrected_state and self.previous_state[key] != corrected_state):
                 logging.debug(f"Writing event for race {race_id}, frame {frame_number}, player {player_id}")
-                self.database.write_event(race_id,
-                                        frame_number,
-                                        player_id,
-                                        corrected_state.lap,
-                                        corrected_state.position,
-                                        corrected_state.coins,
-                                        corrected_state.item1.name,
-                                        corrected_state.item2.name)
-                self.previous_state[player_id] = corrected_state
+                self._write_event(race_id, frame_number, player_id, corrected_state)
+                self.previous_state[key] = corrected_state
+
+    def _write_event(self, race_id: int, frame_number: int, player_id: int, state: PlayerState) -> None:
+        self.database.write_event(race_id,
+                                  frame_number,
+                                  player_id,
+                                  state.lap,
+                                  state.position,
+                                  state.coins,
+                                  state.item1.name,
+                                  state.item2.name)
+        if self.standings is not None:
+            self.standings.update(race_id, frame_number, player_id, state)
+
+
+class AsyncEventAggregator(EventAggregator):
+    """
+    An EventAggregator consuming several channels (or streams, rings...) at once, for a venue of setups.
+
+    Every source is drained in batches by a reader task, which waits for its next batch on a thread of its own
+    so the sources block concurrently without holding up the writer's commits and acks, which run on the
+    default executor. Correction runs on the event loop, and the rows it produces are handed to a
+    single writer task that owns the database, forgets ended races once their last rows are written, and acks
+    each batch once its rows are committed. Backpressure comes from the bounded queue between the readers and
+    the writer.
+    """
+
+    def __init__(self, host: str, port: int, channels: list[str], source_type: SourceType = SourceType.PUBSUB,
+                 partitions: list[int] = None, group: str = 'aggregators', consumer: str = None,
+                 batch_size: int = 256, socket_path: str = DEFAULT_SOCKET_PATH, rings: int = 2,
+                 handle_signals: bool = True, database: Database = None, reorder: ReorderBuffer = None,
+                 standings: Standings = None, merger: TimelineMerger = None, timeline_fps: float = 60.0,
+                 anomaly_corrector: AnomalyCorrector = None, snapshot_path: str = None,
+                 snapshot_interval: float = 5.0, write_queue_size: int = 64, flush_interval: float = 0.1) -> None:
+        super().__init__(host, port, channels[0], source_type, partitions, group, consumer, batch_size, socket_path,
+                         rings, handle_signals=handle_signals, database=database, reorder=reorder,
+                         standings=standings, merger=merger, timeline_fps=timeline_fps,
+                         anomaly_corrector=anomaly_corrector, snapshot_path=snapshot_path,
+                         snapshot_interval=snapshot_interval)
+        self.channels = channels
+        self.write_queue_size = write_queue_size
+        self.flush_interval = flush_interval
+        self._rows: list[tuple[int, int, int, PlayerState]] = []
+        self._ended: list[int] = []
+
+    def _write_event(self, race_id: int, frame_number: int, player_id: int, state: PlayerState) -> None:
+        self._rows.append((race_id, frame_number, player_id, state))
+
+    def _forget_race(self, race_id: int) -> None:
+        # the race's last rows are still queued for the writer, which forgets it once they are written
+        self._ended.append(race_id)
+
+    def _source_of(self, message_id: Any) -> Any:
+        # message ids are tagged with the index of their source, see _read
+        return message_id[0]
+
+    def _commit(self, rows: list[tuple[int, int, int, PlayerState]], ended: list[int], force: bool) -> bool:
+        for row in rows:
+            super()._write_event(*row)
+        for race_id in ended:
+            super()._forget_race(race_id)
+        return self.database.flush(force)
+
+    async def _read(self, index: int, source: EventSource, writes: asyncio.Queue, readers: ThreadPoolExecutor) -> None:
+        loop = asyncio.get_running_loop()
+        while self.running and not source.finished:
+            messages = await loop.run_in_executor(readers, source.read, 1.0)
+            self._track_offsets(source, messages)
+            # released events may have come from any source, so each source's ids are kept with its index
+            done = self._handle([((index, message_id), data) for message_id, data in messages])
+            done.extend(self._expire())
+            # taken here, where the state matches the rows queued so far, and written once they are committed
+            snapshot = self._snapshot() if self._snapshot_due() else None
+            if done or self._rows or self._ended or snapshot is not None:
+                rows, self._rows = self._rows, []
+                ended, self._ended = self._ended, []
+                await writes.put((rows, ended, done, snapshot))
+
+    async def _write(self, writes: asyncio.Queue, sources: list[EventSource]) -> None:
+        unacked: dict[int, list] = {}
+        finished = False
+        while not finished:
+            try:
+                item = await asyncio.wait_for(writes.get(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                item = ([], [], [], None)
+            if item is None:
+                finished = True
+                item = ([], [], [], None)
+            rows, ended, done, snapshot = item
+            for index, message_id in done:
+                unacked.setdefault(index, []).append(message_id)
+            # only ack once the events are committed, so a crash before the commit re-delivers them; with
+            # snapshots, once a snapshot covers them, so they are re-delivered to the state they left off from
+            committed = await asyncio.to_thread(self._commit, rows, ended, finished or snapshot is not None)
+            if snapshot is not None:
+                await asyncio.to_thread(write_snapshot, self.snapshot_path, snapshot)
+            if committed and (self.snapshot_path is None or snapshot is not None):
+                for index, pending_ids in unacked.items():
+                    await asyncio.to_thread(sources[index].ack, pending_ids)
+                unacked = {}
+
+    async def _listen(self) -> None:
+        if self.source_type == SourceType.UNIX_SOCKET:
+            sources = [self._open_source()]
+        else:
+            sources = [self._open_source(channel) for channel in self.channels]
+        self._restore(sources)
+        writes = asyncio.Queue(maxsize=self.write_queue_size)
+        writer = asyncio.create_task(self._write(writes, sources))
+        # a read can block for its whole timeout, so each source gets a thread of its own
+        readers = ThreadPoolExecutor(max_workers=len(sources), thread_name_prefix='reader')
+        try:
+            await asyncio.gather(*(self._read(index, source, writes, readers)
+                                   for index, source in enumerate(sources)))
+        finally:
+            readers.shutdown()
+            done = self._drain()
+            rows, self._rows = self._rows, []
+            ended, self._ended = self._ended, []
+            await writes.put((rows, ended, done, self._snapshot() if self.snapshot_path is not None else None))
+            await writes.put(None)
+            await writer
+            self.database.close()
+            for source in sources:
+                source.close()
+            self.redis_client.close()
+            logging.info("Cleaned up source connections")
+
+    def listen(self) -> None:
+        if self.source_type in (SourceType.PUBSUB, SourceType.STREAM):
+            logging.info(f"Listening on {self.host}:{self.port} on {self.source_type.value} {', '.join(self.channels)}")
+            logging.info(f"redis_client.ping(): {self.redis_client.ping()}")
+        asyncio.run(self._listen())
 
 
 def main():
@@ -93,17 +432,96 @@ def main():
                         help='Host for the event source')
     parser.add_argument('--port', type=int, default=6379,
                         help='Port for the event source')
-    parser.add_argument('--channel', type=str, default='mario_kart_states',
-                        help='Redis channel to listen on')
+    parser.add_argument('--channel', type=str, nargs='+', default=['mario_kart_states'],
+                        help='Redis channels (or streams, with --source stream) to listen on; more than one needs --async')
+    parser.add_argument('--async', dest='use_async', action='store_true',
+                        help='Consume every channel concurrently with asyncio, writing to the database from one writer task')
+    # the queue source only exists inside main.py's SQLITE sink
+    parser.add_argument('--source', type=SourceType, default=SourceType.PUBSUB,
+                        choices=[source for source in SourceType if source != SourceType.QUEUE],
+                        help='Read from pub/sub, or from a stream through a consumer group')
+    parser.add_argument('--partitions', type=int, nargs='+', default=[0],
+                        help='Stream partitions this aggregator consumes; give each aggregator a disjoint set')
+    parser.add_argument('--group', type=str, default='aggregators',
+                        help='Stream consumer group')
+    parser.add_argument('--consumer', type=str,
+                        help='Stream consumer name; reuse it across restarts to resume from unacked entries (defaults to host-pid)')
+    parser.add_argument('--batch-size', type=int, default=256,
+                        help='Maximum stream entries (or shared memory records per ring) read at once')
+    parser.add_argument('--replay', type=str, nargs='+', metavar='RECORDING',
+                        help="Replay recordings made with main.py's --record into the database instead of listening")
+    parser.add_argument('--db-file', type=str, default='mk8cv.db',
+                        help='SQLite database to write to')
+    parser.add_argument('--db-batch-rows', type=int, default=256,
+                        help='Rows committed together in one SQLite transaction')
+    parser.add_argument('--db-flush-ms', type=float, default=100,
+                        help='Longest a row waits to be committed')
+    parser.add_argument('--db-synchronous', type=str.upper, default='NORMAL', choices=['OFF', 'NORMAL', 'FULL'],
+                        help="SQLite crash safety: FULL survives power loss, NORMAL may lose the last commits, OFF may corrupt")
+    parser.add_argument('--lateness', type=int, default=8,
+                        help='Frames a message is held back for so late frames from other processors can be put before it')
+    parser.add_argument('--max-delay', type=float, default=0.5,
+                        help='Seconds after a device goes quiet that its held back messages are released anyway')
+    parser.add_argument('--frame-stride', type=int, default=1,
+                        help="Spacing of a device's frame numbers (the frame processors' --frame-skip + 1), for counting gaps")
+    parser.add_argument('--merge-latency', type=float, default=0.25,
+                        help="Seconds of capture time a race's merged timeline waits for a lagging device before moving on")
+    parser.add_argument('--timeline-fps', type=float, default=60.0,
+                        help='Frames a second of the race timeline that race_data timestamps count')
+    parser.add_argument('--corrector', type=str, default='window', choices=['window', 'hmm'],
+                        help='Correct misreads by majority vote over a sliding window, or by fixed-lag Viterbi decoding')
+    parser.add_argument('--correction-lag', type=int, default=3,
+                        help='With the hmm corrector, frames each state is published after')
+    parser.add_argument('--snapshot', type=str, metavar='PATH',
+                        help='Snapshot the aggregator state to PATH, and resume from it on startup')
+    parser.add_argument('--snapshot-interval', type=float, default=5.0,
+                        help='Seconds between snapshots; stream entries are acked once a snapshot covers them')
+    parser.add_argument('--standings-port', type=int, default=8081,
+                        help='Port serving the live standings and their server-sent event feed; 0 disables it')
+    parser.add_argument('--standings-rate', type=float, default=4.0,
+                        help='Most standings updates sent to each feed client a second')
+    parser.add_argument('--socket-path', type=str, default=DEFAULT_SOCKET_PATH,
+                        help='Path the unix socket source binds to')
+    parser.add_argument('--rings', type=int, default=2,
+                        help='Shared memory rings to poll, named <channel>_<n>; one per frame processor thread')
 
     args = parser.parse_args()
 
-    aggregator = EventAggregator(args.host, args.port, args.channel)
+    database = SqliteDB(args.db_file, batch_rows=args.db_batch_rows, flush_ms=args.db_flush_ms, synchronous=args.db_synchronous)
+    reorder = ReorderBuffer(args.lateness, args.max_delay, args.frame_stride)
+    merger = TimelineMerger(args.merge_latency, args.max_delay)
+    corrector = HmmAnomalyCorrector(database, args.correction_lag) if args.corrector == 'hmm' else None
+    standings = Standings()
+    server = None
+    if args.standings_port and not args.replay:
+        server = StandingsServer(standings, port=args.standings_port, max_rate=args.standings_rate)
+        server.start()
+    if args.use_async:
+        aggregator = AsyncEventAggregator(args.host, args.port, args.channel, args.source, args.partitions,
+                                          args.group, args.consumer, args.batch_size, args.socket_path, args.rings,
+                                          database=database, reorder=reorder, standings=standings, merger=merger,
+                                          timeline_fps=args.timeline_fps, anomaly_corrector=corrector,
+                                          snapshot_path=args.snapshot, snapshot_interval=args.snapshot_interval,
+                                          flush_interval=args.db_flush_ms / 1000)
+    else:
+        if len(args.channel) > 1:
+            parser.error('listening on more than one channel needs --async')
+        aggregator = EventAggregator(args.host, args.port, args.channel[0], args.source, args.partitions, args.group,
+                                     args.consumer, args.batch_size, args.socket_path, args.rings,
+                                     database=database, reorder=reorder, standings=standings, merger=merger,
+                                     timeline_fps=args.timeline_fps, anomaly_corrector=corrector,
+                                     snapshot_path=args.snapshot, snapshot_interval=args.snapshot_interval)
 
     try:
-        aggregator.listen()
+        if args.replay:
+            aggregator.replay(args.replay)
+        else:
+            aggregator.listen()
     except KeyboardInterrupt:
         logging.info("Aggregator stopped.")
+    finally:
+        if server is not None:
+            server.close()
 
 
 if __name__ == "__main__":
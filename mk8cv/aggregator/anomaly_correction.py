@@ -1,9 +1,11 @@
 from abc import ABC, abstractmethod
+import heapq
 import logging
-from collections import Counter
+from collections import deque
+from typing import Any, Hashable
 
 from mk8cv.data.state import PlayerState, Item
-from db import Database
+from mk8cv.aggregator.db import Database
 
 logging.getLogger().setLevel(logging.DEBUG)
 
@@ -15,56 +17,118 @@ class AnomalyCorrector(ABC):
     def correct_anomalies(self, player_id: int, state: PlayerState) -> PlayerState:
         pass
 
+    def end_race(self, race_id: int) -> None:
+        """Drops the history kept for the players of a race that has ended."""
+        pass
+
+    def snapshot(self) -> Any:
+        """The history kept for every player, picklable, for the aggregator's snapshots."""
+        return None
+
+    def restore(self, state: Any) -> None:
+        pass
+
+
+# PlayerState attributes voted on, in the order PlayerState takes them
+_FIELDS = ('position', 'item1', 'item2', 'coins', 'lap', 'race_laps')
+
+
+class _PlayerWindow:
+    """
+    One player's window of states, with every field's values counted as states enter and leave it.
+
+    Each field keeps, for every value in the window, a deque of the insertion numbers of the states holding it,
+    so its count and first occurrence are read off in O(1). Voting scans the distinct values of a field, which
+    the HUD bounds (12 positions, 24 items...), never the window.
+    """
+    __slots__ = ('states', 'timestamps', 'occurrences', 'inserted')
+
+    def __init__(self) -> None:
+        self.states: dict[int, tuple[int, PlayerState]] = {}  # timestamp -> (insertion number, state), oldest first
+        self.timestamps: list[int] = []  # min-heap of the timestamps in states
+        self.occurrences: list[dict[object, deque[int]]] = [{} for _ in _FIELDS]
+        self.inserted = 0
+
+    def last(self) -> PlayerState:
+        return self.states[next(reversed(self.states))][1]
+
+    def add(self, timestamp: int, state: PlayerState) -> None:
+        number = self.inserted
+        self.inserted += 1
+        self.states[timestamp] = (number, state)
+        heapq.heappush(self.timestamps, timestamp)
+        for occurrences, field in zip(self.occurrences, _FIELDS):
+            value = getattr(state, field)
+            if value in occurrences:
+                occurrences[value].append(number)
+            else:
+                occurrences[value] = deque((number,))
+
+    def evict_oldest(self) -> None:
+        """Drops the state with the lowest timestamp, which is the first inserted unless frames arrived out of order."""
+        number, state = self.states.pop(heapq.heappop(self.timestamps))
+        for occurrences, field in zip(self.occurrences, _FIELDS):
+            value = getattr(state, field)
+            numbers = occurrences[value]
+            if numbers[0] == number:
+                numbers.popleft()
+            else:
+                numbers.remove(number)
+            if not numbers:
+                del occurrences[value]
+
+    def vote(self) -> PlayerState:
+        # like Counter.most_common, ties go to the value seen first in the window
+        return PlayerState(*(max(occurrences, key=lambda value: (len(occurrences[value]), -occurrences[value][0]))
+                             for occurrences in self.occurrences))
+
 
 class SlidingWindowAnomalyCorrector(AnomalyCorrector):
     """
     A sliding-window based approach to anomaly correction. For a given player, a sliding
     window is maintained and used to detect anomolous values, using the following rules:
     - if a non-item value is None, use the previous value
+    - every field is published as its most common value over the last window_size frames
 
-
+    Updates never rescan the window (only evicting by lowest timestamp touches a heap), so windows of a second or
+    more of frames are cheap.
     """
 
     def __init__(self, database: Database, window_size: int = 5) -> None:
         self.database = database
         self.window_size = window_size
-        self.history: dict[int, dict[int, PlayerState]] = {} # playerId -> ( timestamp -> PlayerState )
+        self.history: dict[Hashable, _PlayerWindow] = {} # player key -> window of (timestamp -> PlayerState)
 
-    def correct_anomalies(self, timestamp: int, player_id: int, state: PlayerState) -> PlayerState:
+    def correct_anomalies(self, timestamp: int, player_id: Hashable, state: PlayerState) -> PlayerState:
 
         corrected_position = self.correctPosition(state.position, timestamp, player_id)
-        corrected_item1 : Item = state.item1
-        corrected_item2 : Item = state.item2
-        corrected_coins = state.coins
-        corrected_lap = state.lap
-        corrected_race_laps = state.race_laps
-
-        corrected_state = PlayerState(corrected_position, corrected_item1, corrected_item2, corrected_coins, corrected_lap, corrected_race_laps)
+        corrected_state = PlayerState(corrected_position, state.item1, state.item2, state.coins, state.lap, state.race_laps)
 
         # add the new record to the history
         if player_id not in self.history:
-            self.history[player_id] = {}
-        if timestamp not in self.history[player_id]:
-            self.history[player_id][timestamp] = corrected_state
-
-        # check if the self.history[player_id] has more than self.window_size entries. If it does, remove the oldest entries until it is the same size
-        while len(self.history[player_id]) > self.window_size:
-            oldest_timestamp = min(self.history[player_id].keys())
-            del self.history[player_id][oldest_timestamp]
-
-        published_state = PlayerState(
-            Counter(past_state.position for past_state in self.history[player_id].values()).most_common(1)[0][0],
-            Counter(past_state.item1 for past_state in self.history[player_id].values()).most_common(1)[0][0],
-            Counter(past_state.item2 for past_state in self.history[player_id].values()).most_common(1)[0][0],
-            Counter(past_state.coins for past_state in self.history[player_id].values()).most_common(1)[0][0],
-            Counter(past_state.lap for past_state in self.history[player_id].values()).most_common(1)[0][0],
-            Counter(past_state.race_laps for past_state in self.history[player_id].values()).most_common(1)[0][0]
-        )
-
-        return published_state
-    
-
-    def correctPosition(self, position: int, timestamp: int, player_id: int) -> int:
+            self.history[player_id] = _PlayerWindow()
+        window = self.history[player_id]
+        if timestamp not in window.states:
+            window.add(timestamp, corrected_state)
+
+        # drop the oldest entries until the window is back to self.window_size
+        while len(window.states) > self.window_size:
+            window.evict_oldest()
+
+        return window.vote()
+
+    def end_race(self, race_id: int) -> None:
+        # player keys are (race_id, player_id)
+        self.history = {key: window for key, window in self.history.items() if key[0] != race_id}
+
+    def snapshot(self) -> dict[Hashable, _PlayerWindow]:
+        return self.history
+
+    def restore(self, state: dict[Hashable, _PlayerWindow]) -> None:
+        self.history = state
+
+
+    def correctPosition(self, position: int, timestamp: int, player_id: Hashable) -> int:
         # if position is 0 then us the previous position
         if position != 0:
             return position
@@ -72,7 +136,6 @@ class SlidingWindowAnomalyCorrector(AnomalyCorrector):
             if player_id not in self.history:
                 logging.debug(f"player_id {player_id} not in history")
                 return position
-            previous_state = self.history[player_id][list(self.history[player_id].keys())[len(self.history[player_id]) - 1]]
-            corrected_position = previous_state.position
+            corrected_position = self.history[player_id].last().position
             logging.debug(f"correcting position from 0 to {corrected_position}")
             return corrected_position
@@ -0,0 +1,188 @@
+import argparse
+import datetime
+import glob
+import logging
+import os
+import shutil
+import sqlite3
+from typing import Iterable, Optional
+
+from mk8cv.data.state import Item
+
+# Items are dictionary encoded against the same dictionary in every file, so datasets concatenate without
+# re-encoding; an item's index is its position in Item
+ITEM_NAMES = [item.name for item in Item]
+_ITEM_INDEX = {name: index for index, name in enumerate(ITEM_NAMES)}
+# PRAGMA auto_vacuum's value for INCREMENTAL
+_INCREMENTAL_VACUUM = 2
+
+
+def _pyarrow():
+    # pyarrow is only needed to archive and scan races, so it is an optional dependency (pip install .[archive])
+    try:
+        import pyarrow
+        import pyarrow.dataset
+        import pyarrow.parquet
+    except ImportError as e:
+        raise ImportError("Archiving races needs pyarrow: pip install pyarrow") from e
+    return pyarrow
+
+
+def _partitioning():
+    pa = _pyarrow()
+    return pa.dataset.partitioning(pa.schema([('date', pa.string()), ('race_id', pa.int32())]), flavor='hive')
+
+
+def race_path(root: str, date: str, race_id: int) -> str:
+    return os.path.join(root, f'date={date}', f'race_id={race_id}', 'part-0.parquet')
+
+
+def _reclaim(conn: sqlite3.Connection) -> None:
+    """Returns the pages freed by deleted rows to the file system, which SQLite otherwise keeps for reuse."""
+    if conn.execute('PRAGMA auto_vacuum;').fetchone()[0] == _INCREMENTAL_VACUUM:
+        # execute steps the pragma once, freeing a single page; executescript runs it to completion
+        conn.executescript('PRAGMA incremental_vacuum;')
+    else:
+        logging.info("The database was created before incremental vacuuming, so its freed pages are kept for reuse; "
+                     "run with --vacuum while the aggregator is stopped to shrink it")
+
+
+def vacuum(conn: sqlite3.Connection) -> None:
+    """
+    Rewrites the database without its free pages, switching one created before SqliteDB enabled incremental
+    vacuuming over to it so later archives shrink it as they go. This holds the write lock for as long as the
+    rewrite takes, far longer than the aggregator waits for it, so only run it while the aggregator is stopped.
+    """
+    conn.execute(f'PRAGMA auto_vacuum={_INCREMENTAL_VACUUM};')
+    conn.execute('VACUUM;')
+
+
+def archive_race(conn: sqlite3.Connection, root: str, race_id: int, date: str = None, delete: bool = True,
+                 force: bool = False) -> int:
+    """
+    Moves a finished race's race_data rows to a Parquet file under root, returning the number of rows moved.
+
+    A race is only archived once the aggregator has ended it (see race_end), and while it has no rows newer than
+    those committed when it ended, since a device still sending to it would write rows after they were deleted.
+    force archives it regardless, for races written before race_end was kept.
+
+    Files are partitioned hive-style by date (the day the race is archived unless given) and race_id, which
+    therefore are not stored in the file. Counts are narrow integer columns and items are dictionary encoded,
+    and rows are sorted by player and frame, so row group statistics let scans skip players and frame ranges.
+    The file is written under a temporary name that scans skip, checked to hold every row, and only then
+    swapped in for the race's earlier file, if any, so a failed archive never loses an archived race. The rows
+    are then deleted from SQLite, and the pages they took returned to the file system; the race's intervals,
+    standings and rollups stay, as they are small and the viewer reads them.
+    """
+    pa = _pyarrow()
+    rows = conn.execute(
+        '''
+        SELECT timestamp, player_id, lap, position, coins, item_1, item_2
+        FROM race_data
+        WHERE race_id = ?
+        ORDER BY player_id, timestamp;
+        ''', (race_id,)).fetchall()
+    if not rows:
+        logging.warning(f"Race {race_id} has no race_data rows to archive")
+        return 0
+    ended = conn.execute('SELECT last_frame FROM race_end WHERE race_id = ?;', (race_id,)).fetchone()
+    if not force and ended is None:
+        logging.warning(f"Race {race_id} has not ended, not archiving it")
+        return 0
+    if not force and max(row[0] for row in rows) > ended[0]:
+        logging.warning(f"Race {race_id} has rows written after it ended, not archiving it")
+        return 0
+
+    frames, player_ids, laps, positions, coins, items_1, items_2 = zip(*rows)
+    items = pa.array(ITEM_NAMES, type=pa.string())
+    table = pa.Table.from_arrays([
+        pa.array(frames, type=pa.int32()),
+        pa.array(player_ids, type=pa.int16()),
+        pa.array(laps, type=pa.int8()),
+        pa.array(positions, type=pa.int8()),
+        pa.array(coins, type=pa.int8()),
+        pa.DictionaryArray.from_arrays(pa.array([_ITEM_INDEX[item] for item in items_1], type=pa.int8()), items),
+        pa.DictionaryArray.from_arrays(pa.array([_ITEM_INDEX[item] for item in items_2], type=pa.int8()), items),
+    ], names=['frame', 'player_id', 'lap', 'position', 'coins', 'item_1', 'item_2'])
+
+    path = race_path(root, date or datetime.date.today().isoformat(), race_id)
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    temporary = os.path.join(directory, f'.{os.path.basename(path)}.tmp')
+    pa.parquet.write_table(table, temporary, compression='zstd')
+    written = pa.parquet.read_metadata(temporary).num_rows
+    if written != len(rows):
+        os.remove(temporary)
+        raise IOError(f"Archive {temporary} holds {written} of race {race_id}'s {len(rows)} rows")
+    os.replace(temporary, path)
+    # a race archived again replaces its earlier file, whatever day that was written
+    for previous in glob.glob(os.path.join(root, 'date=*', f'race_id={race_id}')):
+        if os.path.abspath(previous) != os.path.abspath(directory):
+            shutil.rmtree(previous)
+
+    if delete:
+        with conn:
+            conn.execute('DELETE FROM race_data WHERE race_id = ?;', (race_id,))
+        _reclaim(conn)
+    logging.info(f"Archived {len(rows)} rows of race {race_id} to {path} ({os.path.getsize(path)} bytes)")
+    return len(rows)
+
+
+def scan(root: str, columns: list[str] = None, race_ids: Iterable[int] = None, player_ids: Iterable[int] = None,
+         since: str = None, until: str = None, where=None):
+    """
+    Reads archived race_data into a pyarrow Table, with date and race_id as columns alongside the stored ones.
+
+    race_ids, since and until (ISO dates, inclusive) prune whole partitions, and player_ids and any further
+    pyarrow.dataset expression in where are pushed down to row group statistics, so only matching data is read.
+    """
+    pa = _pyarrow()
+    dataset = pa.dataset.dataset(root, format='parquet', partitioning=_partitioning())
+    predicates = [where] if where is not None else []
+    if race_ids is not None:
+        predicates.append(pa.dataset.field('race_id').isin(list(race_ids)))
+    if player_ids is not None:
+        predicates.append(pa.dataset.field('player_id').isin(list(player_ids)))
+    if since is not None:
+        predicates.append(pa.dataset.field('date') >= since)
+    if until is not None:
+        predicates.append(pa.dataset.field('date') <= until)
+    expression: Optional[object] = None
+    for predicate in predicates:
+        expression = predicate if expression is None else expression & predicate
+    return dataset.to_table(columns=columns, filter=expression)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Move finished races from SQLite to partitioned Parquet files")
+    parser.add_argument('--db-file', type=str, default='mk8cv.db',
+                        help='SQLite database to archive races from')
+    parser.add_argument('--out-dir', type=str, default='archive',
+                        help='Root of the Parquet dataset')
+    parser.add_argument('--race-id', type=int, nargs='+', default=[],
+                        help='Finished races to archive')
+    parser.add_argument('--date', type=str,
+                        help='Date partition to archive the races under, as YYYY-MM-DD (defaults to today)')
+    parser.add_argument('--keep-rows', action='store_true',
+                        help='Leave the race_data rows in SQLite after archiving them')
+    parser.add_argument('--force', action='store_true',
+                        help='Archive the races even if the aggregator has not ended them')
+    parser.add_argument('--vacuum', action='store_true',
+                        help='Rewrite the database afterwards to shrink it; only while the aggregator is stopped')
+    args = parser.parse_args()
+    if not args.race_id and not args.vacuum:
+        parser.error('give races to archive with --race-id, or --vacuum')
+
+    logging.getLogger().setLevel(logging.INFO)
+    conn = sqlite3.connect(args.db_file)
+    try:
+        for race_id in args.race_id:
+            archive_race(conn, args.out_dir, race_id, args.date, delete=not args.keep_rows, force=args.force)
+        if args.vacuum:
+            vacuum(conn)
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -2,7 +2,11 @@ from abc import ABC, abstractmethod
 from contextlib import contextmanager
 import logging
 import sqlite3
+import threading
+import time
 
+from mk8cv.aggregator.intervals import CLOSE_INTERVAL, INSERT_INTERVAL, IntervalTracker
+from mk8cv.aggregator.rollups import ROLLUP_STATEMENTS, RollupTracker, write_rollups
 from mk8cv.data.state import PlayerState, Item
 
 logging.getLogger().setLevel(logging.DEBUG)
@@ -24,6 +28,21 @@ class Database(ABC):
                 item_2: str):
         pass
 
+    def flush(self, force: bool = False) -> bool:
+        """Writes out buffered events if they are due, or all of them if forced. True once nothing is buffered."""
+        return True
+
+    def close(self) -> None:
+        pass
+
+    def end_race(self, race_id: int) -> None:
+        """Called once a race has ended, to drop anything kept in memory for it."""
+        pass
+
+    def race_epoch(self, race_id: int, capture_time: float) -> float:
+        """The capture time frame 0 of the race's timeline is at, fixed by the first capture time asked with."""
+        return capture_time
+
     @abstractmethod
     def get_previous_events(self,
                            race_id: int,
@@ -32,30 +51,70 @@ class Database(ABC):
         pass
 
 class SqliteDB(Database):
+    """
+    Writes race data through one long-lived connection in WAL mode.
+
+    Rows are buffered and committed together with executemany once batch_rows are waiting or the oldest has
+    waited flush_ms, so a commit (and its fsync) covers many events. synchronous sets SQLite's crash safety:
+    NORMAL never corrupts the database but a power loss may drop the last commits, FULL syncs every commit.
+    Call close to write whatever is still buffered. Each row also updates race_standings, race_intervals and the
+    rollup tables, see IntervalTracker and RollupTracker, in the same transaction. Ending a race commits its
+    buffered rows and records it in race_end, which archiving checks.
+    """
+
     def __init__(self, db_file: str = 'mk8cv.db', schema_file: str = r'./mk8cv-db/schema.sql',
-                 race_data_table: str = 'race_data') -> None:
+                 race_data_table: str = 'race_data', batch_rows: int = 256, flush_ms: float = 100,
+                 synchronous: str = 'NORMAL') -> None:
         super().__init__()
         self.db_file = db_file
         self.race_data_table = race_data_table
+        self.batch_rows = batch_rows
+        self.flush_ms = flush_ms
+        # the embedded aggregator writes from a thread other than the one that opened the database
+        self.conn = sqlite3.connect(db_file, check_same_thread=False)
+        # lets archiving shrink the file after deleting races; only takes effect when the database is created
+        self.conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute(f'PRAGMA synchronous={synchronous}')
+        self._lock = threading.Lock()
+        self._rows: list[tuple] = []
+        self._interval_inserts: list[tuple] = []
+        self._interval_closes: list[tuple] = []
+        self._rollups: dict[str, list[tuple]] = {statement: [] for statement in ROLLUP_STATEMENTS}
+        self._oldest_row = 0.0
+        self._insert = f'''
+            INSERT OR REPLACE INTO {self.race_data_table}
+            (race_id, timestamp, player_id, lap, position, coins, item_1, item_2)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?);
+            '''
+        # the latest state of every player, which redelivered older rows must not overwrite
+        self._upsert_standing = '''
+            INSERT INTO race_standings (race_id, frame, player_id, lap, position, coins, item_1, item_2)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (race_id, player_id) DO UPDATE SET
+                frame = excluded.frame,
+                lap = excluded.lap,
+                position = excluded.position,
+                coins = excluded.coins,
+                item_1 = excluded.item_1,
+                item_2 = excluded.item_2
+            WHERE excluded.frame >= race_standings.frame;
+            '''
         self.create_tables(schema_file)
+        self.intervals = IntervalTracker(self.conn)
+        self.rollups = RollupTracker(self.conn)
 
     def create_tables(self, schema_file: str):
         logging.info(f"Creating tables from schema file {schema_file}")
-        with self.get_connections() as conn:
-            cursor = conn.cursor()
-
-            with open(schema_file, 'r') as f:
-                cursor.executescript(f.read())
-            conn.commit()
+        with open(schema_file, 'r') as f:
+            self.conn.executescript(f.read())
+        self.conn.commit()
         logging.info("Tables created")
 
     @contextmanager
     def get_connections(self):
-        conn = sqlite3.connect(self.db_file)
-        try:
-            yield conn
-        finally:
-            conn.close()
+        with self._lock:
+            yield self.conn
 
     def write_event(self,
                     race_id: int,
@@ -66,35 +125,75 @@ class SqliteDB(Database):
                     coins: int,
                     item_1: str,
                     item_2: str):
-        with self.get_connections() as conn:
-            cursor = conn.cursor()
-
-            row = {
-                'race_id': race_id,
-                'timestamp': timestamp,
-                'player_id': player_id,
-                'lap': lap,
-                'position': position,
-                'coins' : coins,
-                'item_1': item_1,
-                'item_2': item_2
-            }
-
-            logging.debug(f"Inserting row {row}")
-
-            cursor.execute(
-                f'''
-                INSERT OR REPLACE INTO {self.race_data_table}
-                (race_id, timestamp, player_id, lap, position, coins, item_1, item_2)
-                VALUES (:race_id, :timestamp, :player_id, :lap, :position, :coins, :item_1, :item_2);
-                ''', row)
-            conn.commit()
-
+        row = (race_id, timestamp, player_id, lap, position, coins, item_1, item_2)
+        logging.debug(f"Buffering row {row}")
+        with self._lock:
+            if not self._rows:
+                self._oldest_row = time.monotonic()
+            self._rows.append(row)
+            inserts, closes = self.intervals.track(row)
+            self._interval_inserts.extend(inserts)
+            self._interval_closes.extend(closes)
+            for statement, params in self.rollups.track(row).items():
+                self._rollups[statement].extend(params)
+            if len(self._rows) >= self.batch_rows:
+                self._flush()
+
+    def _flush(self) -> None:
+        if not self._rows:
+            return
+        with self.conn:
+            self.conn.executemany(self._insert, self._rows)
+            self.conn.executemany(self._upsert_standing, self._rows)
+            # an interval can be opened and closed within one batch, so inserts go first
+            self.conn.executemany(INSERT_INTERVAL, self._interval_inserts)
+            self.conn.executemany(CLOSE_INTERVAL, self._interval_closes)
+            write_rollups(self.conn, self._rollups)
+        logging.debug(f"Committed {len(self._rows)} rows")
+        self._rows = []
+        self._interval_inserts = []
+        self._interval_closes = []
+        self._rollups = {statement: [] for statement in ROLLUP_STATEMENTS}
+
+    def flush(self, force: bool = False) -> bool:
+        """Commits the buffered rows if forced or the oldest has waited flush_ms. True if nothing is left buffered."""
+        with self._lock:
+            if force or (self._rows and (time.monotonic() - self._oldest_row) * 1000 >= self.flush_ms):
+                self._flush()
+            return not self._rows
+
+    def close(self) -> None:
+        self.flush(force=True)
+        with self._lock:
+            self.conn.close()
+
+    def end_race(self, race_id: int) -> None:
+        with self._lock:
+            # the race's buffered rows are committed first, so race_end covers everything written before it ended
+            self._flush()
+            with self.conn:
+                self.conn.execute('''
+                    INSERT OR REPLACE INTO race_end (race_id, last_frame)
+                    SELECT race_id, MAX(timestamp) FROM race_data WHERE race_id = ? GROUP BY race_id;
+                    ''', (race_id,))
+            self.intervals.forget(race_id)
+            self.rollups.forget(race_id)
+
+    def race_epoch(self, race_id: int, capture_time: float) -> float:
+        # kept in race_clock, so a restarted aggregator puts the race's later frames on the same timeline
+        with self._lock:
+            with self.conn:
+                self.conn.execute('INSERT OR IGNORE INTO race_clock (race_id, epoch) VALUES (?, ?);',
+                                  (race_id, capture_time))
+            (epoch,) = self.conn.execute('SELECT epoch FROM race_clock WHERE race_id = ?;', (race_id,)).fetchone()
+        return epoch
 
     def get_previous_events(self,
                         race_id: int,
                         player_id: int,
                         num_rows: int = 1):
+        # rows still buffered are among the most recent, so commit them before reading
+        self.flush(force=True)
         with self.get_connections() as conn:
             cursor = conn.cursor()
 
@@ -0,0 +1,260 @@
+import argparse
+import csv
+import logging
+import random
+import time
+from collections import deque
+from typing import Any, Callable, Hashable, Optional
+
+import numpy as np
+
+from mk8cv.aggregator.anomaly_correction import AnomalyCorrector, SlidingWindowAnomalyCorrector
+from mk8cv.data.state import Item, PlayerState, global_player_id
+from mk8cv.sinks.recording import read_recordings
+
+# PlayerState attributes decoded, in the order PlayerState takes them
+_FIELDS = ('position', 'item1', 'item2', 'coins', 'lap', 'race_laps')
+# The values each field can take; a reading outside them (0 and -1 for unread, None) carries no information
+_POSITIONS = list(range(1, 13))
+_ITEMS = list(Item)
+_COINS = list(range(0, 11))
+_LAPS = list(range(1, 10))
+_VALUES = (_POSITIONS, _ITEMS, _ITEMS, _COINS, _LAPS, _LAPS)
+_STATES = max(len(values) for values in _VALUES)
+
+# Probability that a reading is wrong
+MISREAD = 0.1
+# Per-frame probabilities of each change, and of any other change, which stays possible so a decoder that went
+# wrong recovers. Positions move a place or two at a time; laps only ever go up by one; coins are picked up one
+# at a time and lost a few at a time when hit; items and the race's lap count change as wholes.
+_POSITION_STEPS = {-1: 0.01, 1: 0.01, -2: 0.002, 2: 0.002}
+_LAP_STEPS = {1: 0.002}
+_COIN_STEPS = {1: 0.03, -1: 0.005, -2: 0.005, -3: 0.005}
+_ITEM_CHANGE = 0.02
+_RACE_LAPS_CHANGE = 0.0001
+_OTHER_CHANGE = 1e-6
+
+
+def _transitions(values: list, steps: dict[int, float] = None, change: float = 0.0) -> np.ndarray:
+    """Log transition matrix, padded to _STATES: steps moves between ordered values, or change to any other."""
+    count = len(values)
+    matrix = np.full((count, count), _OTHER_CHANGE + change / max(count - 1, 1))
+    for step, probability in (steps or {}).items():
+        for i in range(max(0, -step), min(count, count - step)):
+            matrix[i, i + step] += probability
+    np.fill_diagonal(matrix, 0.0)
+    np.fill_diagonal(matrix, 1.0 - matrix.sum(axis=1))
+    padded = np.full((_STATES, _STATES), -np.inf)
+    padded[:count, :count] = np.log(matrix)
+    return padded
+
+
+_LOG_TRANSITIONS = np.stack([
+    _transitions(_POSITIONS, _POSITION_STEPS),
+    _transitions(_ITEMS, change=_ITEM_CHANGE),
+    _transitions(_ITEMS, change=_ITEM_CHANGE),
+    _transitions(_COINS, _COIN_STEPS),
+    _transitions(_LAPS, _LAP_STEPS),
+    _transitions(_LAPS, change=_RACE_LAPS_CHANGE),
+])  # field -> from -> to
+_INDEX = [{value: index for index, value in enumerate(values)} for values in _VALUES]
+_FIELD_RANGE = np.arange(len(_FIELDS))
+
+
+class _PlayerDecoder:
+    """One player's Viterbi scores over every field's values, and the backpointers of the last lag frames."""
+    __slots__ = ('scores', 'backpointers', 'seen', 'timestamp', 'output')
+
+    def __init__(self, lag: int) -> None:
+        self.scores = np.where(np.isfinite(_LOG_TRANSITIONS[:, 0, :]), 0.0, -np.inf)  # field -> value
+        self.backpointers: deque[np.ndarray] = deque(maxlen=lag)  # per frame, field -> value -> previous value
+        self.seen = np.zeros(len(_FIELDS), dtype=bool)
+        self.timestamp = None
+        self.output: Optional[PlayerState] = None
+
+
+class HmmAnomalyCorrector(AnomalyCorrector):
+    """
+    Decodes each player's readings with an online fixed-lag Viterbi decoder per field, instead of voting.
+
+    Every field is a hidden Markov model over its possible values, with transitions encoding how the game lets
+    it change (see _POSITION_STEPS etc.) and readings wrong MISREAD of the time. For each frame the most likely
+    sequence of values is found, and the value it gives the frame lag frames back is published: later frames
+    can still overrule a misread up to lag frames old, and a real change comes through lag frames after it is
+    read. All fields are decoded together as one padded array, so a frame costs a few numpy operations. A field
+    never read in range, e.g. a stat that is not extracted, is passed through as read. Frames no newer than the
+    player's last are not decoded, and get the last published state.
+    """
+
+    def __init__(self, database=None, lag: int = 3, misread: float = MISREAD) -> None:
+        self.database = database
+        self.lag = lag
+        self.history: dict[Hashable, _PlayerDecoder] = {}  # player key -> decoder
+        self._log_emissions = np.stack([
+            np.log(np.full(_STATES, misread / (len(values) - 1))) for values in _VALUES])  # reading was wrong
+        self._log_hit = np.log(1.0 - misread)
+
+    def correct_anomalies(self, timestamp: int, player_id: Hashable, state: PlayerState) -> PlayerState:
+        decoder = self.history.get(player_id)
+        if decoder is None:
+            decoder = self.history[player_id] = _PlayerDecoder(self.lag)
+        if decoder.timestamp is not None and timestamp <= decoder.timestamp:
+            return decoder.output
+        decoder.timestamp = timestamp
+
+        readings = [getattr(state, field) for field in _FIELDS]
+        observed = np.array([index.get(reading, -1) for index, reading in zip(_INDEX, readings)])
+        known = observed >= 0
+        decoder.seen |= known
+
+        # scores[f, i] + transitions[f, i, j] is the best path to value j through value i
+        paths = decoder.scores[:, :, None] + _LOG_TRANSITIONS
+        previous = paths.argmax(axis=1)
+        scores = paths.max(axis=1)
+        emissions = np.where(known[:, None], self._log_emissions, 0.0)
+        emissions[known, observed[known]] = self._log_hit
+        scores += emissions
+        decoder.scores = scores - scores.max(axis=1, keepdims=True)
+
+        # follow the best path back to the frame lag frames ago
+        decoder.backpointers.append(previous)
+        best = decoder.scores.argmax(axis=1)
+        for backpointer in reversed(decoder.backpointers):
+            best = backpointer[_FIELD_RANGE, best]
+
+        decoder.output = PlayerState(*(values[index] if seen else reading
+                                       for values, index, seen, reading
+                                       in zip(_VALUES, best, decoder.seen, readings)))
+        return decoder.output
+
+    def end_race(self, race_id: int) -> None:
+        # player keys are (race_id, player_id)
+        self.history = {key: decoder for key, decoder in self.history.items() if key[0] != race_id}
+
+    def snapshot(self) -> dict[Hashable, _PlayerDecoder]:
+        return self.history
+
+    def restore(self, state: dict[Hashable, _PlayerDecoder]) -> None:
+        self.history = state
+
+
+def _fields(state: PlayerState) -> tuple:
+    return tuple(getattr(state, field) for field in _FIELDS)
+
+
+def _run(corrector: AnomalyCorrector, streams: dict[Hashable, list[tuple[int, PlayerState]]]
+         ) -> tuple[dict[Hashable, list[tuple]], float]:
+    outputs = {}
+    start = time.perf_counter()
+    for key, stream in streams.items():
+        outputs[key] = [_fields(corrector.correct_anomalies(timestamp, key, state)) for timestamp, state in stream]
+    return outputs, time.perf_counter() - start
+
+
+def benchmark(streams: dict[Hashable, list[tuple[int, PlayerState]]],
+              correctors: dict[str, Callable[[], AnomalyCorrector]],
+              truth: dict[Hashable, list[PlayerState]] = None) -> dict[str, dict[str, Any]]:
+    """
+    Runs each corrector over every player's stream of (timestamp, reading), returning per corrector its events
+    a second and how many times each field's published value changed (flicker). With the true states of the
+    frames, also each field's accuracy and the mean events a true change took to be published.
+    """
+    events = sum(len(stream) for stream in streams.values())
+    results = {}
+    for name, factory in correctors.items():
+        outputs, elapsed = _run(factory(), streams)
+        result = {'events_per_second': events / elapsed if elapsed > 0 else 0.0, 'changes': {}, 'accuracy': {},
+                  'delay': {}}
+        for f, field in enumerate(_FIELDS):
+            result['changes'][field] = sum(a[f] != b[f] for output in outputs.values()
+                                           for a, b in zip(output, output[1:]))
+            if truth is None:
+                continue
+            expected = {key: [_fields(state) for state in states] for key, states in truth.items()}
+            correct = sum(out[f] == exp[f] for key in outputs for out, exp in zip(outputs[key], expected[key]))
+            result['accuracy'][field] = correct / events
+            delays = []
+            for key, output in outputs.items():
+                states = expected[key]
+                for i in range(1, len(states)):
+                    if states[i][f] != states[i - 1][f]:
+                        delay = next((j - i for j in range(i, len(output)) if output[j][f] == states[i][f]), None)
+                        if delay is not None:
+                            delays.append(delay)
+            result['delay'][field] = sum(delays) / len(delays) if delays else None
+        results[name] = result
+    return results
+
+
+def read_annotations(path: str) -> list[tuple[int, tuple[PlayerState, ...]]]:
+    """The (frame_number, player states) of a hand-annotated CSV like tests/data/test_annotations.csv."""
+    frames = []
+    with open(path, 'r') as f:
+        for row in csv.DictReader(f):
+            players = sorted({column.split('_')[0] for column in row if column.startswith('player')})
+            frames.append((int(row['frame_number']), tuple(PlayerState(
+                position=int(row[f'{player}_position']),
+                item1=Item.get(row[f'{player}_item1'], None),
+                item2=Item.get(row[f'{player}_item2'], None),
+                coins=int(row[f'{player}_coins']),
+                lap_num=int(row[f'{player}_lap_num']),
+                race_laps=int(row[f'{player}_race_laps'])) for player in players)))
+    return frames
+
+
+def _misread(state: PlayerState, rng: random.Random, rate: float) -> PlayerState:
+    noisy = [getattr(state, field) for field in _FIELDS]
+    for f, values in enumerate(_VALUES):
+        if rng.random() < rate:
+            noisy[f] = rng.choice(values + [None])
+    return PlayerState(*noisy)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the HMM and sliding window anomaly correctors")
+    parser.add_argument('--recording', type=str, nargs='+',
+                        help="Recordings made with main.py's --record to correct")
+    parser.add_argument('--annotations', type=str, default='./tests/data/test_annotations.csv',
+                        help='Annotated frames used as the truth when no recording is given, with misreads added')
+    parser.add_argument('--noise', type=float, default=0.1,
+                        help='Fraction of annotated readings replaced with a random value')
+    parser.add_argument('--window-size', type=int, default=9,
+                        help="The sliding window corrector's window, as the aggregator uses")
+    parser.add_argument('--lag', type=int, default=3,
+                        help="Frames the HMM corrector publishes each frame after")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.INFO)
+    streams: dict[Hashable, list[tuple[int, PlayerState]]] = {}
+    truth = None
+    if args.recording:
+        for message in read_recordings(args.recording):
+            for i, state in enumerate(message.player_states, start=1):
+                key = (message.race_id, global_player_id(message.device_id, i))
+                streams.setdefault(key, []).append((message.frame_number, state))
+    else:
+        rng = random.Random(args.seed)
+        truth = {}
+        for frame_number, states in read_annotations(args.annotations):
+            for player_id, state in enumerate(states, start=1):
+                truth.setdefault(player_id, []).append(state)
+                streams.setdefault(player_id, []).append((frame_number, _misread(state, rng, args.noise)))
+
+    correctors: dict[str, Callable[[], AnomalyCorrector]] = {
+        f'window({args.window_size})': lambda: SlidingWindowAnomalyCorrector(None, args.window_size),
+        f'hmm(lag {args.lag})': lambda: HmmAnomalyCorrector(lag=args.lag),
+    }
+    for name, result in benchmark(streams, correctors, truth).items():
+        logging.info(f"{name}: {result['events_per_second']:.0f} events/s")
+        for field in _FIELDS:
+            line = f"  {field}: {result['changes'][field]} changes"
+            if truth is not None:
+                delay = result['delay'][field]
+                line += f", accuracy {result['accuracy'][field]:.3f}, delay " + (
+                    f"{delay:.1f} events" if delay is not None else 'n/a')
+            logging.info(line)
+
+
+if __name__ == "__main__":
+    main()
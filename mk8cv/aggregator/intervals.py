@@ -0,0 +1,148 @@
+import argparse
+import logging
+import sqlite3
+from typing import Any, Iterable, Optional
+
+# The race_data columns kept as intervals, with their index in a race_data row
+INTERVAL_STATS = {'lap': 3, 'position': 4, 'coins': 5, 'item_1': 6, 'item_2': 7}
+
+INSERT_INTERVAL = '''
+    INSERT OR REPLACE INTO race_intervals (race_id, player_id, stat, start_frame, end_frame, value)
+    VALUES (?, ?, ?, ?, ?, ?);
+    '''
+CLOSE_INTERVAL = '''
+    UPDATE race_intervals SET end_frame = ?
+    WHERE race_id = ? AND player_id = ? AND stat = ? AND start_frame = ?;
+    '''
+
+
+class IntervalTracker:
+    """
+    Turns the race_data rows of each player into runs of frames over which a stat kept the same value.
+
+    An interval starts at the frame its value was first seen and ends at the frame the next value started, and
+    the current interval of every stat is left open (end_frame NULL). track returns the interval inserts and
+    closes a row causes, for the caller to write in the same transaction as the row. The open intervals of a
+    player the tracker has not seen are read from conn, so the aggregator carries on where it stopped after a
+    restart; rows older than an open interval, e.g. redelivered after a restart, change nothing.
+    """
+
+    def __init__(self, conn: Optional[sqlite3.Connection] = None) -> None:
+        self.conn = conn
+        self._open: dict[tuple[int, int], dict[str, tuple[int, Any]]] = {}  # (race_id, player_id) -> stat -> (start, value)
+
+    def _load(self, race_id: int, player_id: int) -> dict[str, tuple[int, Any]]:
+        if self.conn is None:
+            return {}
+        rows = self.conn.execute(
+            '''
+            SELECT stat, start_frame, value
+            FROM race_intervals
+            WHERE race_id = ? AND player_id = ? AND end_frame IS NULL;
+            ''', (race_id, player_id)).fetchall()
+        return {stat: (start_frame, value) for stat, start_frame, value in rows}
+
+    def track(self, row: tuple) -> tuple[list[tuple], list[tuple]]:
+        """Returns the (inserts, closes) caused by a race_data row, as INSERT_INTERVAL and CLOSE_INTERVAL parameters."""
+        race_id, frame, player_id = row[:3]
+        key = (race_id, player_id)
+        current = self._open.get(key)
+        if current is None:
+            current = self._open[key] = self._load(race_id, player_id)
+
+        inserts, closes = [], []
+        for stat, index in INTERVAL_STATS.items():
+            value = row[index]
+            previous = current.get(stat)
+            if previous is not None and (previous[1] == value or frame <= previous[0]):
+                continue
+            if previous is not None:
+                closes.append((frame, race_id, player_id, stat, previous[0]))
+            inserts.append((race_id, player_id, stat, frame, None, value))
+            current[stat] = (frame, value)
+        return inserts, closes
+
+    def forget(self, race_id: int) -> None:
+        """Drops what is kept of a race that has ended; any later row of it reloads it from conn."""
+        self._open = {key: current for key, current in self._open.items() if key[0] != race_id}
+
+
+def intervals_from_race_data(conn: sqlite3.Connection, race_id: int) -> list[list]:
+    """Computes a race's intervals from its race_data rows, as INSERT_INTERVAL parameters in primary key order."""
+    tracker = IntervalTracker()
+    rows = conn.execute(
+        '''
+        SELECT *
+        FROM race_data
+        WHERE race_id = ?
+        ORDER BY player_id, timestamp;
+        ''', (race_id,)).fetchall()
+    # with every interval of a race in hand, each can be written once with its final end_frame
+    intervals: dict[tuple, list] = {}
+    for row in rows:
+        inserts, closes = tracker.track(row)
+        for insert in inserts:
+            intervals[insert[:4]] = list(insert)
+        for end_frame, *key in closes:
+            intervals[tuple(key)][4] = end_frame
+    return [intervals[key] for key in sorted(intervals)]
+
+
+def compact(conn: sqlite3.Connection, race_ids: Iterable[int] = None, prune: bool = False) -> int:
+    """
+    Rebuilds the intervals of races (every race in race_data by default) from their race_data rows, deleting
+    those rows if prune is set. Returns the number of intervals written.
+    """
+    if race_ids is None:
+        race_ids = [race_id for (race_id,) in conn.execute('SELECT DISTINCT race_id FROM race_data;')]
+    written = 0
+    for race_id in race_ids:
+        intervals = intervals_from_race_data(conn, race_id)
+        with conn:
+            conn.execute('DELETE FROM race_intervals WHERE race_id = ?;', (race_id,))
+            conn.executemany(INSERT_INTERVAL, intervals)
+            if prune:
+                conn.execute('DELETE FROM race_data WHERE race_id = ?;', (race_id,))
+        logging.info(f"Race {race_id}: race_data rows compacted into {len(intervals)} intervals")
+        written += len(intervals)
+    return written
+
+
+def query_intervals(conn: sqlite3.Connection, race_id: int, player_id: int, stat: str, start_frame: int,
+                    end_frame: int) -> list[tuple[int, Optional[int], Any]]:
+    """The (start_frame, end_frame, value) intervals of a player's stat overlapping frames start_frame to end_frame."""
+    return conn.execute(
+        '''
+        SELECT start_frame, end_frame, value
+        FROM race_intervals
+        WHERE race_id = ? AND player_id = ? AND stat = ? AND start_frame <= ?
+            AND (end_frame IS NULL OR end_frame > ?)
+        ORDER BY start_frame;
+        ''', (race_id, player_id, stat, end_frame, start_frame)).fetchall()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compact race_data rows into race_intervals")
+    parser.add_argument('--db-file', type=str, default='mk8cv.db',
+                        help='SQLite database to compact')
+    parser.add_argument('--schema-file', type=str, default='./mk8cv-db/schema.sql',
+                        help='Schema creating race_intervals in databases written before it existed')
+    parser.add_argument('--race-id', type=int, nargs='+',
+                        help='Races to compact (defaults to every race in race_data)')
+    parser.add_argument('--prune', action='store_true',
+                        help='Delete the race_data rows of compacted races; only for races that have finished')
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.INFO)
+    conn = sqlite3.connect(args.db_file)
+    try:
+        with open(args.schema_file, 'r') as f:
+            conn.executescript(f.read())
+        written = compact(conn, args.race_id, args.prune)
+        logging.info(f"Wrote {written} intervals")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
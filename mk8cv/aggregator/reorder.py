@@ -0,0 +1,212 @@
+import heapq
+import logging
+import math
+import time
+from collections import deque
+from typing import Any, Optional
+
+from mk8cv.data.state import StateMessage
+
+
+class _DeviceBuffer:
+    __slots__ = ('pending', 'last_released', 'max_seen', 'last_push', 'arrivals')
+
+    def __init__(self) -> None:
+        self.pending: list[tuple[int, int, Any, StateMessage]] = []  # min-heap of (frame_number, arrival, tag, event)
+        self.last_released: Optional[int] = None
+        self.max_seen = -1
+        self.last_push = 0.0
+        self.arrivals = 0
+
+
+class ReorderBuffer:
+    """
+    Puts each device's state messages back into frame order before they reach anomaly correction.
+
+    Frame processors pull frames off a shared queue, so a device's messages can arrive out of order. A message
+    is held until a message `lateness` frames newer has arrived from the same device (the watermark), or the
+    device has gone quiet for max_delay seconds, then released in frame order. A message arriving after a newer
+    frame was released is too late to be used: it is counted and released with event None, so the caller can
+    still ack it. Frame numbers missing from the released order are counted as gaps; frame_stride is the
+    spacing of frames when the capture skips frames (--frame-skip + 1).
+    """
+
+    def __init__(self, lateness: int = 8, max_delay: float = 0.5, frame_stride: int = 1,
+                 stats_interval: float = 10.0) -> None:
+        self.lateness = lateness
+        self.max_delay = max_delay
+        self.frame_stride = frame_stride
+        self.stats_interval = stats_interval
+        self._devices: dict[tuple[int, int], _DeviceBuffer] = {}  # (race_id, device_id) -> buffer
+        self.released = 0
+        self.reordered = 0
+        self.late = 0
+        self.gaps = 0
+        self._last_stats = time.monotonic()
+
+    def _release(self, device: _DeviceBuffer, watermark: Optional[int]) -> list[tuple[Any, Optional[StateMessage]]]:
+        released = []
+        while device.pending and (watermark is None or device.pending[0][0] <= watermark):
+            frame_number, _, tag, event = heapq.heappop(device.pending)
+            if device.last_released is not None and frame_number <= device.last_released:
+                # a duplicate of a frame already released, e.g. a redelivered stream entry
+                self.late += 1
+                released.append((tag, None))
+                continue
+            if device.last_released is not None:
+                self.gaps += max(0, (frame_number - device.last_released) // self.frame_stride - 1)
+            device.last_released = frame_number
+            self.released += 1
+            released.append((tag, event))
+        return released
+
+    def push(self, event: StateMessage, tag: Any = None) -> list[tuple[Any, Optional[StateMessage]]]:
+        """Adds a message and returns the (tag, message) pairs it lets through, in frame order."""
+        key = (event.race_id, event.device_id)
+        device = self._devices.get(key)
+        if device is None:
+            device = self._devices[key] = _DeviceBuffer()
+
+        if device.last_released is not None and event.frame_number <= device.last_released:
+            self.late += 1
+            logging.debug(f"Frame {event.frame_number} of device {event.device_id} arrived after frame "
+                          f"{device.last_released} was released, dropping it")
+            return [(tag, None)]
+
+        if event.frame_number < device.max_seen:
+            self.reordered += 1
+        # arrivals breaks ties between duplicates of a frame, which are not comparable
+        heapq.heappush(device.pending, (event.frame_number, device.arrivals, tag, event))
+        device.arrivals += 1
+        device.max_seen = max(device.max_seen, event.frame_number)
+        device.last_push = time.monotonic()
+        return self._release(device, device.max_seen - self.lateness)
+
+    def expire(self) -> list[tuple[Any, Optional[StateMessage]]]:
+        """Releases everything held for devices that have sent nothing for max_delay seconds."""
+        now = time.monotonic()
+        released = []
+        for device in self._devices.values():
+            if device.pending and now - device.last_push >= self.max_delay:
+                released.extend(self._release(device, None))
+        if now - self._last_stats >= self.stats_interval:
+            logging.info(f"Reorder buffer: released {self.released}, reordered {self.reordered}, late {self.late}, "
+                         f"gaps {self.gaps}, holding {sum(len(device.pending) for device in self._devices.values())}")
+            self._last_stats = now
+        return released
+
+    def snapshot(self) -> dict:
+        """The messages held and each device's position, for the aggregator's snapshots."""
+        return self._devices
+
+    def restore(self, devices: dict) -> None:
+        now = time.monotonic()
+        for device in devices.values():
+            # monotonic time does not carry over between processes, so quiet devices are timed from the restore
+            device.last_push = now
+        self._devices = devices
+
+    def drain(self, race_id: Optional[int] = None) -> list[tuple[Any, Optional[StateMessage]]]:
+        """Releases everything still held, at shutdown, or everything of a race that has ended, forgetting it."""
+        released = []
+        for key, device in list(self._devices.items()):
+            if race_id is None or key[0] == race_id:
+                released.extend(self._release(device, None))
+            if key[0] == race_id:
+                del self._devices[key]
+        return released
+
+
+class _RaceMerge:
+    __slots__ = ('queues', 'last_seen', 'newest', 'last_push')
+
+    def __init__(self) -> None:
+        self.queues: dict[int, deque[tuple[float, Any, StateMessage]]] = {}  # device_id -> in capture order
+        self.last_seen: dict[int, float] = {}  # device_id -> latest capture time pushed
+        self.newest = -math.inf
+        self.last_push = 0.0
+
+
+class TimelineMerger:
+    """
+    Merges the frame-ordered event streams of a race's devices, as released by ReorderBuffer, into one stream
+    in capture time order.
+
+    An event is released once every other device of its race (there must be one) has sent an event captured no
+    earlier, so nothing captured before it can still arrive, or once an event captured max_latency seconds after it has arrived from
+    any device, which bounds how long a stalled device holds the race back. Events are also released when the
+    race has been quiet for max_delay seconds (see expire). Events without a capture time, from publishers
+    that predate it, cannot be merged and pass straight through, as do the None events of late messages.
+    Events that arrive after later ones were released are still passed on, and counted.
+    """
+
+    def __init__(self, max_latency: float = 0.25, max_delay: float = 0.5) -> None:
+        self.max_latency = max_latency
+        self.max_delay = max_delay
+        self._races: dict[int, _RaceMerge] = {}
+        self._released_until: dict[int, float] = {}
+        self.merged = 0
+        self.late = 0
+
+    def _release(self, race_id: int, race: _RaceMerge, flush: bool) -> list[tuple[Any, Optional[StateMessage]]]:
+        released = []
+        while True:
+            heads = [(queue[0][0], device_id) for device_id, queue in race.queues.items() if queue]
+            if not heads:
+                return released
+            capture_time, device_id = min(heads)
+            # with one device seen so far, another may not have sent its first event yet
+            if not (flush or capture_time <= race.newest - self.max_latency
+                    or len(race.last_seen) > 1 and all(seen >= capture_time for seen in race.last_seen.values())):
+                return released
+            _, tag, event = race.queues[device_id].popleft()
+            if capture_time < self._released_until.get(race_id, -math.inf):
+                self.late += 1
+            else:
+                self._released_until[race_id] = capture_time
+            self.merged += 1
+            released.append((tag, event))
+
+    def merge(self, released: list[tuple[Any, Optional[StateMessage]]]) -> list[tuple[Any, Optional[StateMessage]]]:
+        """Adds the (tag, event) pairs released by a ReorderBuffer and returns those now merged, in order."""
+        merged = []
+        touched = {}
+        for tag, event in released:
+            if event is None or event.capture_time is None:
+                merged.append((tag, event))
+                continue
+            race = self._races.get(event.race_id)
+            if race is None:
+                race = self._races[event.race_id] = _RaceMerge()
+            race.queues.setdefault(event.device_id, deque()).append((event.capture_time, tag, event))
+            race.last_seen[event.device_id] = max(race.last_seen.get(event.device_id, -math.inf), event.capture_time)
+            race.newest = max(race.newest, event.capture_time)
+            race.last_push = time.monotonic()
+            touched[event.race_id] = race
+        for race_id, race in touched.items():
+            merged.extend(self._release(race_id, race, flush=False))
+        return merged
+
+    def expire(self) -> list[tuple[Any, Optional[StateMessage]]]:
+        """Releases everything held for races that have received nothing for max_delay seconds."""
+        now = time.monotonic()
+        return [pair for race_id, race in self._races.items() if now - race.last_push >= self.max_delay
+                for pair in self._release(race_id, race, flush=True)]
+
+    def snapshot(self) -> tuple[dict, dict]:
+        """The events held and how far each race has been released, for the aggregator's snapshots."""
+        return self._races, self._released_until
+
+    def restore(self, state: tuple[dict, dict]) -> None:
+        self._races, self._released_until = state
+        now = time.monotonic()
+        for race in self._races.values():
+            race.last_push = now
+
+    def drain(self, race_id: Optional[int] = None) -> list[tuple[Any, Optional[StateMessage]]]:
+        """Releases everything still held, at shutdown, or everything of a race that has ended, forgetting it."""
+        if race_id is not None:
+            race = self._races.pop(race_id, None)
+            self._released_until.pop(race_id, None)
+            return self._release(race_id, race, flush=True) if race is not None else []
+        return [pair for race_id, race in self._races.items() for pair in self._release(race_id, race, flush=True)]
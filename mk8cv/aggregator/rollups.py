@@ -0,0 +1,167 @@
+import argparse
+import logging
+import sqlite3
+from collections import Counter
+from typing import Any, Iterable, Optional
+
+UPSERT_LAP = '''
+    INSERT INTO race_laps (race_id, player_id, lap, start_frame, end_frame, coins_min, coins_max)
+    VALUES (?, ?, ?, ?, NULL, ?, ?)
+    ON CONFLICT (race_id, player_id, lap) DO UPDATE SET
+        coins_min = MIN(coins_min, excluded.coins_min),
+        coins_max = MAX(coins_max, excluded.coins_max);
+    '''
+CLOSE_LAP = '''
+    UPDATE race_laps SET end_frame = ?
+    WHERE race_id = ? AND player_id = ? AND lap = ?;
+    '''
+ADD_POSITION_FRAMES = '''
+    INSERT INTO race_position_time (race_id, player_id, position, frames)
+    VALUES (?, ?, ?, ?)
+    ON CONFLICT (race_id, player_id, position) DO UPDATE SET frames = frames + excluded.frames;
+    '''
+ADD_ITEM_COUNTS = '''
+    INSERT INTO race_items (race_id, player_id, item, pickups, uses)
+    VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT (race_id, player_id, item) DO UPDATE SET
+        pickups = pickups + excluded.pickups,
+        uses = uses + excluded.uses;
+    '''
+# The order updates are written in; a lap is upserted before it can be closed
+ROLLUP_STATEMENTS = (UPSERT_LAP, CLOSE_LAP, ADD_POSITION_FRAMES, ADD_ITEM_COUNTS)
+ROLLUP_TABLES = ('race_laps', 'race_position_time', 'race_items')
+
+
+def _held_items(row: tuple) -> Counter:
+    return Counter(item for item in row[6:8] if item is not None and item != 'NONE')
+
+
+class RollupTracker:
+    """
+    Turns the race_data rows of each player into updates of the rollup tables, so the aggregator can keep them
+    current as it writes rows.
+
+    race_laps gets a row per lap, started and ended by forward lap transitions, with the lowest and highest coin
+    count seen on it. race_position_time adds up the frames spent in each position up to the player's latest
+    row. race_items counts an item as picked up when a slot gains it and as used when it leaves both slots, so
+    an item moving from the second slot to the first is neither. track returns the updates a row causes, keyed
+    by statement, for the caller to write in the same transaction as the row. The previous row of a player the
+    tracker has not seen is read from conn, and rows no newer than it, e.g. redelivered after a restart, are
+    ignored.
+    """
+
+    def __init__(self, conn: Optional[sqlite3.Connection] = None) -> None:
+        self.conn = conn
+        self._last: dict[tuple[int, int], Optional[tuple]] = {}  # (race_id, player_id) -> latest row
+
+    def _load(self, race_id: int, player_id: int) -> Optional[tuple]:
+        if self.conn is None:
+            return None
+        return self.conn.execute(
+            '''
+            SELECT *
+            FROM race_data
+            WHERE race_id = ? AND player_id = ?
+            ORDER BY timestamp DESC
+            LIMIT 1;
+            ''', (race_id, player_id)).fetchone()
+
+    def track(self, row: tuple) -> dict[str, list[tuple]]:
+        race_id, frame, player_id, lap, position, coins = row[:6]
+        key = (race_id, player_id)
+        if key not in self._last:
+            self._last[key] = self._load(race_id, player_id)
+        previous = self._last[key]
+        if previous is not None and frame <= previous[1]:
+            return {}
+        self._last[key] = row
+
+        updates: dict[str, list[tuple]] = {statement: [] for statement in ROLLUP_STATEMENTS}
+        updates[UPSERT_LAP].append((race_id, player_id, lap, frame, coins, coins))
+        if previous is not None:
+            previous_frame, _, previous_lap, previous_position = previous[1:5]
+            if lap > previous_lap:
+                updates[CLOSE_LAP].append((frame, race_id, player_id, previous_lap))
+            updates[ADD_POSITION_FRAMES].append((race_id, player_id, previous_position, frame - previous_frame))
+
+        held, previously_held = _held_items(row), _held_items(previous) if previous is not None else Counter()
+        for item in held.keys() | previously_held.keys():
+            picked_up, used = (held - previously_held)[item], (previously_held - held)[item]
+            if picked_up or used:
+                updates[ADD_ITEM_COUNTS].append((race_id, player_id, item, picked_up, used))
+        return updates
+
+    def forget(self, race_id: int) -> None:
+        """Drops what is kept of a race that has ended; any later row of it reloads it from conn."""
+        self._last = {key: row for key, row in self._last.items() if key[0] != race_id}
+
+
+def write_rollups(conn: sqlite3.Connection, updates: dict[str, list[tuple]]) -> None:
+    for statement in ROLLUP_STATEMENTS:
+        if updates.get(statement):
+            conn.executemany(statement, updates[statement])
+
+
+def rebuild(conn: sqlite3.Connection, race_ids: Iterable[int] = None) -> None:
+    """Recomputes the rollups of races (every race in race_data by default) from their race_data rows."""
+    if race_ids is None:
+        race_ids = [race_id for (race_id,) in conn.execute('SELECT DISTINCT race_id FROM race_data;')]
+    for race_id in race_ids:
+        tracker = RollupTracker()
+        updates: dict[str, list[tuple]] = {statement: [] for statement in ROLLUP_STATEMENTS}
+        rows = conn.execute('SELECT * FROM race_data WHERE race_id = ? ORDER BY player_id, timestamp;', (race_id,))
+        for row in rows.fetchall():
+            for statement, params in tracker.track(row).items():
+                updates[statement].extend(params)
+        with conn:
+            for table in ROLLUP_TABLES:
+                conn.execute(f'DELETE FROM {table} WHERE race_id = ?;', (race_id,))
+            write_rollups(conn, updates)
+        logging.info(f"Rebuilt the rollups of race {race_id}")
+
+
+def read_rollups(conn: sqlite3.Connection, race_id: int, player_id: int) -> dict[str, Any]:
+    """A player's rollups, read through the tables' primary keys."""
+    laps = conn.execute(
+        '''
+        SELECT lap, start_frame, end_frame, coins_min, coins_max
+        FROM race_laps
+        WHERE race_id = ? AND player_id = ?
+        ORDER BY lap;
+        ''', (race_id, player_id)).fetchall()
+    positions = conn.execute(
+        'SELECT position, frames FROM race_position_time WHERE race_id = ? AND player_id = ?;',
+        (race_id, player_id)).fetchall()
+    items = conn.execute(
+        'SELECT item, pickups, uses FROM race_items WHERE race_id = ? AND player_id = ?;',
+        (race_id, player_id)).fetchall()
+    return {
+        'laps': [{'lap': lap, 'start_frame': start, 'end_frame': end, 'frames': end - start if end is not None else None,
+                  'coins_min': coins_min, 'coins_max': coins_max} for lap, start, end, coins_min, coins_max in laps],
+        'position_frames': dict(positions),
+        'items': {item: {'pickups': pickups, 'uses': uses} for item, pickups, uses in items},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rebuild the race rollup tables from race_data")
+    parser.add_argument('--db-file', type=str, default='mk8cv.db',
+                        help='SQLite database to rebuild the rollups of')
+    parser.add_argument('--schema-file', type=str, default='./mk8cv-db/schema.sql',
+                        help='Schema creating the rollup tables in databases written before they existed')
+    parser.add_argument('--race-id', type=int, nargs='+',
+                        help='Races to rebuild (defaults to every race in race_data)')
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.INFO)
+    conn = sqlite3.connect(args.db_file)
+    try:
+        with open(args.schema_file, 'r') as f:
+            conn.executescript(f.read())
+        rebuild(conn, args.race_id)
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
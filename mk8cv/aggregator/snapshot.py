@@ -0,0 +1,52 @@
+import logging
+import os
+import pickle
+import struct
+import zlib
+from typing import Any, Optional
+
+# Layout: magic (u8), version (u8), then a zlib-compressed pickle of the aggregator's state dict
+SNAPSHOT_MAGIC = 0xBA
+SNAPSHOT_VERSION = 3
+_HEADER = struct.Struct('<BB')
+
+
+def encode_snapshot(state: dict[str, Any]) -> bytes:
+    """Serialises aggregator state; done where the state is consistent, the write can happen elsewhere."""
+    return _HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION) + zlib.compress(
+        pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL), 1)
+
+
+def write_snapshot(path: str, data: bytes) -> None:
+    """
+    Replaces the snapshot at path atomically: the data is written and synced to a temporary file next to it,
+    which is then renamed over it, so a crash leaves either the old snapshot or the new one, never a mix.
+    """
+    temporary = f'{path}.tmp'
+    with open(temporary, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary, path)
+    directory = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(directory)
+    finally:
+        os.close(directory)
+    logging.debug(f"Wrote {len(data)} byte snapshot to {path}")
+
+
+def read_snapshot(path: str) -> Optional[dict[str, Any]]:
+    """The state in the snapshot at path, or None if there is none or it cannot be read (the aggregator starts cold)."""
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        data = f.read()
+    try:
+        magic, version = _HEADER.unpack_from(data)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            raise ValueError(f"not a version {SNAPSHOT_VERSION} snapshot")
+        return pickle.loads(zlib.decompress(data[_HEADER.size:]))
+    except Exception as e:
+        logging.warning(f"Ignoring unreadable snapshot {path}: {e}")
+        return None
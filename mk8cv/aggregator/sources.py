@@ -0,0 +1,255 @@
+from abc import ABC, abstractmethod
+from enum import Enum
+import logging
+import os
+import queue
+import socket
+import time
+from multiprocessing import Queue
+from typing import Any, Optional
+
+import redis
+
+from mk8cv.data.state import StateMessage
+from mk8cv.sinks.ipc import DEFAULT_SOCKET_PATH, MAX_DATAGRAM, SHM_RING_NAME, SHM_RING_SIZE, ShmRing, shm_ring_name, \
+    unpack_records
+from mk8cv.sinks.sink import stream_key
+
+
+class SourceType(str, Enum):
+    PUBSUB = 'pubsub'
+    STREAM = 'stream'
+    UNIX_SOCKET = 'unix'
+    SHARED_MEMORY = 'shm'
+    QUEUE = 'queue'
+
+
+class EventSource(ABC):
+    """Where an aggregator reads encoded state messages from."""
+
+    # Set once a source knows no more messages will arrive
+    finished = False
+
+    @abstractmethod
+    def read(self, timeout: float) -> list[tuple[Any, bytes]]:
+        """Waits up to timeout seconds for messages, returned as (id, data) pairs in the order they were published."""
+        pass
+
+    def ack(self, ids: list[Any]) -> None:
+        """Marks messages as processed, so they are not delivered again after a restart."""
+        pass
+
+    def offset(self, message_id: Any) -> Optional[tuple[str, Any]]:
+        """The (partition, position) a message was read at, for sources that re-deliver after a restart."""
+        return None
+
+    def seek(self, offsets: dict[str, Any]) -> None:
+        """Skips messages at or before the partitions' positions, which a restored snapshot already covers."""
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+class PubSubSource(EventSource):
+    """Fire-and-forget Redis pub/sub. Messages published while the aggregator is not listening are lost."""
+
+    def __init__(self, redis_client: redis.Redis, channel: str) -> None:
+        self.pubsub = redis_client.pubsub()
+        self.pubsub.subscribe(channel)
+
+    def read(self, timeout: float) -> list[tuple[Any, bytes]]:
+        message = self.pubsub.get_message(timeout=timeout)
+        if message and message['type'] == 'message':
+            return [(None, message['data'])]
+        return []
+
+    def close(self) -> None:
+        self.pubsub.unsubscribe()
+        self.pubsub.close()
+
+
+def _entry_position(entry_id: bytes | str) -> tuple[int, int]:
+    """A stream entry id, <milliseconds>-<sequence>, as a tuple that orders like the stream."""
+    entry_id = entry_id.decode() if isinstance(entry_id, bytes) else entry_id
+    milliseconds, sequence = entry_id.split('-')
+    return int(milliseconds), int(sequence)
+
+
+class StreamSource(EventSource):
+    """
+    Reads the partitions of a Redis stream written by publish_to_redis_stream through a consumer group.
+
+    Entries stay pending in the group until acked, and a consumer re-reads its own pending entries when it starts,
+    so an aggregator that restarts under the same consumer name resumes where it stopped. Aggregators share the load
+    by consuming disjoint sets of partitions; a partition should have one consumer at a time, since a device's delta
+    messages and its anomaly correction history must all be handled by the same aggregator. After seek, entries
+    up to the given positions are acked without being returned.
+    """
+
+    def __init__(self, redis_client: redis.Redis, stream: str, partitions: list[int], group: str = 'aggregators',
+                 consumer: str = None, batch_size: int = 256) -> None:
+        self.redis_client = redis_client
+        self.group = group
+        self.consumer = consumer or f'{socket.gethostname()}-{os.getpid()}'
+        self.batch_size = batch_size
+        self.keys = [stream_key(stream, partition) for partition in partitions]
+        for key in self.keys:
+            try:
+                # start from the oldest retained entry so nothing published before the group existed is skipped
+                self.redis_client.xgroup_create(key, group, id='0', mkstream=True)
+            except redis.exceptions.ResponseError as e:
+                if 'BUSYGROUP' not in str(e):
+                    raise
+        # '0' re-delivers this consumer's pending entries; once they are drained switch to new entries ('>')
+        self._cursors = {key: '0' for key in self.keys}
+        self._skip_until: dict[str, tuple[int, int]] = {}
+        logging.info(f"Consuming {self.keys} as {self.consumer} in group {group}")
+
+    def read(self, timeout: float) -> list[tuple[Any, bytes]]:
+        response = None
+        pending = {key: cursor for key, cursor in self._cursors.items() if cursor != '>'}
+        if pending:
+            response = self.redis_client.xreadgroup(self.group, self.consumer, pending, count=self.batch_size)
+            drained = set(pending)
+            for key, entries in response or []:
+                key = key.decode() if isinstance(key, bytes) else key
+                if entries:
+                    self._cursors[key] = entries[-1][0]
+                    drained.discard(key)
+            for key in drained:
+                self._cursors[key] = '>'
+        # once nothing is pending, wait for new entries rather than returning an empty batch
+        if not any(entries for _, entries in response or []):
+            response = self.redis_client.xreadgroup(self.group, self.consumer, self._cursors,
+                                                    count=self.batch_size, block=max(1, int(timeout * 1000)))
+
+        messages = []
+        for key, entries in response or []:
+            key = key.decode() if isinstance(key, bytes) else key
+            skip_until = self._skip_until.get(key)
+            for entry_id, fields in entries:
+                # a pending entry trimmed from the stream by XADD MAXLEN comes back without its fields, and one
+                # the snapshot covers was processed, or is held in the restored buffers, before the restart
+                if fields and (skip_until is None or _entry_position(entry_id) > skip_until):
+                    messages.append(((key, entry_id), fields[b'data'] if b'data' in fields else fields['data']))
+                else:
+                    self.redis_client.xack(key, self.group, entry_id)
+        return messages
+
+    def offset(self, message_id: Any) -> Optional[tuple[str, Any]]:
+        key, entry_id = message_id
+        return key, entry_id.decode() if isinstance(entry_id, bytes) else entry_id
+
+    def seek(self, offsets: dict[str, Any]) -> None:
+        self._skip_until = {key: _entry_position(entry_id) for key, entry_id in offsets.items() if key in self.keys}
+
+    def ack(self, ids: list[Any]) -> None:
+        by_key: dict[str, list] = {}
+        for key, entry_id in ids:
+            by_key.setdefault(key, []).append(entry_id)
+        with self.redis_client.pipeline(transaction=False) as pipe:
+            for key, entry_ids in by_key.items():
+                pipe.xack(key, self.group, *entry_ids)
+            pipe.execute()
+
+
+class UnixSocketSource(EventSource):
+    """Receives the datagrams sent by unix_socket_writer. Nothing is buffered while the aggregator is down."""
+
+    def __init__(self, path: str = DEFAULT_SOCKET_PATH) -> None:
+        self.path = path
+        if os.path.exists(path):
+            os.remove(path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(path)
+        # a large receive buffer absorbs bursts without blocking the frame processors
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 22)
+        logging.info(f"Receiving on {path}")
+
+    def _receive(self) -> bytes:
+        """The next datagram, or nothing if it was too large to read whole, since its last record would be cut off."""
+        data, _, flags, _ = self.sock.recvmsg(MAX_DATAGRAM)
+        if flags & socket.MSG_TRUNC:
+            logging.error(f"Dropped a datagram larger than {MAX_DATAGRAM} bytes on {self.path}")
+            return b''
+        return data
+
+    def read(self, timeout: float) -> list[tuple[Any, bytes]]:
+        self.sock.settimeout(timeout)
+        try:
+            data = self._receive()
+        except socket.timeout:
+            return []
+        # drain whatever else has already arrived without waiting again
+        self.sock.setblocking(False)
+        try:
+            while True:
+                data += self._receive()
+        except BlockingIOError:
+            pass
+        return [(None, record) for record in unpack_records(data)]
+
+    def close(self) -> None:
+        self.sock.close()
+        os.remove(self.path)
+
+
+class ShmRingSource(EventSource):
+    """
+    Polls the shared memory rings written by shm_ring_writer, one per frame processor, creating any that do not
+    exist yet.
+
+    The rings are polled without sleeping for spin_seconds after the last record arrived, so a steady stream is
+    picked up within microseconds, and with short sleeps after that so an idle aggregator does not burn a core.
+    """
+
+    def __init__(self, name: str = SHM_RING_NAME, rings: int = 2, size: int = SHM_RING_SIZE,
+                 batch_size: int = 256, spin_seconds: float = 0.05) -> None:
+        self.rings = [ShmRing(shm_ring_name(name, ring), size, create=True) for ring in range(rings)]
+        self.batch_size = batch_size
+        self.spin_seconds = spin_seconds
+        self._last_record = time.monotonic()
+        logging.info(f"Polling shared memory rings {[ring.name for ring in self.rings]}")
+
+    def read(self, timeout: float) -> list[tuple[Any, bytes]]:
+        deadline = time.monotonic() + timeout
+        while True:
+            records = [record for ring in self.rings for record in ring.read(self.batch_size)]
+            now = time.monotonic()
+            if records:
+                self._last_record = now
+                return [(None, record) for record in records]
+            if now >= deadline:
+                return []
+            if now - self._last_record > self.spin_seconds:
+                time.sleep(0.001)
+
+    def close(self) -> None:
+        for ring in self.rings:
+            ring.close()
+
+
+class QueueSource(EventSource):
+    """
+    Receives batches of decoded state messages from frame processors in the same program, for the embedded
+    aggregator of the SQLITE sink. A None in the queue marks the end of the messages.
+    """
+
+    def __init__(self, state_queue: Queue) -> None:
+        self.state_queue = state_queue
+
+    def read(self, timeout: float) -> list[tuple[Any, StateMessage]]:
+        try:
+            batches = [self.state_queue.get(timeout=timeout)]
+            while True:
+                batches.append(self.state_queue.get_nowait())
+        except queue.Empty:
+            pass
+        messages = []
+        for batch in batches:
+            if batch is None:
+                self.finished = True
+                break
+            messages.extend((None, message) for message in batch)
+        return messages
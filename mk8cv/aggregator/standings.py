@@ -0,0 +1,164 @@
+import json
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+from urllib.parse import parse_qs, urlparse
+
+from mk8cv.data.state import PlayerState
+
+
+class Standings:
+    """
+    The latest corrected state of every player, per race, kept in memory for the standings server.
+
+    Each race has a version that goes up with every update. Snapshots are encoded once per version, however many
+    clients read them, and wait blocks until a race moves past a version a client has already seen. A race is
+    forgotten once it has ended, and reads as empty from then on.
+    """
+
+    def __init__(self) -> None:
+        self._players: dict[int, dict[int, dict]] = {}  # race_id -> player_id -> state
+        self._versions: dict[int, int] = {}
+        self._encoded: dict[int, tuple[int, bytes]] = {}  # race_id -> (version, snapshot)
+        self._condition = threading.Condition()
+        self.latest_race: Optional[int] = None
+
+    def update(self, race_id: int, frame_number: int, player_id: int, state: PlayerState) -> None:
+        with self._condition:
+            players = self._players.setdefault(race_id, {})
+            current = players.get(player_id)
+            if current is not None and current['frame'] > frame_number:
+                return
+            players[player_id] = {
+                'player_id': player_id,
+                'frame': frame_number,
+                'lap': state.lap,
+                'position': state.position,
+                'coins': state.coins,
+                'item_1': state.item1.name,
+                'item_2': state.item2.name,
+            }
+            self._versions[race_id] = self._versions.get(race_id, 0) + 1
+            self.latest_race = race_id
+            self._condition.notify_all()
+
+    def snapshot(self, race_id: int) -> tuple[int, bytes]:
+        """The race's version and its standings as JSON, players in position order."""
+        with self._condition:
+            version = self._versions.get(race_id, 0)
+            encoded = self._encoded.get(race_id)
+            if encoded is None or encoded[0] != version:
+                players = sorted(self._players.get(race_id, {}).values(), key=lambda player: player['position'])
+                encoded = (version, json.dumps({'race_id': race_id, 'version': version, 'players': players}).encode())
+                # only cached for races being updated, so asking after other races keeps nothing
+                if race_id in self._versions:
+                    self._encoded[race_id] = encoded
+            return encoded
+
+    def end_race(self, race_id: int) -> None:
+        """Forgets a race that has ended, waking its streams so they send it as empty."""
+        with self._condition:
+            self._players.pop(race_id, None)
+            self._versions.pop(race_id, None)
+            self._encoded.pop(race_id, None)
+            self._condition.notify_all()
+
+    def wait(self, race_id: int, version: int, timeout: float) -> bool:
+        """Waits up to timeout seconds for the race to move past version, returning whether it did."""
+        with self._condition:
+            return self._condition.wait_for(lambda: self._versions.get(race_id, 0) != version, timeout)
+
+
+class _StandingsHandler(BaseHTTPRequestHandler):
+    server: 'StandingsServer'
+
+    def log_message(self, format, *args):
+        logging.debug(f"Standings server: {format % args}")
+
+    def _race_id(self, query: dict[str, list[str]]) -> Optional[int]:
+        if 'race_id' in query:
+            return int(query['race_id'][0])
+        return self.server.standings.latest_race
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        try:
+            race_id = self._race_id(query)
+            max_rate = min(float(query.get('max_rate', [self.server.max_rate])[0]), self.server.max_rate)
+            if max_rate <= 0:
+                raise ValueError
+        except ValueError:
+            self.send_error(400, 'race_id must be an integer and max_rate a positive number')
+            return
+        match url.path:
+            case '/standings':
+                _, body = self.server.standings.snapshot(race_id)
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.send_header('Access-Control-Allow-Origin', '*')
+                self.end_headers()
+                self.wfile.write(body)
+            case '/standings/stream':
+                self._stream(race_id, max_rate)
+            case _:
+                self.send_error(404)
+
+    def _stream(self, race_id: Optional[int], max_rate: float) -> None:
+        """Server-sent events of the race's standings, at most max_rate a second; updates in between are coalesced."""
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+        standings = self.server.standings
+        version = None
+        try:
+            while not self.server.closing:
+                # follow whichever race is running unless the client asked for one
+                race = race_id if race_id is not None else standings.latest_race
+                if version is not None and not standings.wait(race, version, self.server.keepalive):
+                    self.wfile.write(b': keepalive\n\n')
+                    self.wfile.flush()
+                    continue
+                sent = time.monotonic()
+                version, body = standings.snapshot(race)
+                self.wfile.write(b'event: standings\ndata: ' + body + b'\n\n')
+                self.wfile.flush()
+                time.sleep(max(0.0, 1 / max_rate - (time.monotonic() - sent)))
+        except (BrokenPipeError, ConnectionResetError):
+            logging.debug("Standings client disconnected")
+
+
+class StandingsServer(ThreadingHTTPServer):
+    """
+    Serves Standings over HTTP on its own threads, so browsers read the latest state without touching SQLite.
+
+    GET /standings returns a race's standings (race_id, by default the race updated last) as JSON, and
+    GET /standings/stream sends them as server-sent events whenever they change, at most max_rate times a second
+    per client (a client may ask for less with max_rate).
+    """
+
+    daemon_threads = True
+
+    def __init__(self, standings: Standings, host: str = 'localhost', port: int = 8081, max_rate: float = 4.0,
+                 keepalive: float = 15.0) -> None:
+        super().__init__((host, port), _StandingsHandler)
+        self.standings = standings
+        self.max_rate = max_rate
+        self.keepalive = keepalive
+        self.closing = False
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self.serve_forever, name='standings-server', daemon=True)
+        self._thread.start()
+        logging.info(f"Serving standings on http://{self.server_address[0]}:{self.server_address[1]}/standings")
+
+    def close(self) -> None:
+        self.closing = True
+        self.shutdown()
+        self.server_close()
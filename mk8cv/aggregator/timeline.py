@@ -0,0 +1,142 @@
+import argparse
+import json
+import logging
+import os
+import sqlite3
+from typing import Any, Optional
+
+from mk8cv.aggregator.intervals import INTERVAL_STATS, intervals_from_race_data
+
+# Each level of detail is this many times coarser than the one before
+LEVEL_FACTOR = 4
+# Levels are added until one has at most this many buckets across the race
+MAX_BUCKETS = 512
+
+
+def downsample(intervals: list[tuple[int, Optional[int], Any]], end_frame: int,
+               resolution: int) -> list[tuple[int, Any]]:
+    """
+    Downsamples a stat's (start_frame, end_frame, value) intervals, in order, to buckets of resolution frames.
+
+    Each bucket takes the value held for most of it, the earliest on a tie, and runs of buckets with the same
+    value are merged. Returns the (start_frame, value) runs; a run lasts until the next one starts.
+    """
+    if resolution == 1:
+        return [(start, value) for start, _, value in intervals]
+    runs: list[tuple[int, Any]] = []
+    bucket, coverage = None, {}
+
+    def close() -> None:
+        value = max(coverage, key=coverage.get)
+        if not runs or runs[-1][1] != value:
+            runs.append((bucket * resolution, value))
+
+    for start, end, value in intervals:
+        end = end if end is not None else end_frame
+        position = start
+        while position < end:
+            if position // resolution != bucket:
+                if bucket is not None:
+                    close()
+                bucket, coverage = position // resolution, {}
+            upto = min(end, (bucket + 1) * resolution)
+            coverage[value] = coverage.get(value, 0) + upto - position
+            position = upto
+    if bucket is not None:
+        close()
+    return runs
+
+
+def _columns(runs: list[tuple[int, Any]]) -> dict[str, list]:
+    return {'start': [start for start, _ in runs], 'value': [value for _, value in runs]}
+
+
+def export_race(conn: sqlite3.Connection, race_id: int, out_dir: str, max_buckets: int = MAX_BUCKETS) -> dict:
+    """
+    Writes a race's timeline as level-of-detail JSON files under out_dir/<race_id>/, returning the manifest.
+
+    index.json lists the players, the race's frame range and the levels; lod<resolution>.json holds every
+    player's lap, position, coins and item runs downsampled to buckets of resolution frames, as columns of run
+    start frames and values. Level 1 is full resolution, and each further level is LEVEL_FACTOR times coarser,
+    down to one with at most max_buckets buckets, so a page only fetches the level its zoom needs.
+    Intervals are read from race_intervals, or computed from race_data for races recorded before it existed.
+    """
+    rows = conn.execute(
+        '''
+        SELECT player_id, stat, start_frame, end_frame, value
+        FROM race_intervals
+        WHERE race_id = ?
+        ORDER BY player_id, stat, start_frame;
+        ''', (race_id,)).fetchall()
+    if not rows:
+        rows = [(player_id, stat, start, end, value)
+                for _, player_id, stat, start, end, value in intervals_from_race_data(conn, race_id)]
+    if not rows:
+        raise ValueError(f"Race {race_id} has no race data")
+
+    start_frame = min(start for _, _, start, _, _ in rows)
+    # intervals only say when values changed, and race_standings when each player was last seen
+    (last_frame,) = conn.execute('SELECT MAX(frame) FROM race_standings WHERE race_id = ?;', (race_id,)).fetchone()
+    end_frame = max(last_frame or 0, *(max(start, end or 0) for _, _, start, end, _ in rows)) + 1
+    intervals: dict[int, dict[str, list]] = {}
+    for player_id, stat, start, end, value in rows:
+        intervals.setdefault(player_id, {}).setdefault(stat, []).append((start, end, value))
+
+    names = dict(conn.execute('SELECT player_id, player_name FROM racer_metadata;').fetchall())
+    race_dir = os.path.join(out_dir, str(race_id))
+    os.makedirs(race_dir, exist_ok=True)
+    levels = []
+    resolution = 1
+    while True:
+        level = {
+            'race_id': race_id,
+            'resolution': resolution,
+            'players': {str(player_id): {stat: _columns(downsample(stats[stat], end_frame, resolution))
+                                         for stat in INTERVAL_STATS if stat in stats}
+                        for player_id, stats in intervals.items()},
+        }
+        file = f'lod{resolution}.json'
+        with open(os.path.join(race_dir, file), 'w') as f:
+            json.dump(level, f, separators=(',', ':'))
+        levels.append({'resolution': resolution, 'file': file, 'bytes': os.path.getsize(os.path.join(race_dir, file))})
+        if (end_frame - start_frame) / resolution <= max_buckets:
+            break
+        resolution *= LEVEL_FACTOR
+
+    manifest = {
+        'race_id': race_id,
+        'start_frame': start_frame,
+        'end_frame': end_frame,
+        'players': [{'player_id': player_id, 'player_name': names.get(player_id)} for player_id in intervals],
+        'levels': levels,
+    }
+    with open(os.path.join(race_dir, 'index.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    sizes = ', '.join(f"{level['file']} ({level['bytes']} bytes)" for level in levels)
+    logging.info(f"Exported race {race_id} to {race_dir}: {sizes}")
+    return manifest
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export finished races as downsampled timelines for the static viewer")
+    parser.add_argument('--db-file', type=str, default='mk8cv.db',
+                        help='SQLite database to read races from')
+    parser.add_argument('--race-id', type=int, nargs='+', required=True,
+                        help='Races to export')
+    parser.add_argument('--out-dir', type=str, default='races',
+                        help='Directory the races are written under, one directory per race')
+    parser.add_argument('--max-buckets', type=int, default=MAX_BUCKETS,
+                        help='Buckets across the race at the coarsest level of detail')
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.INFO)
+    conn = sqlite3.connect(args.db_file)
+    try:
+        for race_id in args.race_id:
+            export_race(conn, race_id, args.out_dir, args.max_buckets)
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -15,8 +15,18 @@ def capture_and_process(
         frame_skip: int,
         process_queue: Queue,
         stop_event: Event,
-        fps: Optional[float] = None
+        fps: Optional[float] = None,
+        epoch: Optional[float] = None
 ) -> None:
+    """
+    Reads frames from a capture device or video file, queueing every (frame_skip + 1)-th one for processing
+    with its frame count and capture time.
+
+    Capture times are seconds on the system's wall clock, so frames from different devices can be aligned. A
+    device's frames are stamped as they are read, from the monotonic clock offset to wall-clock time once, so
+    they never go backwards. A video file's frames are stamped with their presentation time after epoch, which
+    every capture process is given the same value of, so files started together line up.
+    """
     logging.getLogger().setLevel(logging.INFO)
     logging.info(f"Starting capture process for device {device_id}...")
 
@@ -32,6 +42,9 @@ def capture_and_process(
         return
 
     frame_time = None
+    clock_offset = time.time() - time.monotonic()
+    epoch = time.time() if epoch is None else epoch
+    file_fps = cap.get(cv2.CAP_PROP_FPS) or fps or 60.0
 
     if isinstance(source, int):  # Real device
         cap.set(cv2.CAP_PROP_FRAME_WIDTH, 1920)
@@ -59,12 +72,19 @@ def capture_and_process(
         if frame_count % (frame_skip + 1) != 0:
             continue
 
+        if isinstance(source, int):
+            capture_time = clock_offset + time.monotonic()
+        else:
+            # not every container has timestamps, so fall back on the frame rate
+            pts = cap.get(cv2.CAP_PROP_POS_MSEC) / 1000
+            capture_time = epoch + (pts if pts > 0 or frame_count == 1 else (frame_count - 1) / file_fps)
+
         # Downscale to specified resolution
         downscaled = cv2.resize(frame, downscale_resolution)
 
         # Try to put the frame in the queue, if it's full, skip this frame
         try:
-            process_queue.put((device_id, frame_count, downscaled), block=False)
+            process_queue.put((device_id, frame_count, capture_time, downscaled), block=False)
             frames_processed += 1
 
             # Calculate and log FPS every second
@@ -0,0 +1,295 @@
+import json
+import logging
+import math
+import random
+import struct
+import time
+from enum import Enum
+from typing import Optional
+
+from mk8cv.data.state import Item, PlayerState, StateDecoder, StateEncoder, StateMessage
+
+
+class Codec(str, Enum):
+    JSON = 'json'
+    BINARY = 'binary'
+    # Stateful, see DeltaEncoder
+    DELTA = 'delta'
+
+
+# Binary layout, little-endian:
+#   header:     magic (u8), version (u8), race_id (i32), device_id (u16), frame_number (i64), player count (u8)
+#   version 2:  capture_time (f64, NaN if unknown)
+#   per player: position (i8), lap (i8), race_laps (i8), item1 (u8), item2 (u8), coins (i8)
+# Unextracted stats (-1 or None) are sent as -1 and unknown items as 0. JSON messages always start with '{',
+# so the magic byte is enough to tell the two codecs apart on the wire. Version 1 messages, without a capture
+# time, are still decoded, so older recordings replay.
+BINARY_MAGIC = 0xB8
+BINARY_VERSION = 2
+_HEADER = struct.Struct('<BBiHqB')
+_CAPTURE_TIME = struct.Struct('<d')
+_PLAYER = struct.Struct('<bbbBBb')
+
+
+def _stat(value: Optional[int]) -> int:
+    return -1 if value is None else int(value)
+
+
+def _player_fields(state: PlayerState) -> tuple[int, int, int, int, int, int]:
+    """A player's state as the values packed by _PLAYER."""
+    return (_stat(state.position), _stat(state.lap), _stat(state.race_laps),
+            state.item1.value if state.item1 is not None else 0,
+            state.item2.value if state.item2 is not None else 0,
+            _stat(state.coins))
+
+
+def _player_state(fields: tuple[int, ...]) -> PlayerState:
+    position, lap, race_laps, item1, item2, coins = fields
+    return PlayerState(position, Item(item1) if item1 else None, Item(item2) if item2 else None, coins, lap, race_laps)
+
+
+def _pack_time(capture_time: Optional[float]) -> float:
+    return math.nan if capture_time is None else capture_time
+
+
+def _unpack_time(value: float) -> Optional[float]:
+    return None if math.isnan(value) else value
+
+
+def _encode_binary(message: StateMessage) -> bytes:
+    parts = [_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, message.race_id, message.device_id, message.frame_number,
+                          len(message.player_states)),
+             _CAPTURE_TIME.pack(_pack_time(message.capture_time))]
+    for state in message.player_states:
+        parts.append(_PLAYER.pack(*_player_fields(state)))
+    return b''.join(parts)
+
+
+def _decode_binary(data: bytes) -> StateMessage:
+    magic, version, race_id, device_id, frame_number, num_players = _HEADER.unpack_from(data)
+    offset = _HEADER.size
+    capture_time = None
+    if version == BINARY_VERSION:
+        capture_time = _unpack_time(_CAPTURE_TIME.unpack_from(data, offset)[0])
+        offset += _CAPTURE_TIME.size
+    elif version != 1:
+        raise ValueError(f"Unsupported binary StateMessage version {version}, expected {BINARY_VERSION}")
+
+    player_states = [_player_state(fields) for fields in _PLAYER.iter_unpack(data[offset:])]
+    if len(player_states) != num_players:
+        raise ValueError(f"Binary StateMessage declares {num_players} players but carries {len(player_states)}")
+    return StateMessage(device_id, frame_number, race_id, *player_states, capture_time=capture_time)
+
+
+def encode_state_message(message: StateMessage, codec: Codec = Codec.BINARY) -> bytes:
+    if codec == Codec.JSON:
+        return json.dumps(message, cls=StateEncoder).encode()
+    if codec == Codec.DELTA:
+        raise ValueError("Delta encoding depends on the previous messages, use a DeltaEncoder")
+    return _encode_binary(message)
+
+
+def decode_state_message(data: bytes | str) -> StateMessage:
+    """Decodes a JSON or binary message, telling them apart by the first byte. Delta messages need a DeltaDecoder."""
+    if isinstance(data, str):
+        data = data.encode()
+    if data[:1] == b'{':
+        return json.loads(data, cls=StateDecoder)
+    if data[:1] == bytes([DELTA_MAGIC]):
+        raise ValueError("Delta messages depend on the previous messages of their stream, use a DeltaDecoder")
+    if data[:1] != bytes([BINARY_MAGIC]):
+        raise ValueError(f"Unrecognised StateMessage encoding (first byte {data[:1]!r})")
+    return _decode_binary(data)
+
+
+# Delta layout, little-endian. Every message starts with
+#   magic (u8), kind (u8), stream_id (u32), device_id (u16), sequence number (u16)
+# A keyframe follows it with a complete binary message body:
+#   race_id (i32), frame_number (i64), player count (u8), capture_time (f64, NaN if unknown),
+#   then every player as in _PLAYER
+# A delta follows it with
+#   frames since the stream's previous message (u16), microseconds of capture time since it (u32),
+#   changed players bitmask (u8)
+#   and for each changed player, a changed fields bitmask (u8) then each changed field as in _PLAYER
+# so a frame where nothing changed costs 17 bytes. The stream id tells apart the frame processors publishing the
+# same device, and a gap in the sequence numbers makes the decoder wait for that stream's next keyframe.
+DELTA_MAGIC = 0xB9
+_KEYFRAME = 0
+_DELTA = 1
+_DELTA_HEADER = struct.Struct('<BBIHH')
+_KEYFRAME_BODY = struct.Struct('<iqBd')
+_DELTA_BODY = struct.Struct('<HIB')
+_FIELDS = [struct.Struct('<' + field) for field in _PLAYER.format.lstrip('<')]
+_MAX_FRAME_GAP = 0xFFFF
+_MAX_TIME_GAP = 0xFFFFFFFF
+
+
+class _StreamState:
+    __slots__ = ('sequence', 'race_id', 'frame_number', 'fields', 'capture_time', 'keyframe_frame', 'keyframe_time')
+
+    def __init__(self, sequence: int, race_id: int, frame_number: int, fields: list[tuple[int, ...]],
+                 capture_time: Optional[float]) -> None:
+        self.sequence = sequence
+        self.race_id = race_id
+        self.frame_number = frame_number
+        self.fields = fields
+        # as the decoder reconstructs it, so the encoder's time deltas never drift from the decoder's
+        self.capture_time = capture_time
+        self.keyframe_frame = frame_number
+        self.keyframe_time = time.monotonic()
+
+
+def _time_gap(previous: _StreamState, message: StateMessage) -> Optional[int]:
+    """Microseconds of capture time since the stream's previous message, or None if a delta cannot carry it."""
+    if previous.capture_time is None or message.capture_time is None:
+        return 0 if previous.capture_time is None and message.capture_time is None else None
+    gap = round((message.capture_time - previous.capture_time) * 1_000_000)
+    return gap if 0 <= gap <= _MAX_TIME_GAP else None
+
+
+class DeltaEncoder:
+    """
+    Encodes each device's state messages as the fields that changed since its previous message.
+
+    A full keyframe is sent for a device's first message, every keyframe_interval frames or keyframe_seconds
+    seconds after the last one, and whenever the race or the number of players changes, so a decoder that
+    joins late or misses a message catches up within one interval.
+    """
+
+    def __init__(self, keyframe_interval: int = 120, keyframe_seconds: float = 2.0,
+                 stream_id: Optional[int] = None) -> None:
+        self.keyframe_interval = keyframe_interval
+        self.keyframe_seconds = keyframe_seconds
+        self.stream_id = random.getrandbits(32) if stream_id is None else stream_id
+        self._devices: dict[int, _StreamState] = {}
+
+    def _needs_keyframe(self, previous: Optional[_StreamState], message: StateMessage) -> bool:
+        return (previous is None
+                or previous.race_id != message.race_id
+                or len(previous.fields) != len(message.player_states)
+                or not 0 <= message.frame_number - previous.frame_number <= _MAX_FRAME_GAP
+                or _time_gap(previous, message) is None
+                or message.frame_number - previous.keyframe_frame >= self.keyframe_interval
+                or time.monotonic() - previous.keyframe_time >= self.keyframe_seconds)
+
+    def encode(self, message: StateMessage) -> bytes:
+        previous = self._devices.get(message.device_id)
+        sequence = (previous.sequence + 1) & 0xFFFF if previous is not None else 0
+        fields = [_player_fields(state) for state in message.player_states]
+        header = _DELTA_HEADER.pack(DELTA_MAGIC, _KEYFRAME, self.stream_id, message.device_id, sequence)
+
+        if self._needs_keyframe(previous, message):
+            self._devices[message.device_id] = _StreamState(sequence, message.race_id, message.frame_number, fields,
+                                                            message.capture_time)
+            return b''.join([header, _KEYFRAME_BODY.pack(message.race_id, message.frame_number, len(fields),
+                                                         _pack_time(message.capture_time)),
+                             *(_PLAYER.pack(*player_fields) for player_fields in fields)])
+
+        changed_players = 0
+        parts = []
+        for i, (old, new) in enumerate(zip(previous.fields, fields)):
+            if old == new:
+                continue
+            changed_players |= 1 << i
+            changed_fields = 0
+            values = []
+            for j, (field, old_value, new_value) in enumerate(zip(_FIELDS, old, new)):
+                if old_value != new_value:
+                    changed_fields |= 1 << j
+                    values.append(field.pack(new_value))
+            parts.append(bytes([changed_fields]))
+            parts.extend(values)
+
+        frame_gap = message.frame_number - previous.frame_number
+        time_gap = _time_gap(previous, message)
+        previous.sequence = sequence
+        previous.frame_number = message.frame_number
+        previous.fields = fields
+        if previous.capture_time is not None:
+            previous.capture_time += time_gap / 1_000_000
+        header = _DELTA_HEADER.pack(DELTA_MAGIC, _DELTA, self.stream_id, message.device_id, sequence)
+        return b''.join([header, _DELTA_BODY.pack(frame_gap, time_gap, changed_players), *parts])
+
+
+class BatchEncoder:
+    """
+    Encodes a BackgroundSink writer's batches of messages, remembering the last one.
+
+    BackgroundSink retries a failed batch as is, and re-encoding it would advance a DeltaEncoder past messages
+    that were never delivered.
+    """
+
+    def __init__(self, codec: Codec, delta_encoder: DeltaEncoder = None) -> None:
+        self.codec = codec
+        self.delta_encoder = delta_encoder
+        self._batch = None
+        self._records = None
+
+    def encode(self, batch: list[StateMessage]) -> list[bytes]:
+        if batch is not self._batch:
+            if self.codec == Codec.DELTA:
+                self._records = [self.delta_encoder.encode(message) for message in batch]
+            else:
+                self._records = [encode_state_message(message, self.codec) for message in batch]
+            self._batch = batch
+        return self._records
+
+
+class DeltaDecoder:
+    """
+    Rebuilds full state messages from the streams of one or more DeltaEncoders.
+
+    JSON and binary messages are passed through decode_state_message, so a consumer can use one decoder whatever
+    codec its publishers use. Every message gets PlayerStates of its own, so consumers may change them.
+    """
+
+    def __init__(self) -> None:
+        self._streams: dict[tuple[int, int], _StreamState] = {}
+
+    def decode(self, data: bytes | str) -> Optional[StateMessage]:
+        """The full state message, or None if it is a delta on a stream that is waiting for its next keyframe."""
+        if isinstance(data, str) or data[:1] != bytes([DELTA_MAGIC]):
+            return decode_state_message(data)
+
+        _, kind, stream_id, device_id, sequence = _DELTA_HEADER.unpack_from(data)
+        key = (stream_id, device_id)
+        offset = _DELTA_HEADER.size
+
+        if kind == _KEYFRAME:
+            race_id, frame_number, num_players, capture_time = _KEYFRAME_BODY.unpack_from(data, offset)
+            offset += _KEYFRAME_BODY.size
+            fields = [_PLAYER.unpack_from(data, offset + i * _PLAYER.size) for i in range(num_players)]
+            stream = _StreamState(sequence, race_id, frame_number, fields, _unpack_time(capture_time))
+            self._streams[key] = stream
+            return StateMessage(device_id, frame_number, race_id, *map(_player_state, fields),
+                                capture_time=stream.capture_time)
+        if kind != _DELTA:
+            raise ValueError(f"Unrecognised delta message kind {kind}")
+
+        stream = self._streams.get(key)
+        if stream is None or sequence != (stream.sequence + 1) & 0xFFFF:
+            if stream is not None:
+                logging.debug(f"Missed a message on stream {stream_id:08x} for device {device_id}, waiting for a keyframe")
+                del self._streams[key]
+            return None
+
+        frame_gap, time_gap, changed_players = _DELTA_BODY.unpack_from(data, offset)
+        offset += _DELTA_BODY.size
+        for i in range(len(stream.fields)):
+            if not changed_players & (1 << i):
+                continue
+            changed_fields = data[offset]
+            offset += 1
+            values = list(stream.fields[i])
+            for j, field in enumerate(_FIELDS):
+                if changed_fields & (1 << j):
+                    values[j] = field.unpack_from(data, offset)[0]
+                    offset += field.size
+            stream.fields[i] = tuple(values)
+
+        stream.sequence = sequence
+        stream.frame_number += frame_gap
+        if stream.capture_time is not None:
+            stream.capture_time += time_gap / 1_000_000
+        return StateMessage(device_id, stream.frame_number, stream.race_id, *map(_player_state, stream.fields),
+                            capture_time=stream.capture_time)
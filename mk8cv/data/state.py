@@ -1,11 +1,19 @@
 import json
 import random
 from enum import Enum
+from typing import Optional
 
 
 class Player(str, Enum):
     P1 = 'p1'
     P2 = 'p2'
+    P3 = 'p3'
+    P4 = 'p4'
+
+
+def global_player_id(device_id: int, device_player_num: int) -> int:
+    """Overall player id for the device_player_num-th (1-based) player on a capture device's split screen."""
+    return device_id * len(Player) + device_player_num
 
 
 class Stat(str, Enum):
@@ -65,8 +73,8 @@ class StateEncoder(json.JSONEncoder):
                 'lap': obj.lap,
                 'race_laps': obj.race_laps,
                 'position': obj.position,
-                'item1': obj.item1.name,
-                'item2': obj.item2.name,
+                'item1': obj.item1.name if obj.item1 is not None else None,
+                'item2': obj.item2.name if obj.item2 is not None else None,
                 'coins': obj.coins
             }
         elif isinstance(obj, StateMessage):
@@ -74,8 +82,8 @@ class StateEncoder(json.JSONEncoder):
                 'race_id': obj.race_id,
                 'device_id': obj.device_id,
                 'frame_number': obj.frame_number,
-                'player1_state': obj.player1_state,
-                'player2_state': obj.player2_state
+                'capture_time': obj.capture_time,
+                'player_states': list(obj.player_states)
             }
         else:
             return super().default(obj)
@@ -89,28 +97,30 @@ class StateDecoder(json.JSONDecoder):
         # Decode PlayerState
         if 'lap' in obj and 'race_laps' in obj and 'position' in obj:
             return PlayerState(
-                lap=obj['lap'],
+                lap_num=obj['lap'],
                 race_laps=obj['race_laps'],
                 position=obj['position'],
-                item1=Item[obj['item1']],  # assuming Item is an Enum
-                item2=Item[obj['item2']],
+                item1=Item[obj['item1']] if obj['item1'] is not None else None,
+                item2=Item[obj['item2']] if obj['item2'] is not None else None,
                 coins=obj['coins']
             )
 
         # Decode StateMessage
         if 'race_id' in obj and 'device_id' in obj and 'frame_number' in obj:
             return StateMessage(
-                race_id=obj['race_id'],
-                device_id=obj['device_id'],
-                frame_number=obj['frame_number'],
-                player1_state=obj['player1_state'],
-                player2_state=obj['player2_state']
+                obj['device_id'],
+                obj['frame_number'],
+                obj['race_id'],
+                *obj['player_states'],
+                capture_time=obj.get('capture_time')
             )
 
         return obj
 
 
 class PlayerState:
+    __slots__ = ('lap', 'race_laps', 'position', 'item1', 'item2', 'coins')
+
     def __init__(self, position: int, item1: Item, item2: Item, coins: int = 0, lap_num: int = 1, race_laps: int = 3):
         self.lap = lap_num
         self.race_laps = race_laps
@@ -144,28 +154,44 @@ class PlayerState:
         return json.dumps({
             Stat.POSITION: self.position,
             Stat.LAP_NUM: self.lap,
-            Stat.ITEM1: self.item1.name,
-            Stat.ITEM2: self.item2.name,
+            Stat.ITEM1: self.item1.name if self.item1 is not None else None,
+            Stat.ITEM2: self.item2.name if self.item2 is not None else None,
             Stat.COINS: self.coins,
             Stat.RACE_LAPS: self.race_laps
         }, cls=StateEncoder)
 
 
 class StateMessage:
-    def __init__(self, device_id: int, frame_number: int, race_id: int, player1_state: PlayerState,
-                 player2_state: PlayerState):
+    """
+    The states of every player on one device's split screen for a single frame, in Player order.
+
+    frame_number counts the device's own frames, and capture_time is when the frame was captured, in seconds on
+    a clock shared by every capture device (None if unknown), so frames of different devices can be aligned.
+    """
+    __slots__ = ('race_id', 'device_id', 'frame_number', 'player_states', 'capture_time')
+
+    def __init__(self, device_id: int, frame_number: int, race_id: int, *player_states: PlayerState,
+                 capture_time: Optional[float] = None):
         self.race_id = race_id
         self.device_id = device_id
         self.frame_number = frame_number
-        self.player1_state = player1_state
-        self.player2_state = player2_state
+        self.player_states = player_states
+        self.capture_time = capture_time
+
+    @property
+    def player1_state(self) -> PlayerState:
+        return self.player_states[0] if len(self.player_states) > 0 else None
+
+    @property
+    def player2_state(self) -> PlayerState:
+        return self.player_states[1] if len(self.player_states) > 1 else None
 
     def __repr__(self):
         return json.dumps({
             "race_id": self.race_id,
             "device_id": self.device_id,
             "frame_number": self.frame_number,
-            Player.P1: self.player1_state if self.player1_state else {},
-            Player.P2: self.player2_state if self.player2_state else {}
+            "capture_time": self.capture_time,
+            **{player: state if state else {} for player, state in zip(Player, self.player_states)}
         }, cls=StateEncoder)
 
@@ -4,15 +4,25 @@ import os
 import cv2
 import argparse
 from multiprocessing import Process, Event
+from threading import Thread
 import time
 
 
 import redis
 
+from mk8cv.aggregator.aggregator import EventAggregator
+from mk8cv.aggregator.db import SqliteDB
+from mk8cv.aggregator.sources import SourceType
 from mk8cv.capture.capture import capture_and_process
+from mk8cv.data.codec import Codec
 from mk8cv.data.state import Stat
+from mk8cv.processing.aois import Layout
+from mk8cv.processing.calibration import CALIBRATION_DIR, SharedDeviceAois
 from mk8cv.processing.frame_processor import process_frames
-from mk8cv.sinks.sink import SinkType
+from mk8cv.processing.races import RaceIds
+from mk8cv.sinks.background import OverflowPolicy
+from mk8cv.sinks.ipc import DEFAULT_SOCKET_PATH
+from mk8cv.sinks.sink import STREAM_MAXLEN, PartitionKey, SinkType, race_id_allocator
 
 
 def main(_args: argparse.Namespace) -> None:
@@ -20,25 +30,59 @@ def main(_args: argparse.Namespace) -> None:
     m = multiprocessing.Manager()
     process_queue = m.Queue(maxsize=_args.queue_size)
 
+    # With the SQLITE sink the frame processors feed an aggregator thread in this process
+    state_queue = None
+    aggregator_thread = None
+    if _args.sink == SinkType.SQLITE:
+        state_queue = multiprocessing.Queue(maxsize=_args.queue_size)
+        database = SqliteDB(_args.db_file, batch_rows=_args.db_batch_rows, flush_ms=_args.db_flush_ms,
+                            synchronous=_args.db_synchronous)
+        aggregator = EventAggregator(None, None, None, SourceType.QUEUE, state_queue=state_queue, handle_signals=False,
+                                     database=database)
+        aggregator_thread = Thread(target=aggregator.listen, name='aggregator', daemon=True)
+        aggregator_thread.start()
+
     # Create an event to signal process termination
     stop_capture_event = Event()
     stop_process_event = Event()
 
-    # Create and start capture processes
+    # Create and start capture processes, sharing the time video files start at so their frames line up
     capture_processes = []
+    epoch = time.time()
     for i in range(_args.num_devices):
         source = _args.video_file if _args.video_file else i
         process = Process(target=capture_and_process,
-                          args=(source, i, _args.resolution, _args.frame_skip, process_queue, stop_capture_event, _args.fps))
+                          args=(source, i, _args.resolution, _args.frame_skip, process_queue, stop_capture_event, _args.fps,
+                                epoch))
         process.start()
         capture_processes.append(process)
 
+    # Races are shared by every frame processor and advanced as the lap counter comes and goes, their ids allocated
+    # by the sink so setups sharing it never reuse each other's. Without the lap counter, or with --race-id, every
+    # frame belongs to one race
+    race_ids = None
+    race_id = _args.race_id
+    allocator = race_id_allocator(_args.sink)
+    if race_id is None and Stat.LAP_NUM in _args.extract:
+        race_ids = RaceIds(_args.num_devices, allocate=allocator.allocate)
+    elif race_id is None:
+        race_id = allocator.allocate()
+
+    # Every frame processor splits a device's players by the same layout and reads them through the same AOIs,
+    # each device's layout resolved and its HUD calibrated by whichever processor needs it first
+    shared_aois = SharedDeviceAois(_args.num_devices)
+
     # Create and start frame processing processes
     processing_processes = []
-    for _ in range(_args.threads):
+    for worker_id in range(_args.threads):
         process = Process(target=process_frames,
                           args=(
-                          process_queue, stop_process_event, _args.race_id, _args.display, _args.training_save_dir, _args.write_csv, _args.sink, _args.extract))
+                          process_queue, stop_process_event, race_id, _args.display, _args.training_save_dir, _args.write_csv, _args.sink, _args.extract,
+                          _args.resolution, _args.layout, _args.calibration_dir, _args.calibrate,
+                          _args.recalibrate, _args.codec, _args.keyframe_interval, _args.keyframe_seconds,
+                          _args.stream_partitions, _args.partition_by, _args.stream_maxlen, _args.sink_buffer,
+                          _args.sink_batch_size, _args.overflow, _args.spill_path, _args.socket_path, worker_id,
+                          state_queue, _args.record, race_ids, shared_aois))
         process.start()
         processing_processes.append(process)
 
@@ -70,9 +114,17 @@ def main(_args: argparse.Namespace) -> None:
     for process in capture_processes + processing_processes:
         process.join()
 
+    if aggregator_thread is not None:
+        # the processors have flushed their sinks, so everything before this marker gets written
+        state_queue.put(None)
+        aggregator_thread.join()
+
     if _args.display:
         cv2.destroyAllWindows()
 
+def parse_layout(value):
+    return None if value == 'auto' else parse_enum(Layout)(value)
+
 def parse_enum(enum_class):
     def parse(value):
         try:
@@ -99,8 +151,40 @@ if __name__ == "__main__":
                         help="Frames per second for video emulation (only used with --video-file)")
     parser.add_argument("--display", action="store_true",
                         help="Display processed frames (for debugging)")
-    parser.add_argument('--sink', type=lambda sink: SinkType[sink], default=SinkType.REDIS, choices=list(SinkType),
+    parser.add_argument('--sink', type=lambda sink: SinkType[sink.upper()], default=SinkType.REDIS, choices=list(SinkType),
                         help="Choose the message broker to use for publishing the processed frames")
+    parser.add_argument("--socket-path", type=str, default=DEFAULT_SOCKET_PATH,
+                        help="With the UNIX_SOCKET sink, the socket the aggregator is bound to")
+    parser.add_argument("--sink-buffer", type=int, default=4096,
+                        help="Messages buffered in memory while the sink catches up")
+    parser.add_argument("--sink-batch-size", type=int, default=64,
+                        help="Most messages sent to the sink in one pipelined round-trip")
+    parser.add_argument("--overflow", type=OverflowPolicy, default=OverflowPolicy.BLOCK, choices=list(OverflowPolicy),
+                        help="What to do when the sink buffer is full: block processing, drop the oldest message or spill to disk")
+    parser.add_argument("--spill-path", type=str,
+                        help="File messages are spilled to with --overflow spill (defaults to a per-process temp file)")
+    parser.add_argument("--db-file", type=str, default='mk8cv.db',
+                        help="With the SQLITE sink, the SQLite database to write to")
+    parser.add_argument("--db-batch-rows", type=int, default=256,
+                        help="With the SQLITE sink, rows committed together in one SQLite transaction")
+    parser.add_argument("--db-flush-ms", type=float, default=100,
+                        help="With the SQLITE sink, longest a row waits to be committed")
+    parser.add_argument("--db-synchronous", type=str.upper, default='NORMAL', choices=['OFF', 'NORMAL', 'FULL'],
+                        help="With the SQLITE sink, SQLite crash safety: FULL survives power loss, NORMAL may lose the last commits, OFF may corrupt")
+    parser.add_argument("--record", type=str, metavar="PATH",
+                        help="Also record every state to compressed files PATH.<thread>, for the aggregator's --replay")
+    parser.add_argument("--stream-partitions", type=int, default=1,
+                        help="With the REDIS_STREAM sink, number of stream partitions aggregators can split between them")
+    parser.add_argument("--partition-by", type=PartitionKey, default=PartitionKey.DEVICE, choices=list(PartitionKey),
+                        help="With the REDIS_STREAM sink, whether messages are partitioned by device or by race")
+    parser.add_argument("--stream-maxlen", type=int, default=STREAM_MAXLEN,
+                        help="With the REDIS_STREAM sink, approximate number of entries kept per partition")
+    parser.add_argument('--codec', type=Codec, default=Codec.DELTA, choices=list(Codec),
+                        help="Wire format of published state messages; delta sends only changed fields, json is larger and slower but human-readable")
+    parser.add_argument("--keyframe-interval", type=int, default=120,
+                        help="With the delta codec, send every device's full state at least once every this many frames")
+    parser.add_argument("--keyframe-seconds", type=float, default=2.0,
+                        help="With the delta codec, send every device's full state at least once every this many seconds")
     parser.add_argument("--training-save-dir", type=str,
                         help="Directory to save training images (optional)")
     parser.add_argument("--extract", type=parse_enum(Stat), nargs='*', choices=list(Stat), default=list(Stat),
@@ -108,7 +192,15 @@ if __name__ == "__main__":
     parser.add_argument("--write-csv", action='store_true',
                         help="enable/disable writing extracted stats to csv")
     parser.add_argument("--race-id", type=int,
-                        help="manually specify a race_id (defaults to random int)")
+                        help="Put every frame in this race instead of detecting races from the lap counter")
+    parser.add_argument("--layout", type=parse_layout, nargs='+', default=[Layout.TWO_PLAYER],
+                        help="Split-screen layout (1p, 2p, 3p, 4p or auto) per device in device order; a single value applies to all devices")
+    parser.add_argument("--calibration-dir", type=str, default=CALIBRATION_DIR,
+                        help="Directory of cached per-device HUD calibrations, used whenever present")
+    parser.add_argument("--calibrate", action='store_true',
+                        help="Calibrate the HUD AOIs of devices without a cached calibration on startup")
+    parser.add_argument("--recalibrate", action='store_true',
+                        help="Calibrate the HUD AOIs of every device on startup, replacing cached calibrations")
 
     logging.getLogger().setLevel(logging.INFO)
     args = parser.parse_args()
@@ -127,9 +219,21 @@ if __name__ == "__main__":
     logging.info(f"FPS (for video file): {args.fps}")
     logging.info(f"Display frames: {args.display}")
     logging.info(f"Sink: {args.sink}")
+    logging.info(f"Sink buffer: {args.sink_buffer} messages in batches of {args.sink_batch_size}, overflow {args.overflow.value}")
+    if args.sink == SinkType.REDIS_STREAM:
+        logging.info(f"Stream partitions: {args.stream_partitions} by {args.partition_by.value}, maxlen {args.stream_maxlen}")
+    if args.sink == SinkType.SQLITE:
+        logging.info(f"Database: {args.db_file}, commits of {args.db_batch_rows} rows or every {args.db_flush_ms}ms, synchronous {args.db_synchronous}")
+    if args.record:
+        logging.info(f"Recording to {args.record}.<thread>")
+    logging.info(f"Codec: {args.codec.value}")
+    if args.codec == Codec.DELTA:
+        logging.info(f"Keyframes every {args.keyframe_interval} frames or {args.keyframe_seconds}s")
     logging.info(f"Extracting: {args.extract}")
     logging.info(f"CSV writing: {args.write_csv}")
-    logging.info(f"Race ID: {args.race_id}")
+    logging.info(f"Race ID: {args.race_id if args.race_id is not None else 'detected from the lap counter' if Stat.LAP_NUM in args.extract else 'allocated by the sink'}")
+    logging.info(f"Layouts: {[layout.value if layout else 'auto' for layout in args.layout]}")
+    logging.info(f"Calibration: {'recalibrate' if args.recalibrate else 'calibrate' if args.calibrate else 'cached only'} ({args.calibration_dir})")
     logging.info(
         f"Save training images to directory: {args.training_save_dir if args.training_save_dir else 'Not provided (not saving training images)'}")
 
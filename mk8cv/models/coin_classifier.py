@@ -8,7 +8,9 @@ import numpy as np
 
 
 from mk8cv.data.state import Player, Stat
-from mk8cv.processing.aois import CROP_COORDS
+from mk8cv.models.templates import MaskPyramid, load_templates
+from mk8cv.processing.aois import CROP_COORDS, crop, stat_crop_shapes
+from mk8cv.processing.crops import ColorSpace, FrameCrops
 
 
 class CoinClassifier(ABC):
@@ -16,36 +18,50 @@ class CoinClassifier(ABC):
         self._model = None
 
     @abstractmethod
-    def load(self, model_path: str = None) -> None:
+    def load(self, model_path: str = None, resolution: tuple[int, int] = None) -> None:
         pass
 
     @abstractmethod
     def _predict(self, frame: MatLike) -> str:
         pass
 
-    def extract_player_coins(self, frame: MatLike, player: Player) -> int:
-        """Extracts the player's coins from the frame."""
-        height, width, channels = frame.shape
+    def _predict_aoi(self, crops: FrameCrops, player: Player) -> int:
+        # overridden by classifiers that can reuse the frame's shared resizes and colour conversions
+        return self._predict(crops.get(player, Stat.COINS))
 
-        coin_coords = CROP_COORDS[player][Stat.COINS]
-        coins = self._predict(frame[round(height * coin_coords[2]): round(height * coin_coords[3]), round(width * coin_coords[0]): round(width * coin_coords[1])])
+    def extract_player_coins(self, frame: MatLike, player: Player, crop_coords=CROP_COORDS) -> int:
+        """Extracts the player's coins from the frame."""
+        coins = self._predict(crop(frame, crop_coords[player][Stat.COINS]))
 
         return coins
 
+    def extract_players_coins(self, crops: FrameCrops) -> dict[Player, int]:
+        """Extracts the coins of every player on screen from the frame's shared crops."""
+        return {player: self._predict_aoi(crops, player) for player in crops.players}
+
 class SevenSegmentCoinClassifier(CoinClassifier):
+    # (width, height) the coin counter is normalised to before reading its segments
+    SIZE = (65, 48)
 
     def __init__(self):
         super().__init__()
 
-    def load(self, model_path: str = None):
+    def load(self, model_path: str = None, resolution: tuple[int, int] = None):
         pass
 
     def _predict(self, frame: MatLike):
-        result, visualization = self._recognize_seven_segment(frame)
+        resized = cv2.resize(frame, self.SIZE)
+        result, visualization = self._recognize_seven_segment(resized, cv2.cvtColor(resized, cv2.COLOR_BGR2HSV))
         # cv2.imshow('Visualization', cv2.resize(visualization, (0,0), fx=2.0, fy=2.0))
         # cv2.waitKey(0)
         return result
 
+    def _predict_aoi(self, crops: FrameCrops, player: Player) -> int:
+        result, visualization = self._recognize_seven_segment(
+            crops.get(player, Stat.COINS, size=self.SIZE),
+            crops.get(player, Stat.COINS, ColorSpace.HSV, size=self.SIZE))
+        return result
+
     # def _preprocess_image(self, image):
     #     gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
     #     image = cv2.resize(gray, (65 , 48))
@@ -61,7 +77,7 @@ class SevenSegmentCoinClassifier(CoinClassifier):
     def _preprocess_image(self, image):
         # plt.imshow(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
         # plt.title('Original Preprocess')
-        image = cv2.resize(image, (65, 48))
+        # image arrives already resized to SIZE
 
         blurred = cv2.GaussianBlur(image, (5, 5), 0)
         # plt.imshow(blurred)
@@ -84,7 +100,7 @@ class SevenSegmentCoinClassifier(CoinClassifier):
         return thresh
 
 
-    def _extract_segments(self, preprocessed_image, original_image):
+    def _extract_segments(self, preprocessed_image, hsv_image):
         h, w = preprocessed_image.shape
         # cv2.imshow('preprocessed_image', preprocessed_image)
         # cv2.waitKey(0)
@@ -126,13 +142,10 @@ class SevenSegmentCoinClassifier(CoinClassifier):
 
 
         orange_segments = []
+        lower_orange = np.array([5, 150, 150])
+        upper_orange = np.array([25, 255, 255])
         for i, (x, y) in enumerate(list(segment_points)):
-            image = cv2.resize(original_image, (65, 48))
-            image = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
-            lower_orange = np.array([5, 150, 150])
-            upper_orange = np.array([25, 255, 255])
-
-            segment_area = image[int((h * y) - 1):int((h * y) + 1),
+            segment_area = hsv_image[int((h * y) - 1):int((h * y) + 1),
                             int((w * x) - 1):int((w * x) + 1)]
 
             # check if the segment is orange
@@ -168,15 +181,15 @@ class SevenSegmentCoinClassifier(CoinClassifier):
 
         return min(dists, key=operator.itemgetter(0))[1]
 
-    def _recognize_seven_segment(self, image):
+    def _recognize_seven_segment(self, image, hsv_image):
         preprocessed = self._preprocess_image(image)
-        segments, is_ten, preprocessed, visualization = self._extract_segments(preprocessed, image)
+        segments, is_ten, preprocessed, visualization = self._extract_segments(preprocessed, hsv_image)
 
         # Convert preprocessed (grayscale) to BGR
-        preprocessed_bgr = cv2.cvtColor(preprocessed, cv2.COLOR_GRAY2BGR)
+        # preprocessed_bgr = cv2.cvtColor(preprocessed, cv2.COLOR_GRAY2BGR)
 
         # Concatenate images horizontally
-        debug_output = cv2.resize(cv2.hconcat([preprocessed_bgr, visualization]), (0, 0), fx=4.0, fy=4.0)
+        # debug_output = cv2.resize(cv2.hconcat([preprocessed_bgr, visualization]), (0, 0), fx=4.0, fy=4.0)
 
         # Display the concatenated image
         # cv2.imshow('Preprocessed | Visualization', debug_output)
@@ -193,17 +206,24 @@ class CannyMaskCoinClassifier(CoinClassifier):
         super().__init__()
         self._masks = None
 
-    def load(self, model_path: str = "./templates/coins/edges/"):
-        self._masks = self._load_templates(model_path, 'mask')
+    def load(self, model_path: str = "./templates/coins/edges/", resolution: tuple[int, int] = None):
+        self._masks = MaskPyramid(load_templates(model_path, masks=True))
+        if resolution is not None:
+            self._masks.precompute(stat_crop_shapes(resolution, Stat.COINS))
 
     def _predict(self, frame: MatLike):
-        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        return self._predict_gray(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY))
+
+    def _predict_aoi(self, crops: FrameCrops, player: Player) -> int:
+        return self._predict_gray(crops.get(player, Stat.COINS, ColorSpace.GRAY))
+
+    def _predict_gray(self, gray: MatLike):
         boosted = cv2.convertScaleAbs(gray, alpha=1.5, beta=0)
         canny = cv2.Canny(boosted, threshold1=50, threshold2=150)
 
         min_error = None
         best_mask = None
-        for index, mask in self._masks.items():
+        for index, mask in self._masks.at(canny.shape[:2]).items():
             error = self._score_mask(canny, mask)
 
             if min_error == None or min_error > error:
@@ -212,23 +232,8 @@ class CannyMaskCoinClassifier(CoinClassifier):
 
         return best_mask
 
-    def _load_templates(self, template_dir: str, masks=False):
-        templates = {}
-        for filename in os.listdir(template_dir):
-            if filename.endswith('.png'):
-                if masks and not filename.endswith('_mask.png'):
-                    continue
-                elif not masks and (filename.endswith('_mask.png') or 'mask' in filename):
-                    continue
-                number = filename.split('.')[0]
-                if masks:
-                    number = number.split('_')[0]
-                template = cv2.imread(os.path.join(template_dir, filename), 0)
-                templates[number] = template
-        return templates
-    
     def _score_mask(self, image, mask):
-        height, width = image.shape[:2]
-        masked_canny = cv2.bitwise_and(image, cv2.resize(mask, (width, height)))
+        # mask is already sized to image by the MaskPyramid
+        masked_canny = cv2.bitwise_and(image, mask)
         
         return np.sum(masked_canny)
\ No newline at end of file
@@ -7,7 +7,8 @@ import cv2
 from cv2.typing import MatLike
 
 from mk8cv.data.state import Player, Stat, Item
-from mk8cv.processing.aois import CROP_COORDS
+from mk8cv.processing.aois import CROP_COORDS, crop
+from mk8cv.processing.crops import ColorSpace, FrameCrops
 
 
 classes = ['01', '02', '03', '04', '05', '06', '07', '08', '09', '10', '11', '12', '13', '14', '15', '16', '17', '18', '19', '20', '21', '23', '24']
@@ -28,17 +29,27 @@ class ItemClassifier(ABC):
     def _predict(self, frame: MatLike) -> str:
         pass
 
-    def extract_player_items(self, frame: MatLike, player: Player) -> tuple[Item, Item]:
+    def _predict_rgb_batch(self, images: list[MatLike]) -> list[str]:
+        # overridden by classifiers that can classify RGB crops in one batch
+        return [self._predict(cv2.cvtColor(image, cv2.COLOR_RGB2BGR)) for image in images]
+
+    def extract_player_items(self, frame: MatLike, player: Player, crop_coords=CROP_COORDS) -> tuple[Item, Item]:
         """Extracts the player's items from the frame."""
-        height, width, channels = frame.shape
+        item1 = self._predict(crop(frame, crop_coords[player][Stat.ITEM1]))
+        item2 = self._predict(crop(frame, crop_coords[player][Stat.ITEM2]))
 
-        item1_coords = CROP_COORDS[player][Stat.ITEM1]
-        item1 = self._predict(frame[round(height * item1_coords[2]): round(height * item1_coords[3]), round(width * item1_coords[0]): round(width * item1_coords[1])])
+        return Item(int(item1)), Item(int(item2))
 
-        item2_coords = CROP_COORDS[player][Stat.ITEM2]
-        item2 = self._predict(frame[round(height * item2_coords[2]): round(height * item2_coords[3]), round(width * item2_coords[0]): round(width * item2_coords[1])])
+    def extract_players_items(self, crops: FrameCrops) -> dict[Player, tuple[Item, Item]]:
+        """Extracts both item slots of every player on screen in a single forward pass."""
+        players = crops.players
+        images = []
+        for player in players:
+            images.append(crops.get(player, Stat.ITEM1, ColorSpace.RGB))
+            images.append(crops.get(player, Stat.ITEM2, ColorSpace.RGB))
+        items = self._predict_rgb_batch(images)
 
-        return Item(int(item1)), Item(int(item2))
+        return {player: (Item(int(items[2 * i])), Item(int(items[2 * i + 1]))) for i, player in enumerate(players)}
 
 
 class MobileNetV3ItemClassifier(ItemClassifier):
@@ -55,6 +66,9 @@ class MobileNetV3ItemClassifier(ItemClassifier):
         return self._model
 
     def _predict(self, frame: MatLike):
+        return self._predict_rgb_batch([cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)])[0]
+
+    def _predict_rgb_batch(self, images: list[MatLike]) -> list[str]:
         img_width, img_height = 96, 96
         preprocess = transforms.Compose([
             transforms.ToPILImage(),
@@ -63,15 +77,13 @@ class MobileNetV3ItemClassifier(ItemClassifier):
             transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
         ])
 
-        image = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-        image = preprocess(image).unsqueeze(0).to(self._device)
+        batch = torch.stack([preprocess(image) for image in images]).to(self._device)
 
         with torch.no_grad():
-            output = self._model(image)
+            output = self._model(batch)
             _, predicted = torch.max(output, 1)
 
-        predicted_class = classes[predicted.item()]
-        return predicted_class
+        return [classes[index] for index in predicted.tolist()]
 
 
 class ResNet18ItemClassifier(ItemClassifier):
@@ -88,6 +100,9 @@ class ResNet18ItemClassifier(ItemClassifier):
         return self._model
     
     def _predict(self, frame: MatLike):
+        return self._predict_rgb_batch([cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)])[0]
+
+    def _predict_rgb_batch(self, images: list[MatLike]) -> list[str]:
         img_width, img_height = 96, 96
         preprocess = transforms.Compose([
             transforms.ToPILImage(),
@@ -96,12 +111,10 @@ class ResNet18ItemClassifier(ItemClassifier):
             transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
         ])
 
-        image = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-        image = preprocess(image).unsqueeze(0).to(self._device)
+        batch = torch.stack([preprocess(image) for image in images]).to(self._device)
 
         with torch.no_grad():
-            output = self._model(image)
+            output = self._model(batch)
             _, predicted = torch.max(output, 1)
 
-        predicted_class = classes[predicted.item()]
-        return predicted_class
+        return [classes[index] for index in predicted.tolist()]
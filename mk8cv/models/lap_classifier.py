@@ -8,7 +8,9 @@ from cv2.typing import MatLike
 import numpy as np
 
 from mk8cv.data.state import Player, Stat
-from mk8cv.processing.aois import CROP_COORDS
+from mk8cv.models.templates import TEMPLATES_ROOT, load_templates, scale_templates
+from mk8cv.processing.aois import CROP_COORDS, Layout, crop, stat_crop_shapes
+from mk8cv.processing.crops import ColorSpace, FrameCrops
 
 
 class LapClassifier(ABC):
@@ -16,40 +18,54 @@ class LapClassifier(ABC):
         self._model = None
 
     @abstractmethod
-    def load(self, model_path: str = None) -> None:
+    def load(self, model_path: str = None, resolution: tuple[int, int] = None) -> None:
         pass
 
     @abstractmethod
     def _predict(self, frame: MatLike) -> tuple[int, int]:
         pass
 
-    def extract_laps(self, frame: MatLike, player: Player) -> tuple[int, int]:
-        height, width, channels = frame.shape
+    def _predict_aoi(self, crops: FrameCrops, player: Player, stat: Stat):
+        # overridden by classifiers that can reuse the frame's shared resizes and colour conversions
+        return self._predict(frame=crops.get(player, stat))
 
-        lap_num_coords = CROP_COORDS[player][Stat.LAP_NUM]
-        race_laps_coords = CROP_COORDS[player][Stat.RACE_LAPS]
-
-        lap_num = self._predict(frame=frame[round(height * lap_num_coords[2]): round(height * lap_num_coords[3]), round(width * lap_num_coords[0]): round(width * lap_num_coords[1])])
-        race_laps = self._predict(frame=frame[round(height * race_laps_coords[2]): round(height * race_laps_coords[3]), round(width * race_laps_coords[0]): round(width * race_laps_coords[1])])
+    def extract_laps(self, frame: MatLike, player: Player, crop_coords=CROP_COORDS) -> tuple[int, int]:
+        lap_num = self._predict(frame=crop(frame, crop_coords[player][Stat.LAP_NUM]))
+        race_laps = self._predict(frame=crop(frame, crop_coords[player][Stat.RACE_LAPS]))
 
         return lap_num, race_laps
 
+    def extract_players_laps(self, crops: FrameCrops) -> dict[Player, tuple[int, int]]:
+        """Extracts (lap_num, race_laps) for every player on screen from the frame's shared crops."""
+        return {player: (self._predict_aoi(crops, player, Stat.LAP_NUM), self._predict_aoi(crops, player, Stat.RACE_LAPS))
+                for player in crops.players}
+
 class SevenSegmentLapClassifier(LapClassifier):
+    # (width, height) the lap digits are normalised to before reading their segments
+    SIZE = (27, 42)
+    # Segments a reading may get wrong and still be its nearest digit; anything further, e.g. a crop without the
+    # lap counter, is no digit at all
+    MAX_SEGMENT_ERRORS = 1
+
     def __init__(self):
         super().__init__()
 
-    def load(self, model_path: str = None):
+    def load(self, model_path: str = None, resolution: tuple[int, int] = None):
         pass
 
     def _predict(self, frame: MatLike) -> tuple[int, int]:
-        result, visualization = self._recognize_seven_segment(frame)
+        result, visualization = self._recognize_seven_segment(cv2.resize(frame, self.SIZE))
+        return result
+
+    def _predict_aoi(self, crops: FrameCrops, player: Player, stat: Stat):
+        result, visualization = self._recognize_seven_segment(crops.get(player, stat, size=self.SIZE))
         return result
 
     def _preprocess_image(self, image):
         # plt.imshow(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
         # plt.title('Original Preprocess')
         # image = cv2.resize(image, (65, 48))
-        image = cv2.resize(image, (27, 42))
+        # image arrives already resized to SIZE
 
         blurred = cv2.GaussianBlur(image, (3, 3), 0)
         # plt.imshow(blurred)
@@ -129,7 +145,8 @@ class SevenSegmentLapClassifier(LapClassifier):
 
         dists = [(np.abs(np.array(pattern) - np.array(segments)).sum(), digit) for pattern, digit in segment_patterns.items()]
 
-        return min(dists, key=operator.itemgetter(0))[1]
+        dist, digit = min(dists, key=operator.itemgetter(0))
+        return digit if dist <= self.MAX_SEGMENT_ERRORS else None
 
     def _recognize_seven_segment(self, image):
         preprocessed = self._preprocess_image(image)
@@ -153,40 +170,38 @@ class SevenSegmentLapClassifier(LapClassifier):
 class TemplateMatchingLapClassifier(LapClassifier):
     def __init__(self):
         super().__init__()
-        self._lap_num_templates
-        self._lap_num_masks
-        self._race_laps_templates
-        self._race_laps_masks
-
-    def load(self, model_path: str = None) -> None:
-        self._lap_num_templates = self._load_templates(os.path.join(model_path, "templates/lap_num"))
-        self._lap_num_masks = self._load_templates(os.path.join(model_path, "templates/lap_num"), masks=True)
-        self._race_laps_templates = self._load_templates(os.path.join(model_path, "templates/race_laps"))
-        self._race_laps_masks = self._load_templates(os.path.join(model_path, "templates/race_laps"), masks=True)
+        self._lap_num_templates = None
+        self._lap_num_masks = None
+        self._race_laps_templates = None
+        self._race_laps_masks = None
+
+    def load(self, model_path: str = os.path.dirname(TEMPLATES_ROOT), resolution: tuple[int, int] = None) -> None:
+        # both recognizers run over each crop, so templates must fit the smaller of the two. The templates were cut
+        # from 2P footage, so they only fit the 2P crops
+        crop_shapes = (stat_crop_shapes(resolution, Stat.LAP_NUM, [Layout.TWO_PLAYER]) |
+                       stat_crop_shapes(resolution, Stat.RACE_LAPS, [Layout.TWO_PLAYER])
+                       if resolution is not None else ())
+        self._lap_num_templates = scale_templates(
+            load_templates(os.path.join(model_path, "templates/lap_num")), resolution, crop_shapes)
+        self._lap_num_masks = scale_templates(
+            load_templates(os.path.join(model_path, "templates/lap_num"), masks=True), resolution, crop_shapes)
+        self._race_laps_templates = scale_templates(
+            load_templates(os.path.join(model_path, "templates/race_laps")), resolution, crop_shapes)
+        self._race_laps_masks = scale_templates(
+            load_templates(os.path.join(model_path, "templates/race_laps"), masks=True), resolution, crop_shapes)
 
     def _predict(self, frame: MatLike) -> tuple[int, int]:
-        lap_nums = self._recognize_lap_num(frame, self._lap_num_templates, self._lap_num_masks)
-        race_laps = self._recognize_race_laps(frame, self._race_laps_templates, self._race_laps_masks)
+        return self._predict_gray(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY))
+
+    def _predict_aoi(self, crops: FrameCrops, player: Player, stat: Stat):
+        return self._predict_gray(crops.get(player, stat, ColorSpace.GRAY))
+
+    def _predict_gray(self, gray: MatLike) -> tuple[int, int]:
+        lap_nums = self._recognize_lap_num(gray, self._lap_num_templates, self._lap_num_masks)
+        race_laps = self._recognize_race_laps(gray, self._race_laps_templates, self._race_laps_masks)
 
         return lap_nums, race_laps
 
-    @staticmethod
-    def _load_templates(template_dir, masks=False):
-        templates = {}
-        for filename in os.listdir(template_dir):
-            if filename.endswith('.png'):
-                if masks and not filename.endswith('_mask.png'):
-                    continue
-                elif not masks and (filename.endswith('_mask.png') or 'mask' in filename):
-                    continue
-                number = filename.split('.')[0]
-                if masks:
-                    number = number.split('_')[0]
-                template = cv2.imread(os.path.join(template_dir, filename), 0)
-                # template = cv2.resize(cv2.imread(os.path.join(template_dir, filename), 0), (0, 0), fx=.2, fy=.2)
-                templates[number] = template
-        return templates
-    
     @staticmethod
     def _match_template(image, template, mask, threshold=0.95):
         result = cv2.matchTemplate(image, template, cv2.TM_SQDIFF, mask=mask)
@@ -196,8 +211,7 @@ class TemplateMatchingLapClassifier(LapClassifier):
         return min_val
 
     @staticmethod
-    def _recognize_lap_num(image, templates, masks):
-        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    def _recognize_lap_num(gray, templates, masks):
         # cv2.imshow('gray', gray)
 
         scores = {}
@@ -211,8 +225,8 @@ class TemplateMatchingLapClassifier(LapClassifier):
             return best
         return None
 
-    def _recognize_race_laps(image, templates, masks):
-        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    @staticmethod
+    def _recognize_race_laps(gray, templates, masks):
         # cv2.imshow('gray', gray)
 
         scores = {}
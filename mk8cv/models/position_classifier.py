@@ -11,7 +11,9 @@ import numpy as np
 import matplotlib.pyplot as plt
 
 from mk8cv.data.state import Player, Stat
-from mk8cv.processing.aois import CROP_COORDS
+from mk8cv.models.templates import MaskPyramid, load_templates, scale_templates
+from mk8cv.processing.aois import CROP_COORDS, Layout, crop, stat_crop_shapes
+from mk8cv.processing.crops import ColorSpace, FrameCrops
 
 
 classes = ["00","01","02","03","04","05","06","07","08","09","10","11","12"]
@@ -25,28 +27,39 @@ class PositionClassifier(ABC):
         self._classes = classes
 
     @abstractmethod
-    def load(self, model_path: str = None) -> None:
+    def load(self, model_path: str = None, resolution: tuple[int, int] = None) -> None:
         pass
 
     @abstractmethod
     def _predict(self, frame: MatLike) -> str:
         pass
 
-    def extract_player_position(self, frame: MatLike, player: Player) -> int:
-        """Extracts the player's items from the frame."""
-        height, width, channels = frame.shape
+    def _predict_aoi(self, crops: FrameCrops, player: Player):
+        # overridden by classifiers that can reuse the frame's shared resizes and colour conversions
+        return self._predict(crops.get(player, Stat.POSITION))
+
+    def _predict_players(self, crops: FrameCrops) -> list:
+        # overridden by classifiers that can classify every player's crop in one batch
+        return [self._predict_aoi(crops, player) for player in crops.players]
 
-        position_coords = CROP_COORDS[player][Stat.POSITION]
-        position = self._predict(frame[round(height * position_coords[2]): round(height * position_coords[3]), round(width * position_coords[0]): round(width * position_coords[1])])
+    def extract_player_position(self, frame: MatLike, player: Player, crop_coords=CROP_COORDS) -> int:
+        """Extracts the player's items from the frame."""
+        position = self._predict(crop(frame, crop_coords[player][Stat.POSITION]))
 
         return int(position)
 
+    def extract_players_position(self, crops: FrameCrops) -> dict[Player, int]:
+        """Extracts the position of every player on screen from the frame's shared crops."""
+        positions = self._predict_players(crops)
+        return {player: int(position) for player, position in zip(crops.players, positions)}
+
 
 class MobileNetV3PositionClassifier(PositionClassifier):
     def __init__(self):
         super().__init__()
 
-    def load(self, model_path=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'position_classifier_mobilenetv3.pth')):
+    def load(self, model_path=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'position_classifier_mobilenetv3.pth'),
+             resolution: tuple[int, int] = None):
         self._model = models.mobilenet_v3_large(weights=None)
         num_classes = len(self._classes)
         self._model.classifier[3] = nn.Linear(self._model.classifier[3].in_features, num_classes)
@@ -56,6 +69,13 @@ class MobileNetV3PositionClassifier(PositionClassifier):
         return self._model
 
     def _predict(self, frame: MatLike):
+        return self._predict_rgb_batch([cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)])[0]
+
+    def _predict_players(self, crops: FrameCrops) -> list[str]:
+        # every player's position in a single forward pass, as the item classifier does
+        return self._predict_rgb_batch([crops.get(player, Stat.POSITION, ColorSpace.RGB) for player in crops.players])
+
+    def _predict_rgb_batch(self, images: list[MatLike]) -> list[str]:
         img_width, img_height = 96, 96
         preprocess = transforms.Compose([
             transforms.ToPILImage(),
@@ -64,15 +84,13 @@ class MobileNetV3PositionClassifier(PositionClassifier):
             transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
         ])
 
-        image = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-        image = preprocess(image).unsqueeze(0).to(self._device)
+        batch = torch.stack([preprocess(image) for image in images]).to(self._device)
 
         with torch.no_grad():
-            output = self._model(image)
+            output = self._model(batch)
             _, predicted = torch.max(output, 1)
 
-        predicted_class = classes[predicted.item()]
-        return predicted_class
+        return [classes[index] for index in predicted.tolist()]
 
 
 class TemplatePositionClassifier(PositionClassifier):
@@ -81,12 +99,19 @@ class TemplatePositionClassifier(PositionClassifier):
         self._templates = None
         self._masks = None
 
-    def load(self, model_path: str = "./templates/position"):
-        self._templates = self._load_templates(model_path)
-        self._masks = self._load_templates(model_path, 'mask')
+    def load(self, model_path: str = "./templates/position", resolution: tuple[int, int] = None):
+        # the templates were cut from 2P footage, so they only fit the 2P crops
+        crop_shapes = stat_crop_shapes(resolution, Stat.POSITION, [Layout.TWO_PLAYER]) if resolution is not None else ()
+        self._templates = scale_templates(load_templates(model_path), resolution, crop_shapes)
+        self._masks = scale_templates(load_templates(model_path, masks=True), resolution, crop_shapes)
 
     def _predict(self, frame: MatLike):
-        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        return self._predict_gray(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY))
+
+    def _predict_aoi(self, crops: FrameCrops, player: Player):
+        return self._predict_gray(crops.get(player, Stat.POSITION, ColorSpace.GRAY))
+
+    def _predict_gray(self, gray: MatLike):
 
         scores = {}
         for number, template in self._templates.items():
@@ -99,21 +124,6 @@ class TemplatePositionClassifier(PositionClassifier):
             return best
         return None
 
-    def _load_templates(self, template_dir: str, masks=False):
-        templates = {}
-        for filename in os.listdir(template_dir):
-            if filename.endswith('.png'):
-                if masks and not filename.endswith('_mask.png'):
-                    continue
-                elif not masks and (filename.endswith('_mask.png') or 'mask' in filename):
-                    continue
-                number = filename.split('.')[0]
-                if masks:
-                    number = number.split('_')[0]
-                template = cv2.imread(os.path.join(template_dir, filename), 0)
-                templates[number] = template
-        return templates
-
     def _match_template(self, image, template, mask, threshold=0.95):
         result = cv2.matchTemplate(image, template, cv2.TM_SQDIFF, mask=mask)
         min_val, max_val, min_loc, max_loc = cv2.minMaxLoc(result)
@@ -127,17 +137,25 @@ class CannyMaskPositionClassifier(PositionClassifier):
         self._threshold = threshold
 
 
-    def load(self, model_path: str = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../templates/position/edges/')):
-        self._masks = self._load_templates(model_path, 'mask')
+    def load(self, model_path: str = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../templates/position/edges/'),
+             resolution: tuple[int, int] = None):
+        self._masks = MaskPyramid(load_templates(model_path, masks=True))
+        if resolution is not None:
+            self._masks.precompute(stat_crop_shapes(resolution, Stat.POSITION))
 
     def _predict(self, frame: MatLike):
-        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        return self._predict_gray(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY))
+
+    def _predict_aoi(self, crops: FrameCrops, player: Player):
+        return self._predict_gray(crops.get(player, Stat.POSITION, ColorSpace.GRAY))
+
+    def _predict_gray(self, gray: MatLike):
         boosted = cv2.convertScaleAbs(gray, alpha=1.5, beta=0)
         canny = cv2.Canny(boosted, threshold1=50, threshold2=150)
 
         min_error = None
         best_mask = None
-        for index, mask in self._masks.items():
+        for index, mask in self._masks.at(canny.shape[:2]).items():
             error = self._score_mask(canny, mask)
 
             if min_error == None or min_error > error:
@@ -146,23 +164,8 @@ class CannyMaskPositionClassifier(PositionClassifier):
 
         return best_mask if min_error < self._threshold else 0
 
-    def _load_templates(self, template_dir: str, masks=False):
-        templates = {}
-        for filename in os.listdir(template_dir):
-            if filename.endswith('.png'):
-                if masks and not filename.endswith('_mask.png'):
-                    continue
-                elif not masks and (filename.endswith('_mask.png') or 'mask' in filename):
-                    continue
-                number = filename.split('.')[0]
-                if masks:
-                    number = number.split('_')[0]
-                template = cv2.imread(os.path.join(template_dir, filename), 0)
-                templates[number] = template
-        return templates
-    
     def _score_mask(self, image, mask):
-        height, width = image.shape[:2]
-        masked_canny = cv2.bitwise_and(image, cv2.resize(mask, (width, height)))
+        # mask is already sized to image by the MaskPyramid
+        masked_canny = cv2.bitwise_and(image, mask)
         
         return np.sum(masked_canny)
\ No newline at end of file
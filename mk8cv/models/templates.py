@@ -0,0 +1,202 @@
+import argparse
+import hashlib
+import json
+import logging
+import os
+from typing import Iterable, Optional
+
+import cv2
+from cv2.typing import MatLike
+import numpy as np
+
+from mk8cv.processing.aois import REFERENCE_RESOLUTION
+
+TEMPLATES_ROOT = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../templates'))
+BUNDLE_PATH = os.path.join(TEMPLATES_ROOT, 'templates.bundle')
+# Bump whenever the bundle layout changes so stale bundles from older builds are ignored
+BUNDLE_VERSION = 1
+
+
+def _is_mask(filename: str) -> bool:
+    return filename.endswith('_mask.png') or 'mask' in filename
+
+
+def _template_key(filename: str, masks: bool) -> str:
+    number = filename.split('.')[0]
+    if masks:
+        number = number.split('_')[0]
+    return number
+
+
+def _png_files(template_dir: str) -> list[str]:
+    return sorted(filename for filename in os.listdir(template_dir) if filename.endswith('.png'))
+
+
+def _fingerprint(template_dir: str) -> str:
+    """Hash of the name, size and mtime of every PNG in a directory; changes whenever a template is edited."""
+    digest = hashlib.sha1()
+    for filename in _png_files(template_dir):
+        stat = os.stat(os.path.join(template_dir, filename))
+        digest.update(f'{filename}:{stat.st_size}:{stat.st_mtime_ns};'.encode())
+    return digest.hexdigest()
+
+
+def _load_pngs(template_dir: str, masks: bool = False) -> dict[str, MatLike]:
+    templates = {}
+    for filename in _png_files(template_dir):
+        if masks and not filename.endswith('_mask.png'):
+            continue
+        elif not masks and _is_mask(filename):
+            continue
+        templates[_template_key(filename, masks)] = cv2.imread(os.path.join(template_dir, filename), 0)
+    return templates
+
+
+class TemplateBundle:
+    """
+    Every grayscale template under TEMPLATES_ROOT packed into one flat uint8 array plus a JSON index.
+
+    The array is memory-mapped read-only, so every worker process shares the same page-cache pages
+    instead of decoding its own copy of each PNG. Templates come back as zero-copy views.
+    """
+
+    def __init__(self, path: str = BUNDLE_PATH) -> None:
+        with open(path + '.json', 'r') as f:
+            self._index = json.load(f)
+        if self._index.get('version') != BUNDLE_VERSION:
+            raise ValueError(f"Template bundle {path} has version {self._index.get('version')}, expected {BUNDLE_VERSION}")
+        self._data = np.load(path + '.npy', mmap_mode='r')
+
+    def get(self, template_dir: str, masks: bool = False) -> Optional[dict[str, MatLike]]:
+        """Templates for a directory, or None if the directory is not bundled or has changed since the build."""
+        key = os.path.relpath(os.path.abspath(template_dir), self._index['root'])
+        entry = self._index['dirs'].get(key)
+        if entry is None or entry['fingerprint'] != _fingerprint(template_dir):
+            return None
+
+        templates = {}
+        for name, (offset, height, width) in entry['masks' if masks else 'templates'].items():
+            templates[name] = self._data[offset:offset + height * width].reshape(height, width)
+        return templates
+
+    @staticmethod
+    def build(root: str = TEMPLATES_ROOT, path: str = BUNDLE_PATH) -> None:
+        """Compiles every template directory under root into path.npy / path.json."""
+        chunks = []
+        offset = 0
+        dirs = {}
+        for dirpath, _, filenames in os.walk(root):
+            if not any(filename.endswith('.png') for filename in filenames):
+                continue
+            entry = {'fingerprint': _fingerprint(dirpath), 'templates': {}, 'masks': {}}
+            for masks in (False, True):
+                for name, template in _load_pngs(dirpath, masks).items():
+                    height, width = template.shape[:2]
+                    chunks.append(np.ascontiguousarray(template, dtype=np.uint8).ravel())
+                    entry['masks' if masks else 'templates'][name] = (offset, height, width)
+                    offset += height * width
+            dirs[os.path.relpath(dirpath, root)] = entry
+
+        # swap the data in first so a reader never sees an index pointing past the end of the array
+        with open(path + '.npy.tmp', 'wb') as f:
+            np.save(f, np.concatenate(chunks) if chunks else np.empty(0, dtype=np.uint8))
+        os.replace(path + '.npy.tmp', path + '.npy')
+        with open(path + '.json.tmp', 'w') as f:
+            json.dump({'version': BUNDLE_VERSION, 'root': os.path.abspath(root), 'dirs': dirs}, f)
+        os.replace(path + '.json.tmp', path + '.json')
+        logging.info(f"Bundled {len(dirs)} template directories ({offset} bytes) into {path}")
+
+
+_bundle: Optional[TemplateBundle] = None
+_bundle_loaded = False
+
+
+def _default_bundle() -> Optional[TemplateBundle]:
+    global _bundle, _bundle_loaded
+    if not _bundle_loaded:
+        _bundle_loaded = True
+        try:
+            _bundle = TemplateBundle()
+        except (OSError, ValueError) as e:
+            logging.info(f"No usable template bundle ({e}), reading PNGs from disk")
+    return _bundle
+
+
+def load_templates(template_dir: str, masks: bool = False) -> dict[str, MatLike]:
+    """
+    Loads the templates (or their `_mask` counterparts) in template_dir, keyed by the number in the filename.
+
+    Served from the memory-mapped TemplateBundle when it is present and up to date, otherwise read
+    from the PNG files directly.
+    """
+    bundle = _default_bundle()
+    templates = bundle.get(template_dir, masks) if bundle is not None else None
+    if templates is None:
+        templates = _load_pngs(template_dir, masks)
+    return templates
+
+
+class MaskPyramid:
+    """
+    Masks resized to every crop shape they are scored against, keyed by (height, width).
+
+    Levels for the shapes the pipeline resolution produces are built once in `precompute`, so
+    per-frame scoring never resizes. An unexpected shape (e.g. no resolution given at load time)
+    is resized on first use and cached.
+    """
+
+    def __init__(self, masks: dict[str, MatLike]) -> None:
+        self._masks = masks
+        self._levels: dict[tuple[int, int], dict[str, MatLike]] = {}
+
+    def precompute(self, shapes: Iterable[tuple[int, int]]) -> None:
+        for shape in shapes:
+            self.at(shape)
+
+    def at(self, shape: tuple[int, int]) -> dict[str, MatLike]:
+        level = self._levels.get(shape)
+        if level is None:
+            height, width = shape
+            level = {index: cv2.resize(mask, (width, height)) for index, mask in self._masks.items()}
+            self._levels[shape] = level
+        return level
+
+
+def scale_templates(templates: dict[str, MatLike],
+                    resolution: Optional[tuple[int, int]],
+                    max_shapes: Iterable[tuple[int, int]] = ()) -> dict[str, MatLike]:
+    """
+    Scales templates cut at REFERENCE_RESOLUTION to the given (width, height) pipeline resolution.
+
+    Templates are clamped to the smallest of max_shapes so cv2.matchTemplate never sees a template
+    larger than the crop it slides over.
+    """
+    if resolution is None or tuple(resolution) == REFERENCE_RESOLUTION:
+        return templates
+
+    scale_x = resolution[0] / REFERENCE_RESOLUTION[0]
+    scale_y = resolution[1] / REFERENCE_RESOLUTION[1]
+    max_shapes = list(max_shapes)
+    max_height = min((shape[0] for shape in max_shapes), default=None)
+    max_width = min((shape[1] for shape in max_shapes), default=None)
+
+    scaled = {}
+    for index, template in templates.items():
+        height = max(1, round(template.shape[0] * scale_y))
+        width = max(1, round(template.shape[1] * scale_x))
+        if max_height is not None:
+            height, width = min(height, max_height), min(width, max_width)
+        scaled[index] = cv2.resize(template, (width, height), interpolation=cv2.INTER_AREA)
+    return scaled
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compile the template PNGs into a memory-mappable bundle")
+    parser.add_argument('--root', type=str, default=TEMPLATES_ROOT,
+                        help='Directory of template PNGs to bundle')
+    parser.add_argument('--out', type=str, default=BUNDLE_PATH,
+                        help='Bundle path, without the .npy/.json extension')
+
+    logging.getLogger().setLevel(logging.INFO)
+    args = parser.parse_args()
+    TemplateBundle.build(args.root, args.out)
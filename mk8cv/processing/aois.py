@@ -1,6 +1,36 @@
+from enum import Enum
+from typing import Iterable
 
 from mk8cv.data.state import Player, Stat
 
+# Resolution the CROP_COORDS and the templates/ directory were tuned against, formatted as (width, height)
+REFERENCE_RESOLUTION = (1920, 1080)
+
+
+class Layout(str, Enum):
+    ONE_PLAYER = '1p'
+    TWO_PLAYER = '2p'
+    THREE_PLAYER = '3p'
+    FOUR_PLAYER = '4p'
+
+
+# Single player HUD over the full screen. Formatted as x1, x2, y1, y2
+SINGLE_SCREEN_COORDS = {
+    Stat.POSITION: (0.85, 0.95, 0.8, 0.95),
+    Stat.COINS: (0.045, 0.075, 0.91, 0.96),
+    Stat.LAP_NUM: (0.093, 0.11, 0.905, 0.96),
+    Stat.RACE_LAPS: (0.117, 0.13, 0.912, 0.955),
+    Stat.ITEM1: (0.06, 0.13, 0.05, 0.19),
+    Stat.ITEM2: (0.03, 0.065, 0.03, 0.1),
+}
+
+
+def _quadrant(coords: dict[Stat, tuple[float, float, float, float]], column: int, row: int) -> dict[Stat, tuple[float, float, float, float]]:
+    """Shrinks full screen coords into one quadrant of a 2x2 split. Each quadrant keeps the 16:9 aspect ratio."""
+    return {stat: ((column + x1) / 2, (column + x2) / 2, (row + y1) / 2, (row + y2) / 2)
+            for stat, (x1, x2, y1, y2) in coords.items()}
+
+
 # Formatted as x1, x2, y1, y2
 CROP_COORDS = {
     Player.P1 : {
@@ -21,4 +51,77 @@ CROP_COORDS = {
         Stat.ITEM1: (0.834, 0.918, 0.08, 0.23),
         Stat.ITEM2: (0.915, 0.958, 0.047, 0.13),
     }
-}
\ No newline at end of file
+}
+
+# 1P, 3P and 4P coords are derived from the full screen HUD and are a starting point; the 2P coords are hand tuned.
+# In 3P the bottom-right quadrant holds the course map rather than a player.
+LAYOUTS = {
+    Layout.ONE_PLAYER: {
+        Player.P1: SINGLE_SCREEN_COORDS,
+    },
+    Layout.TWO_PLAYER: CROP_COORDS,
+    Layout.THREE_PLAYER: {
+        Player.P1: _quadrant(SINGLE_SCREEN_COORDS, 0, 0),
+        Player.P2: _quadrant(SINGLE_SCREEN_COORDS, 1, 0),
+        Player.P3: _quadrant(SINGLE_SCREEN_COORDS, 0, 1),
+    },
+    Layout.FOUR_PLAYER: {
+        Player.P1: _quadrant(SINGLE_SCREEN_COORDS, 0, 0),
+        Player.P2: _quadrant(SINGLE_SCREEN_COORDS, 1, 0),
+        Player.P3: _quadrant(SINGLE_SCREEN_COORDS, 0, 1),
+        Player.P4: _quadrant(SINGLE_SCREEN_COORDS, 1, 1),
+    },
+}
+
+
+def crop_bounds(resolution: tuple[int, int], coords: tuple[float, float, float, float]) -> tuple[int, int, int, int]:
+    """Pixel bounds of a crop at the given (width, height) resolution, formatted as y1, y2, x1, x2."""
+    width, height = resolution
+    return (round(height * coords[2]), round(height * coords[3]),
+            round(width * coords[0]), round(width * coords[1]))
+
+
+def crop_shape(resolution: tuple[int, int], coords: tuple[float, float, float, float]) -> tuple[int, int]:
+    """(height, width) of the crop a frame at the given resolution yields for coords."""
+    y1, y2, x1, x2 = crop_bounds(resolution, coords)
+    return y2 - y1, x2 - x1
+
+
+def stat_crop_shapes(resolution: tuple[int, int], stat: Stat, layouts: Iterable[Layout] = tuple(Layout)) -> set[tuple[int, int]]:
+    """Every (height, width) a stat's crop takes across players and layouts. Rounding can make players differ by a pixel."""
+    return {crop_shape(resolution, coords[stat]) for layout in layouts for coords in LAYOUTS[layout].values()}
+
+
+def crop(frame, coords: tuple[float, float, float, float]):
+    """Slices the AOI described by coords out of frame, without copying."""
+    height, width = frame.shape[:2]
+    y1, y2, x1, x2 = crop_bounds((width, height), coords)
+    return frame[y1:y2, x1:x2]
+
+
+class AoiTable:
+    """
+    Integer pixel slices of every player's AOIs for one layout at one resolution.
+
+    Built once per device so that classifiers slice frames directly instead of re-deriving
+    bounds from the fractional coords on every call.
+    """
+
+    def __init__(self, crop_coords: dict[Player, dict[Stat, tuple[float, float, float, float]]],
+                 resolution: tuple[int, int]) -> None:
+        self.crop_coords = crop_coords
+        self.resolution = tuple(resolution)
+        self.slices = {}
+        for player, coords in crop_coords.items():
+            self.slices[player] = {}
+            for stat, stat_coords in coords.items():
+                y1, y2, x1, x2 = crop_bounds(self.resolution, stat_coords)
+                self.slices[player][stat] = (slice(y1, y2), slice(x1, x2))
+
+    @property
+    def players(self) -> list[Player]:
+        return list(self.slices)
+
+    def crop(self, frame, player: Player, stat: Stat):
+        rows, columns = self.slices[player][stat]
+        return frame[rows, columns]
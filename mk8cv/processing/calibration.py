@@ -0,0 +1,360 @@
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+from functools import partial
+from typing import Callable, Optional
+
+import cv2
+from cv2.typing import MatLike
+import numpy as np
+
+from mk8cv.data.state import Player, Stat
+from mk8cv.models.templates import TEMPLATES_ROOT, load_templates
+from mk8cv.processing.aois import LAYOUTS, REFERENCE_RESOLUTION, AoiTable, Layout, crop_bounds
+from mk8cv.processing.layout import detect_layout
+
+CALIBRATION_DIR = 'calibration'
+# Fraction of the frame around an expected AOI that is searched for the HUD element
+SEARCH_MARGIN = 0.04
+# Scales tried around the layout's expected HUD scale
+SEARCH_SCALES = np.linspace(0.85, 1.15, 7)
+MIN_MATCH_SCORE = 0.35
+# Frames between calibration attempts on a device; the frames in between use the nominal AOIs
+CALIBRATION_INTERVAL = 15
+# Attempts per device before falling back to the nominal AOIs for good
+MAX_CALIBRATION_ATTEMPTS = 20
+
+
+class HudCorrection:
+    """
+    Maps the nominal AOI fractions onto where a device actually draws the HUD.
+
+    Overscan and letterboxing shrink or grow the picture about some origin, so a corrected
+    coordinate is `scale * nominal + offset` on each axis, in fractions of the frame.
+    """
+
+    def __init__(self, scale: float = 1.0, offset_x: float = 0.0, offset_y: float = 0.0) -> None:
+        self.scale = scale
+        self.offset_x = offset_x
+        self.offset_y = offset_y
+
+    def apply(self, crop_coords: dict[Player, dict[Stat, tuple[float, float, float, float]]]
+              ) -> dict[Player, dict[Stat, tuple[float, float, float, float]]]:
+        return {player: {stat: (x1 * self.scale + self.offset_x, x2 * self.scale + self.offset_x,
+                                y1 * self.scale + self.offset_y, y2 * self.scale + self.offset_y)
+                         for stat, (x1, x2, y1, y2) in coords.items()}
+                for player, coords in crop_coords.items()}
+
+    def to_dict(self) -> dict[str, float]:
+        return {'scale': self.scale, 'offset_x': self.offset_x, 'offset_y': self.offset_y}
+
+    @staticmethod
+    def from_dict(data: dict[str, float]) -> 'HudCorrection':
+        return HudCorrection(data['scale'], data['offset_x'], data['offset_y'])
+
+    def __repr__(self):
+        return json.dumps(self.to_dict())
+
+
+def _locate_position(edges: MatLike, coords: tuple[float, float, float, float], templates: dict[str, MatLike],
+                     expected_scale: float) -> Optional[tuple[float, float, float, float]]:
+    """
+    Searches around a player's position AOI for the best matching position digit.
+
+    Returns the (center_x, center_y) of the match as fractions of the frame, the scale of the match
+    relative to expected_scale, and the match score; or None if nothing matched well enough.
+    """
+    height, width = edges.shape
+    y1, y2, x1, x2 = crop_bounds((width, height), (coords[0] - SEARCH_MARGIN, coords[1] + SEARCH_MARGIN,
+                                                   coords[2] - SEARCH_MARGIN, coords[3] + SEARCH_MARGIN))
+    y1, y2, x1, x2 = max(y1, 0), min(y2, height), max(x1, 0), min(x2, width)
+    window = edges[y1:y2, x1:x2]
+
+    best = None
+    for scale in SEARCH_SCALES * expected_scale:
+        fx = scale * width / REFERENCE_RESOLUTION[0]
+        fy = scale * height / REFERENCE_RESOLUTION[1]
+        for template in templates.values():
+            scaled = cv2.resize(template, None, fx=fx, fy=fy, interpolation=cv2.INTER_AREA)
+            if scaled.shape[0] > window.shape[0] or scaled.shape[1] > window.shape[1]:
+                continue
+            result = cv2.matchTemplate(window, scaled, cv2.TM_CCORR_NORMED)
+            _, score, _, location = cv2.minMaxLoc(result)
+            if best is None or score > best[3]:
+                center_x = (x1 + location[0] + scaled.shape[1] / 2) / width
+                center_y = (y1 + location[1] + scaled.shape[0] / 2) / height
+                best = (center_x, center_y, scale / expected_scale, score)
+
+    if best is None or best[3] < MIN_MATCH_SCORE:
+        return None
+    return best
+
+
+def calibrate(frame: MatLike, layout: Layout, templates: dict[str, MatLike] = None) -> Optional[HudCorrection]:
+    """
+    Locates the HUD in a frame by matching the position digit templates near each player's position AOI.
+
+    Returns None when fewer than half of the players' digits could be found (e.g. the frame is a menu),
+    in which case the caller should try again on a later frame.
+    """
+    if templates is None:
+        templates = load_templates(os.path.join(TEMPLATES_ROOT, 'position/edges'))
+
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    edges = cv2.Canny(cv2.convertScaleAbs(gray, alpha=1.5, beta=0), threshold1=50, threshold2=150)
+
+    # the templates were cut from 2P footage; other layouts draw the HUD at a different size
+    reference_height = LAYOUTS[Layout.TWO_PLAYER][Player.P1][Stat.POSITION]
+    reference_height = reference_height[3] - reference_height[2]
+
+    anchors = []
+    for player, coords in LAYOUTS[layout].items():
+        position = coords[Stat.POSITION]
+        expected_scale = (position[3] - position[2]) / reference_height
+        match = _locate_position(edges, position, templates, expected_scale)
+        if match is None:
+            continue
+        center_x, center_y, scale, _ = match
+        anchors.append(((position[0] + position[1]) / 2, (position[2] + position[3]) / 2, center_x, center_y, scale))
+
+    if not anchors or len(anchors) < len(LAYOUTS[layout]) / 2:
+        return None
+
+    scale = float(np.median([anchor[4] for anchor in anchors]))
+    offset_x = float(np.median([found_x - scale * expected_x for expected_x, _, found_x, _, _ in anchors]))
+    offset_y = float(np.median([found_y - scale * expected_y for _, expected_y, _, found_y, _ in anchors]))
+    return HudCorrection(scale, offset_x, offset_y)
+
+
+def _calibration_path(calibration_dir: str, device_id: int) -> str:
+    return os.path.join(calibration_dir, f'device_{device_id}.json')
+
+
+def save_calibration(calibration_dir: str, device_id: int, layout: Layout, correction: HudCorrection) -> None:
+    """Writes the device's correction and corrected AOI table, atomically so concurrent workers never read half a file."""
+    os.makedirs(calibration_dir, exist_ok=True)
+    path = _calibration_path(calibration_dir, device_id)
+    table = {
+        'layout': layout.value,
+        'correction': correction.to_dict(),
+        'crop_coords': {player.value: {stat.value: coords for stat, coords in stats.items()}
+                        for player, stats in correction.apply(LAYOUTS[layout]).items()},
+    }
+    with open(f'{path}.{os.getpid()}.tmp', 'w') as f:
+        json.dump(table, f, indent=2)
+    os.replace(f'{path}.{os.getpid()}.tmp', path)
+    logging.info(f"Saved calibration for device {device_id} to {path}: {correction}")
+
+
+def load_calibration(calibration_dir: str, device_id: int, layout: Layout
+                     ) -> Optional[dict[Player, dict[Stat, tuple[float, float, float, float]]]]:
+    """The device's cached AOI table, or None if it has not been calibrated for this layout."""
+    path = _calibration_path(calibration_dir, device_id)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        table = json.load(f)
+    if table['layout'] != layout.value:
+        logging.info(f"Ignoring calibration for device {device_id}: cached for {table['layout']}, running {layout.value}")
+        return None
+    return {Player(player): {Stat(stat): tuple(coords) for stat, coords in stats.items()}
+            for player, stats in table['crop_coords'].items()}
+
+
+class SharedDeviceAois:
+    """
+    The layout and calibration of every capture device, shared by the frame processors so each is worked out
+    once per device: the layout from whichever of its frames a processor handles first, so every processor
+    splits the device's players the same way, and the calibration by the first processor to need it, which
+    saves the table the others then load. Create it in the orchestrating process and pass it to the frame
+    processors.
+    """
+
+    _LAYOUTS = list(Layout)
+    # A device's calibration, from no processor having started it to done, or given up on
+    _UNCALIBRATED, _CALIBRATING, _CALIBRATED, _NOMINAL = range(4)
+
+    def __init__(self, num_devices: int) -> None:
+        self._lock = multiprocessing.Lock()
+        # the index of each device's layout in Layout, -1 until resolved
+        self._layouts = multiprocessing.Array('b', [-1] * num_devices, lock=False)
+        self._calibrations = multiprocessing.Array('b', [self._UNCALIBRATED] * num_devices, lock=False)
+
+    def layout(self, device_id: int, resolve: Callable[[], Layout]) -> Layout:
+        """The device's layout, calling resolve for it if no processor has yet."""
+        with self._lock:
+            index = self._layouts[device_id]
+            if index < 0:
+                layout = resolve()
+                self._layouts[device_id] = self._LAYOUTS.index(layout)
+                return layout
+            return self._LAYOUTS[index]
+
+    def claim(self, device_id: int) -> bool:
+        """Whether the caller is the first to calibrate the device, and should do so."""
+        with self._lock:
+            if self._calibrations[device_id] != self._UNCALIBRATED:
+                return False
+            self._calibrations[device_id] = self._CALIBRATING
+            return True
+
+    def finish(self, device_id: int, calibrated: bool) -> None:
+        """Marks the claimed device's calibration done, saved if calibrated or given up on otherwise."""
+        with self._lock:
+            self._calibrations[device_id] = self._CALIBRATED if calibrated else self._NOMINAL
+
+    def calibrated(self, device_id: int) -> Optional[bool]:
+        """Whether the device's calibration was saved, or None while it is still being calibrated."""
+        with self._lock:
+            calibration = self._calibrations[device_id]
+        return None if calibration == self._CALIBRATING else calibration == self._CALIBRATED
+
+
+class DeviceAois:
+    """
+    Resolves and caches the AoiTable of every capture device seen by a frame processor.
+
+    A device's layout comes from `layouts` (indexed by device_id, a single entry applies to all, None
+    means detect it from the first frame). Its AOIs come from the cached calibration in calibration_dir
+    when present; with calibrate set, an uncalibrated device is calibrated from its first frames that show
+    the HUD, and recalibrate ignores the cache. Calibration is attempted every CALIBRATION_INTERVAL frames,
+    and the device's nominal AoiTable is used until it succeeds. Processors sharing `shared` resolve each
+    device's layout once, and only the first to need a device's calibration runs it; the others use the
+    nominal AOIs until it is done, then load the table it saved.
+    """
+
+    def __init__(self, layouts: list[Optional[Layout]], calibration_dir: Optional[str] = None,
+                 calibrate: bool = False, recalibrate: bool = False, shared: SharedDeviceAois = None) -> None:
+        self._layouts = layouts or [Layout.TWO_PLAYER]
+        self._shared = shared
+        self._calibration_dir = calibration_dir or CALIBRATION_DIR
+        self._calibrate = calibrate or recalibrate
+        self._use_cache = not recalibrate
+        self._device_layouts: dict[int, Layout] = {}
+        self._tables: dict[int, AoiTable] = {}
+        self._nominal: dict[int, AoiTable] = {}  # devices still being calibrated
+        self._waiting: set[int] = set()  # devices another processor is calibrating
+        self._attempts: dict[int, int] = {}
+        self._since_attempt: dict[int, int] = {}
+        self._templates = None
+
+    def _resolve_layout(self, device_id: int, frame: MatLike) -> Layout:
+        layout = self._layouts[device_id] if device_id < len(self._layouts) else self._layouts[0]
+        if layout is None:
+            layout = detect_layout(frame)
+            logging.info(f"Detected {layout.value} layout for device {device_id}")
+        return layout
+
+    def _layout(self, device_id: int, frame: MatLike) -> Layout:
+        if device_id not in self._device_layouts:
+            resolve = partial(self._resolve_layout, device_id, frame)
+            self._device_layouts[device_id] = self._shared.layout(device_id, resolve) if self._shared else resolve()
+        return self._device_layouts[device_id]
+
+    def get(self, device_id: int, frame: MatLike) -> AoiTable:
+        table = self._tables.get(device_id)
+        if table is not None:
+            return table
+
+        nominal = self._nominal.get(device_id)
+        if nominal is not None:
+            self._since_attempt[device_id] += 1
+            if self._since_attempt[device_id] < CALIBRATION_INTERVAL:
+                return nominal
+            if device_id in self._waiting:
+                return self._collect(device_id, frame, nominal)
+            return self._attempt(device_id, frame, nominal)
+
+        layout = self._layout(device_id, frame)
+        resolution = (frame.shape[1], frame.shape[0])
+
+        crop_coords = load_calibration(self._calibration_dir, device_id, layout) if self._use_cache else None
+        if crop_coords is not None:
+            logging.info(f"Using cached calibration for device {device_id}")
+        elif self._calibrate:
+            nominal = self._nominal[device_id] = AoiTable(LAYOUTS[layout], resolution)
+            if self._shared is None or self._shared.claim(device_id):
+                return self._attempt(device_id, frame, nominal)
+            self._waiting.add(device_id)
+            return self._collect(device_id, frame, nominal)
+
+        self._tables[device_id] = AoiTable(crop_coords or LAYOUTS[layout], resolution)
+        return self._tables[device_id]
+
+    def _attempt(self, device_id: int, frame: MatLike, nominal: AoiTable) -> AoiTable:
+        """Tries to calibrate the device from this frame, returning its nominal AOIs until one succeeds."""
+        layout = self._device_layouts[device_id]
+        self._since_attempt[device_id] = 0
+        if self._templates is None:
+            self._templates = load_templates(os.path.join(TEMPLATES_ROOT, 'position/edges'))
+        correction = calibrate(frame, layout, self._templates)
+        if correction is not None:
+            save_calibration(self._calibration_dir, device_id, layout, correction)
+            table = AoiTable(correction.apply(LAYOUTS[layout]), (frame.shape[1], frame.shape[0]))
+        else:
+            self._attempts[device_id] = self._attempts.get(device_id, 0) + 1
+            if self._attempts[device_id] < MAX_CALIBRATION_ATTEMPTS:
+                return nominal
+            logging.warning(f"Could not calibrate device {device_id} in {MAX_CALIBRATION_ATTEMPTS} attempts, "
+                            f"using the nominal AOIs")
+            table = nominal
+
+        if self._shared is not None:
+            self._shared.finish(device_id, correction is not None)
+        del self._nominal[device_id]
+        self._tables[device_id] = table
+        return table
+
+    def _collect(self, device_id: int, frame: MatLike, nominal: AoiTable) -> AoiTable:
+        """Loads the table another processor saved for the device once it is done, until then the nominal AOIs."""
+        self._since_attempt[device_id] = 0
+        calibrated = self._shared.calibrated(device_id)
+        if calibrated is None:
+            return nominal
+        table = nominal
+        if calibrated:
+            crop_coords = load_calibration(self._calibration_dir, device_id, self._device_layouts[device_id])
+            if crop_coords is not None:
+                logging.info(f"Using the calibration another processor saved for device {device_id}")
+                table = AoiTable(crop_coords, (frame.shape[1], frame.shape[0]))
+
+        self._waiting.discard(device_id)
+        del self._nominal[device_id]
+        self._tables[device_id] = table
+        return table
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Calibrate a capture device's HUD AOIs from a video or live device")
+    parser.add_argument('--video-file', type=str,
+                        help='Video file recorded from the device (defaults to reading the live device)')
+    parser.add_argument('--device-id', type=int, default=0,
+                        help='Device to calibrate')
+    parser.add_argument('--layout', type=Layout, default=Layout.TWO_PLAYER, choices=list(Layout),
+                        help='Split-screen layout shown on the device')
+    parser.add_argument('--calibration-dir', type=str, default=CALIBRATION_DIR,
+                        help='Directory the per-device AOI tables are saved to')
+    parser.add_argument('--max-frames', type=int, default=600,
+                        help='Give up if no frame calibrates within this many frames')
+
+    logging.getLogger().setLevel(logging.INFO)
+    args = parser.parse_args()
+
+    cap = cv2.VideoCapture(args.video_file if args.video_file else args.device_id)
+    position_templates = load_templates(os.path.join(TEMPLATES_ROOT, 'position/edges'))
+    result = None
+    for _ in range(args.max_frames):
+        ret, frame = cap.read()
+        if not ret:
+            break
+        result = calibrate(frame, args.layout, position_templates)
+        if result is not None:
+            break
+    cap.release()
+
+    if result is None:
+        logging.error(f"Could not locate the HUD for device {args.device_id}")
+    else:
+        save_calibration(args.calibration_dir, args.device_id, args.layout, result)
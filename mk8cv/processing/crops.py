@@ -0,0 +1,56 @@
+from enum import Enum
+from typing import Optional
+
+import cv2
+from cv2.typing import MatLike
+
+from mk8cv.data.state import Player, Stat
+from mk8cv.processing.aois import AoiTable
+
+
+class ColorSpace(str, Enum):
+    BGR = 'bgr'
+    GRAY = 'gray'
+    HSV = 'hsv'
+    RGB = 'rgb'
+
+
+_CONVERSIONS = {
+    ColorSpace.GRAY: cv2.COLOR_BGR2GRAY,
+    ColorSpace.HSV: cv2.COLOR_BGR2HSV,
+    ColorSpace.RGB: cv2.COLOR_BGR2RGB,
+}
+
+
+class FrameCrops:
+    """
+    Every AOI of one frame, shared by all classifiers.
+
+    Crops are views into the frame. Each (resize, colour space) variant of a crop is computed the
+    first time a classifier asks for it and reused by everything else that needs it during the frame,
+    so no classifier repeats a slice, resize or cvtColor another one already did.
+    """
+
+    def __init__(self, frame: MatLike, aois: AoiTable) -> None:
+        self.frame = frame
+        self.aois = aois
+        self._cache: dict[tuple[Player, Stat, ColorSpace, Optional[tuple[int, int]]], MatLike] = {}
+
+    @property
+    def players(self) -> list[Player]:
+        return self.aois.players
+
+    def get(self, player: Player, stat: Stat, space: ColorSpace = ColorSpace.BGR,
+            size: Optional[tuple[int, int]] = None) -> MatLike:
+        """The player's stat crop, optionally resized to (width, height) first, in the given colour space."""
+        key = (player, stat, space, size)
+        crop = self._cache.get(key)
+        if crop is None:
+            if space != ColorSpace.BGR:
+                crop = cv2.cvtColor(self.get(player, stat, ColorSpace.BGR, size), _CONVERSIONS[space])
+            elif size is not None:
+                crop = cv2.resize(self.get(player, stat), size)
+            else:
+                crop = self.aois.crop(self.frame, player, stat)
+            self._cache[key] = crop
+        return crop
@@ -6,26 +6,37 @@ import time
 from multiprocessing import Event, Queue
 from queue import Empty
 from typing import Optional
-import random
 
 import cv2
 import redis
 
+from mk8cv.data.codec import Codec, DeltaEncoder
 from mk8cv.data.state import Player, StateMessage, Stat, PlayerState, Item
 from mk8cv.models.coin_classifier import CoinClassifier, SevenSegmentCoinClassifier
 from mk8cv.models.item_classifier import ItemClassifier, MobileNetV3ItemClassifier
 from mk8cv.models.lap_classifier import LapClassifier, SevenSegmentLapClassifier
 from mk8cv.models.position_classifier import PositionClassifier, CannyMaskPositionClassifier
-from mk8cv.processing.aois import CROP_COORDS
-from mk8cv.sinks.sink import SinkType, publish_to_redis
+from mk8cv.processing.aois import CROP_COORDS, AoiTable, Layout
+from mk8cv.processing.calibration import DeviceAois, SharedDeviceAois
+from mk8cv.processing.crops import FrameCrops
+from mk8cv.processing.races import RaceIds, first_race_id, hud_visible
+from mk8cv.sinks.background import BackgroundSink, OverflowPolicy
+from mk8cv.sinks.ipc import DEFAULT_SOCKET_PATH, SHM_RING_NAME, shm_ring_name, shm_ring_writer, unix_socket_writer
+from mk8cv.sinks.recording import recording_path, recording_writer
+from mk8cv.sinks.sink import STREAM_MAXLEN, PartitionKey, SinkType, redis_writer
 from mk8cv.utils.visualization import visualize
 
 
-def generateCrops(device_id: int, frame_count: int, frame: cv2.typing.MatLike, training_save_dir: str) -> None:
+# Per-player columns written by --write-csv, in order
+CSV_STAT_FIELDS = ['position', 'item1', 'item2', 'coins', 'lap_num', 'race_laps']
+
+
+def generateCrops(device_id: int, frame_count: int, frame: cv2.typing.MatLike, training_save_dir: str,
+                  crop_coords=CROP_COORDS) -> None:
     # formatted as "crop_nome" : (x1, x2, y1, y2)
     height, width, channels = frame.shape
 
-    for player, stat in CROP_COORDS.items():
+    for player, stat in crop_coords.items():
         for name, coords in stat.items():
             crop = frame[round(height * coords[2]): round(height * coords[3]),
                    round(width * coords[0]): round(width * coords[1])]
@@ -48,36 +59,44 @@ def process_frame(
         item_model: ItemClassifier = None,
         position_model: PositionClassifier = None,
         lap_model: LapClassifier = None,
+        aois: AoiTable = None,
+        capture_time: Optional[float] = None,
 ) -> StateMessage:
+    if aois is None:
+        aois = AoiTable(CROP_COORDS, (frame.shape[1], frame.shape[0]))
 
     if extract is None or not extract:
-        player1_state = PlayerState.generate_random_state()
-        player2_state = PlayerState.generate_random_state()
+        extract = []
+        states = {player: PlayerState.generate_random_state() for player in aois.players}
     else:
-        player1_state = PlayerState(-1, Item.NONE, Item.NONE, -1, -1, -1)
-        player2_state = PlayerState(-1, Item.NONE, Item.NONE, -1, -1, -1)
+        states = {player: PlayerState(-1, Item.NONE, Item.NONE, -1, -1, -1) for player in aois.players}
+
+    # every crop and colour conversion is computed once per frame and shared by the classifiers
+    crops = FrameCrops(frame, aois)
 
+    # each stat is extracted for every player on screen in one batched call
     if Stat.COINS in extract:
-        player1_state.coins = coin_model.extract_player_coins(frame, Player.P1)
-        player2_state.coins = coin_model.extract_player_coins(frame, Player.P2)
+        for player, coins in coin_model.extract_players_coins(crops).items():
+            states[player].coins = coins
 
     if Stat.LAP_NUM in extract or Stat.RACE_LAPS in extract:
-        player1_state.lap, player1_state.race_laps = lap_model.extract_laps(frame, Player.P1)
-        player2_state.lap, player2_state.race_laps = lap_model.extract_laps(frame, Player.P2)
+        for player, (lap, race_laps) in lap_model.extract_players_laps(crops).items():
+            states[player].lap, states[player].race_laps = lap, race_laps
 
     if Stat.ITEM1 in extract or Stat.ITEM2 in extract:
-        player1_state.item1, player1_state.item2 = item_model.extract_player_items(frame, Player.P1)
-        player2_state.item1, player2_state.item2 = item_model.extract_player_items(frame, Player.P2)
+        for player, (item1, item2) in item_model.extract_players_items(crops).items():
+            states[player].item1, states[player].item2 = item1, item2
 
     if Stat.POSITION in extract:
-        player1_state.position = position_model.extract_player_position(frame, Player.P1)
-        player2_state.position = position_model.extract_player_position(frame, Player.P2)
+        for player, position in position_model.extract_players_position(crops).items():
+            states[player].position = position
 
-    return StateMessage(device_id, frame_count, race_id, player1_state, player2_state)
+    return StateMessage(device_id, frame_count, race_id, *states.values(), capture_time=capture_time)
 
 
-def load_models(extract: list[Stat]) -> tuple[
+def load_models(extract: list[Stat], resolution: tuple[int, int] = None) -> tuple[
     Optional[CoinClassifier], Optional[ItemClassifier], Optional[PositionClassifier], Optional[LapClassifier]]:
+    """Loads the classifiers for the requested stats, specialising any templates to the pipeline resolution."""
     coin_model, item_model, position_model, lap_model = None, None, None, None
 
     if Stat.ITEM1 in extract or Stat.ITEM2 in extract:
@@ -87,15 +106,15 @@ def load_models(extract: list[Stat]) -> tuple[
 
     if Stat.RACE_LAPS in extract or Stat.LAP_NUM in extract:
         lap_model = SevenSegmentLapClassifier()
-        lap_model.load()
+        lap_model.load(resolution=resolution)
 
     if Stat.POSITION in extract:
         position_model = CannyMaskPositionClassifier()
-        position_model.load()
+        position_model.load(resolution=resolution)
 
     if Stat.COINS in extract:
         coin_model = SevenSegmentCoinClassifier()
-        coin_model.load()
+        coin_model.load(resolution=resolution)
 
     return coin_model, item_model, position_model, lap_model
 
@@ -109,79 +128,127 @@ def process_frames(
         write_csv: bool = False,
         sink_type: SinkType = SinkType.REDIS,
         extract: list[Stat] = None,
+        resolution: tuple[int, int] = None,
+        layouts: list[Optional[Layout]] = None,
+        calibration_dir: str = None,
+        calibrate: bool = False,
+        recalibrate: bool = False,
+        codec: Codec = Codec.DELTA,
+        keyframe_interval: int = 120,
+        keyframe_seconds: float = 2.0,
+        stream_partitions: int = 1,
+        partition_by: PartitionKey = PartitionKey.DEVICE,
+        stream_maxlen: int = STREAM_MAXLEN,
+        sink_buffer: int = 4096,
+        sink_batch_size: int = 64,
+        overflow: OverflowPolicy = OverflowPolicy.BLOCK,
+        spill_path: str = None,
+        socket_path: str = DEFAULT_SOCKET_PATH,
+        worker_id: int = 0,
+        state_queue: Queue = None,
+        record_path: str = None,
+        race_ids: RaceIds = None,
+        shared_aois: SharedDeviceAois = None,
 ) -> None:
+    """
+    Pulls frames off process_queue until stop_event is set, extracting and publishing every player's state.
+
+    layouts holds the split-screen layout of each capture device, indexed by device_id; a single entry applies
+    to every device and None means detect it from the device's first frame, once for every processor sharing
+    shared_aois. See DeviceAois for how the calibration arguments pick each device's AOIs. With the delta codec, each device's messages carry only the
+    fields that changed, plus a keyframe every keyframe_interval frames or keyframe_seconds seconds. The stream
+    sink spreads messages over stream_partitions streams by partition_by, each capped at about stream_maxlen entries.
+    Messages are written by a BackgroundSink holding up to sink_buffer messages, see it for the overflow policies.
+    The unix socket sink sends to socket_path, and the shared memory sink writes to this worker's own ring. The
+    SQLite sink hands the messages, undecoded, to the embedded aggregator reading state_queue. With record_path,
+    every message is also appended to this worker's own recording, for the aggregator to replay; the recording
+    drops its oldest buffered messages when it cannot keep up, whatever the overflow policy.
+    With race_ids, shared by every processor, each frame's race is detected from the HUD and frames captured
+    between races are not published; otherwise every frame belongs to race_id.
+    """
     logging.getLogger().setLevel(logging.INFO)
     logging.info("Starting frame processor...")
     logging.info(f'extract: {extract}')
     if extract is None:
         extract = [stat for stat in Stat]
+    delta_encoder = DeltaEncoder(keyframe_interval, keyframe_seconds) if codec == Codec.DELTA else None
     match sink_type:
         case SinkType.REDIS:
             logging.info('Sink type: Redis')
-            sink = redis.Redis()
+            writer = redis_writer(redis.Redis(), sink_type, "mario_kart_states", codec, delta_encoder)
+        case SinkType.REDIS_STREAM:
+            logging.info(f'Sink type: Redis stream ({stream_partitions} partitions by {partition_by.value})')
+            writer = redis_writer(redis.Redis(), sink_type, "mario_kart_states", codec, delta_encoder,
+                                  stream_partitions, partition_by, stream_maxlen)
+        case SinkType.UNIX_SOCKET:
+            logging.info(f'Sink type: unix socket ({socket_path})')
+            writer = unix_socket_writer(socket_path, codec, delta_encoder)
+        case SinkType.SHARED_MEMORY:
+            ring = shm_ring_name(SHM_RING_NAME, worker_id)
+            logging.info(f'Sink type: shared memory ring ({ring})')
+            writer = shm_ring_writer(ring, codec, delta_encoder)
+        case SinkType.SQLITE:
+            logging.info('Sink type: embedded aggregator writing to SQLite')
+            writer = state_queue.put
         case _:
-            sink = None
+            writer = None
+    sink = BackgroundSink(writer, sink_buffer, sink_batch_size, overflow, spill_path) if writer is not None else None
+    recorder = None
+    if record_path:
+        logging.info(f'Recording to {recording_path(record_path, worker_id)}')
+        # a slow disk must not stall inference, so the recording drops its oldest messages rather than block
+        recorder = BackgroundSink(recording_writer(recording_path(record_path, worker_id)), sink_buffer,
+                                  sink_batch_size, OverflowPolicy.DROP_OLDEST)
 
     if race_id is None:
-        race_id = random.randint(0,10000)  # TODO: decide how this should be determined and coordinated across frame processors + webapp
+        race_id = first_race_id()
 
     start_time = time.time()
     frames_processed = 0
 
-    coin_model, item_model, position_model, lap_model = load_models(extract)
+    coin_model, item_model, position_model, lap_model = load_models(extract, resolution)
+
+    device_aois = DeviceAois(layouts, calibration_dir, calibrate, recalibrate, shared_aois)
 
     with open('item_annotations.csv', 'w') as f:
-        fieldnames = [
-            'frame_number',
-            'player1_position',
-            'player1_item1',
-            'player1_item2',
-            'player1_coins',
-            'player1_lap_num',
-            'player1_race_laps',
-            'player2_position',
-            'player2_item1',
-            'player2_item2',
-            'player2_coins',
-            'player2_lap_num',
-            'player2_race_laps'
-        ]
+        fieldnames = ['frame_number'] + [f'player{i}_{field}'
+                                         for i in range(1, len(Player) + 1) for field in CSV_STAT_FIELDS]
         csvwriter = csv.DictWriter(f, fieldnames=fieldnames)
         csvwriter.writeheader()
         logging.info('Starting frame processing loop...')
         while not stop_event.is_set():
             try:
-                device_id, frame_count, frame = process_queue.get(timeout=1)
+                device_id, frame_count, capture_time, frame = process_queue.get(timeout=1)
+                aois = device_aois.get(device_id, frame)
                 state_message = process_frame(race_id, device_id, frame_count, frame, extract, coin_model, item_model,
-                                              position_model, lap_model)
-
-                player1_state = state_message.player1_state
-                player2_state = state_message.player2_state
+                                              position_model, lap_model, aois, capture_time)
+                if race_ids is not None:
+                    state_message.race_id = race_ids.race_for(
+                        device_id, capture_time if capture_time is not None else time.time(),
+                        hud_visible(state_message.player_states))
 
                 if write_csv:
-                    csvrowdict = {
-                        'frame_number': state_message.frame_number,
-                        'player1_position': player1_state.position,
-                        'player1_item1': player1_state.item1,
-                        'player1_item2': player1_state.item2,
-                        'player1_coins': player1_state.coins,
-                        'player1_lap_num': player1_state.lap,
-                        'player1_race_laps': player1_state.race_laps,
-                        'player2_position': player2_state.position,
-                        'player2_item1': player2_state.item1,
-                        'player2_item2': player2_state.item2,
-                        'player2_coins': player2_state.coins,
-                        'player2_lap_num': player2_state.lap,
-                        'player2_race_laps': player2_state.race_laps
-                    }
+                    csvrowdict = {'frame_number': state_message.frame_number}
+                    for i, player_state in enumerate(state_message.player_states, start=1):
+                        csvrowdict.update({
+                            f'player{i}_position': player_state.position,
+                            f'player{i}_item1': player_state.item1,
+                            f'player{i}_item2': player_state.item2,
+                            f'player{i}_coins': player_state.coins,
+                            f'player{i}_lap_num': player_state.lap,
+                            f'player{i}_race_laps': player_state.race_laps
+                        })
                     csvwriter.writerow(csvrowdict)
 
                 # Choose one of the following based on your chosen method:
-                match sink_type:
-                    case SinkType.REDIS:
-                        publish_to_redis(sink, "mario_kart_states", state_message)
-                    case _:
-                        logging.debug("state_message: %s", json.dumps(state_message, default=str))
+                if state_message.race_id is None:
+                    logging.debug(f"Frame {frame_count} of device {device_id} is between races, not publishing it")
+                elif sink is not None:
+                    sink.put(state_message)
+                else:
+                    logging.debug("state_message: %s", json.dumps(state_message, default=str))
+                if recorder is not None and state_message.race_id is not None:
+                    recorder.put(state_message)
 
                 frames_processed += 1
                 elapsed_time = time.time() - start_time
@@ -194,15 +261,12 @@ def process_frames(
                 logging.debug(f"Processed and published frame {frame_count} from device {device_id}")
                 if training_save_dir:
                     generateCrops(device_id=device_id, frame_count=frame_count, frame=frame,
-                                  training_save_dir=training_save_dir)
+                                  training_save_dir=training_save_dir, crop_coords=aois.crop_coords)
 
-                states = {
-                    Player.P1: player1_state,
-                    Player.P2: player2_state
-                }
+                states = dict(zip(Player, state_message.player_states))
 
                 if display:
-                    visualize(frame, states, device_id, stop_event)
+                    visualize(frame, states, device_id, stop_event, aois.crop_coords)
 
             except Empty:
                 logging.info("Queue is empty. Waiting for frames...")
@@ -211,3 +275,8 @@ def process_frames(
             except Exception as e:
                 logging.error(f"Error processing frame: {e}")
                 continue
+
+    if sink is not None:
+        sink.close()
+    if recorder is not None:
+        recorder.close()
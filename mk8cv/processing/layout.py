@@ -0,0 +1,37 @@
+import cv2
+from cv2.typing import MatLike
+import numpy as np
+
+from mk8cv.processing.aois import Layout
+
+# A split-screen divider is a thin, dark, flat line through the middle of the frame
+DIVIDER_MAX_MEAN = 40
+DIVIDER_MAX_STD = 15
+DIVIDER_HALF_WIDTH = 0.002
+
+
+def _is_divider(strip: MatLike) -> bool:
+    return np.mean(strip) < DIVIDER_MAX_MEAN and np.std(strip) < DIVIDER_MAX_STD
+
+
+def detect_layout(frame: MatLike) -> Layout:
+    """
+    Guesses the split-screen layout of a frame from the dividers between the player views.
+
+    A vertical divider alone means 2P and a vertical plus horizontal divider means a 2x2 grid. 3P and
+    4P share the grid and cannot be told apart this way, so a grid is reported as 4P; configure 3P
+    setups explicitly.
+    """
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    height, width = gray.shape
+    half_x = max(1, round(width * DIVIDER_HALF_WIDTH))
+    half_y = max(1, round(height * DIVIDER_HALF_WIDTH))
+
+    vertical = _is_divider(gray[:, width // 2 - half_x: width // 2 + half_x])
+    horizontal = _is_divider(gray[height // 2 - half_y: height // 2 + half_y, :])
+
+    if vertical and horizontal:
+        return Layout.FOUR_PLAYER
+    if vertical:
+        return Layout.TWO_PLAYER
+    return Layout.ONE_PLAYER
@@ -0,0 +1,110 @@
+import logging
+import math
+import multiprocessing
+import time
+from typing import Callable, Optional
+
+from mk8cv.data.state import PlayerState
+
+# Seconds without a lap counter on screen after which a device's race is over
+RACE_END_GAP = 5.0
+# Devices starting a race within this many seconds of each other are in the same race
+RACE_JOIN_WINDOW = 30.0
+
+# Fields of a device's slot in the shared array
+_RACE, _START, _LAST_HUD, _ACTIVE, _PREVIOUS_RACE, _PREVIOUS_END = range(6)
+_DEVICE_FIELDS = 6
+# The venue's latest race: its id and capture time, and the next id to allocate without an allocator
+_VENUE_RACE, _VENUE_START, _NEXT_RACE = range(3)
+
+
+def first_race_id() -> int:
+    """
+    A first race id later than any an earlier run allocated: one per minute since the epoch. A race takes
+    longer than a minute, so a run never allocates ids faster than minutes pass, and the ids fit the codecs' i32.
+    Setups started in the same minute get the same id, so ids shared between setups come from the sink's
+    allocator (see mk8cv.sinks.sink.RedisRaceIds), which starts from this.
+    """
+    return int(time.time() // 60)
+
+
+def hud_visible(player_states: tuple[PlayerState, ...]) -> bool:
+    """Whether a frame shows the race HUD, i.e. any player's lap counter was read."""
+    return any(state.lap is not None and state.lap > 0 for state in player_states)
+
+
+class RaceIds:
+    """
+    Race ids for every frame processor, allocated from one counter in shared memory and advanced by watching
+    the race HUD come and go.
+
+    A device is in a race from the first frame showing a lap counter until RACE_END_GAP seconds of capture time
+    pass without one (the results and menus that follow have none). The devices of a venue race together, so a
+    device starting a race within RACE_JOIN_WINDOW seconds of another joins its race; otherwise the next id is
+    allocated, by allocate when given (one shared by every setup of the venue, so their ids never collide) and
+    otherwise from first_id on. Frames are judged by capture time, so frames of a device handled out of order by
+    different processors still land in the right race, and frames between races get no race. Create it in the
+    orchestrating process and pass it to the frame processors.
+    """
+
+    def __init__(self, num_devices: int, first_id: Optional[int] = None, end_gap: float = RACE_END_GAP,
+                 join_window: float = RACE_JOIN_WINDOW, allocate: Callable[[], int] = None) -> None:
+        self.num_devices = num_devices
+        self.end_gap = end_gap
+        self.join_window = join_window
+        self.allocate = allocate
+        self._lock = multiprocessing.Lock()
+        # doubles hold every id an i32 can, and NaN for none
+        self._devices = multiprocessing.Array('d', [math.nan, math.nan, -math.inf, 0.0, math.nan, -math.inf]
+                                              * num_devices, lock=False)
+        self._venue = multiprocessing.Array('d', [math.nan, -math.inf, first_id if first_id is not None
+                                                  else first_race_id()], lock=False)
+
+    @staticmethod
+    def _id(value: float) -> Optional[int]:
+        return None if math.isnan(value) else int(value)
+
+    def _start_race(self, slot: int, capture_time: float) -> None:
+        devices, venue = self._devices, self._venue
+        if math.isnan(venue[_VENUE_RACE]) or capture_time - venue[_VENUE_START] > self.join_window \
+                or venue[_VENUE_RACE] == devices[slot + _PREVIOUS_RACE]:
+            if self.allocate is not None:
+                venue[_VENUE_RACE] = self.allocate()
+            else:
+                venue[_VENUE_RACE] = venue[_NEXT_RACE]
+                venue[_NEXT_RACE] += 1
+            venue[_VENUE_START] = capture_time
+            logging.info(f"Race {int(venue[_VENUE_RACE])} started on device {slot // _DEVICE_FIELDS}")
+        else:
+            logging.info(f"Device {slot // _DEVICE_FIELDS} joined race {int(venue[_VENUE_RACE])}")
+        devices[slot + _RACE] = venue[_VENUE_RACE]
+        devices[slot + _START] = capture_time
+        devices[slot + _LAST_HUD] = capture_time
+        devices[slot + _ACTIVE] = 1.0
+
+    def race_for(self, device_id: int, capture_time: float, hud: bool) -> Optional[int]:
+        """The race a device's frame belongs to, or None if it was captured between races."""
+        slot = device_id * _DEVICE_FIELDS
+        devices = self._devices
+        with self._lock:
+            active = devices[slot + _ACTIVE] > 0
+            if active and capture_time >= devices[slot + _START]:
+                if hud:
+                    devices[slot + _LAST_HUD] = max(devices[slot + _LAST_HUD], capture_time)
+                elif capture_time - devices[slot + _LAST_HUD] >= self.end_gap:
+                    devices[slot + _PREVIOUS_RACE] = devices[slot + _RACE]
+                    devices[slot + _PREVIOUS_END] = devices[slot + _LAST_HUD]
+                    devices[slot + _ACTIVE] = 0.0
+                    logging.info(f"Race {int(devices[slot + _RACE])} finished on device {device_id}")
+                    return None
+                return self._id(devices[slot + _RACE])
+            # a frame from before the device's current race started, handled late by another processor
+            if active:
+                return self._id(devices[slot + _PREVIOUS_RACE]) if capture_time <= devices[
+                    slot + _PREVIOUS_END] + self.end_gap else None
+            if capture_time <= devices[slot + _PREVIOUS_END]:
+                return self._id(devices[slot + _PREVIOUS_RACE])
+            if hud:
+                self._start_race(slot, capture_time)
+                return self._id(devices[slot + _RACE])
+            return None
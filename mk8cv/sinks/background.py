@@ -0,0 +1,188 @@
+import logging
+import os
+import struct
+import tempfile
+import threading
+import time
+from collections import deque
+from enum import Enum
+from typing import Callable, Optional
+
+from mk8cv.data.codec import Codec, decode_state_message, encode_state_message
+from mk8cv.data.state import StateMessage
+
+# Spilled messages are binary-encoded, each prefixed by its length
+_SPILL_LENGTH = struct.Struct('<I')
+# Longest wait between retries of a batch the sink failed to write
+MAX_RETRY_DELAY = 5.0
+
+
+class OverflowPolicy(str, Enum):
+    BLOCK = 'block'
+    DROP_OLDEST = 'drop-oldest'
+    SPILL = 'spill'
+
+
+class BackgroundSink:
+    """
+    Hands state messages to a sink writer on a background thread, so a slow or unreachable sink never stalls
+    frame processing.
+
+    Messages wait in a buffer of at most max_buffer messages and are passed to write in batches of up to
+    batch_size, in the order they were put. A batch that fails to write is retried with backoff. When the buffer
+    is full, put either blocks until there is room, drops the oldest buffered message, or spills new messages
+    to a file that is replayed, still in order, once the buffer drains. A writer with a close attribute is
+    closed once the sink has flushed.
+    """
+
+    def __init__(self, write: Callable[[list[StateMessage]], None], max_buffer: int = 4096, batch_size: int = 64,
+                 overflow: OverflowPolicy = OverflowPolicy.BLOCK, spill_path: Optional[str] = None,
+                 stats_interval: float = 10.0) -> None:
+        self._write = write
+        self.max_buffer = max_buffer
+        self.batch_size = batch_size
+        self.overflow = overflow
+        self.spill_path = spill_path or os.path.join(tempfile.gettempdir(), f'mk8cv-sink-{os.getpid()}.spill')
+        self.stats_interval = stats_interval
+
+        self._buffer: deque[StateMessage] = deque()
+        self._condition = threading.Condition()
+        self._closed = False
+        self._spill_file = None
+        self._spilled_pending = 0
+
+        self.flushed = 0
+        self.dropped = 0
+        self.spilled = 0
+        self._flush_count = 0
+        self._flush_seconds = 0.0
+        self._max_flush_seconds = 0.0
+
+        self._thread = threading.Thread(target=self._run, name='background-sink', daemon=True)
+        self._thread.start()
+
+    def put(self, message: StateMessage) -> None:
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("put on a closed BackgroundSink")
+            # once spilling, keep spilling until the file is replayed so messages stay in order
+            if self._spill_file is not None:
+                self._spill(message)
+            elif len(self._buffer) >= self.max_buffer:
+                match self.overflow:
+                    case OverflowPolicy.BLOCK:
+                        self._condition.wait_for(lambda: len(self._buffer) < self.max_buffer or self._closed)
+                        self._buffer.append(message)
+                    case OverflowPolicy.DROP_OLDEST:
+                        self._buffer.popleft()
+                        self.dropped += 1
+                        self._buffer.append(message)
+                    case OverflowPolicy.SPILL:
+                        logging.warning(f"Sink buffer full, spilling messages to {self.spill_path}")
+                        self._spill_file = open(self.spill_path, 'ab')
+                        self._spill(message)
+            else:
+                self._buffer.append(message)
+            self._condition.notify_all()
+
+    def _spill(self, message: StateMessage) -> None:
+        data = encode_state_message(message, Codec.BINARY)
+        self._spill_file.write(_SPILL_LENGTH.pack(len(data)) + data)
+        self._spilled_pending += 1
+        self.spilled += 1
+
+    def _unspill(self) -> None:
+        """Moves spilled messages back into the buffer; called with the lock held once the buffer is empty."""
+        self._spill_file.close()
+        self._spill_file = None
+        with open(self.spill_path, 'rb') as f:
+            data = f.read()
+        os.remove(self.spill_path)
+        offset = 0
+        while offset < len(data):
+            (length,) = _SPILL_LENGTH.unpack_from(data, offset)
+            offset += _SPILL_LENGTH.size
+            self._buffer.append(decode_state_message(data[offset:offset + length]))
+            offset += length
+        logging.info(f"Replaying {self._spilled_pending} spilled messages")
+        self._spilled_pending = 0
+
+    @property
+    def depth(self) -> int:
+        return len(self._buffer) + self._spilled_pending
+
+    def stats(self) -> dict[str, float]:
+        return {
+            'depth': self.depth,
+            'flushed': self.flushed,
+            'dropped': self.dropped,
+            'spilled': self.spilled,
+            'avg_flush_ms': 1000 * self._flush_seconds / self._flush_count if self._flush_count else 0.0,
+            'max_flush_ms': 1000 * self._max_flush_seconds,
+        }
+
+    def _next_batch(self) -> Optional[list[StateMessage]]:
+        with self._condition:
+            self._condition.wait_for(lambda: self._buffer or self._spill_file is not None or self._closed,
+                                     timeout=self.stats_interval)
+            if not self._buffer and self._spill_file is not None:
+                self._unspill()
+            if not self._buffer:
+                return None if self._closed else []
+            return [self._buffer[i] for i in range(min(self.batch_size, len(self._buffer)))]
+
+    def _run(self) -> None:
+        retry_delay = 0.1
+        last_stats = time.monotonic()
+        batch = None
+        while True:
+            # a failed batch is retried as is, so writers can tell a retry from a new batch
+            if not batch:
+                batch = self._next_batch()
+            if batch is None:
+                break
+            if batch:
+                start = time.perf_counter()
+                try:
+                    self._write(batch)
+                except Exception as e:
+                    logging.error(f"Sink write of {len(batch)} messages failed, retrying in {retry_delay:.1f}s: {e}")
+                    time.sleep(retry_delay)
+                    retry_delay = min(retry_delay * 2, MAX_RETRY_DELAY)
+                    continue
+                retry_delay = 0.1
+                elapsed = time.perf_counter() - start
+                self._flush_count += 1
+                self._flush_seconds += elapsed
+                self._max_flush_seconds = max(self._max_flush_seconds, elapsed)
+
+                with self._condition:
+                    # drop-oldest may have already discarded some of the batch while it was being written
+                    for message in batch:
+                        if self._buffer and self._buffer[0] is message:
+                            self._buffer.popleft()
+                    self.flushed += len(batch)
+                    self._condition.notify_all()
+                batch = None
+
+            if time.monotonic() - last_stats >= self.stats_interval:
+                stats = self.stats()
+                logging.info(f"Sink buffer depth {stats['depth']}/{self.max_buffer}, flushed {stats['flushed']}, "
+                             f"dropped {stats['dropped']}, spilled {stats['spilled']}, flush latency "
+                             f"avg {stats['avg_flush_ms']:.1f}ms max {stats['max_flush_ms']:.1f}ms")
+                self._flush_count = 0
+                self._flush_seconds = 0.0
+                self._max_flush_seconds = 0.0
+                last_stats = time.monotonic()
+
+    def close(self, timeout: float = 10.0) -> None:
+        """Flushes everything still buffered or spilled, giving up after timeout seconds."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            # still writing, so the writer is left open under it
+            logging.warning(f"Sink closed with {self.depth} messages unflushed")
+        elif hasattr(self._write, 'close'):
+            self._write.close()
@@ -0,0 +1,202 @@
+import logging
+import os
+import socket
+import struct
+import tempfile
+from multiprocessing import resource_tracker, shared_memory
+from typing import Callable, Iterable
+
+from mk8cv.data.codec import BatchEncoder, Codec, DeltaEncoder
+from mk8cv.data.state import StateMessage
+
+DEFAULT_SOCKET_PATH = os.path.join(tempfile.gettempdir(), 'mk8cv_states.sock')
+SHM_RING_NAME = 'mk8cv_states'
+SHM_RING_SIZE = 1 << 20
+# Largest datagram unix_socket_writer sends and the unix socket source reads; larger batches are split
+MAX_DATAGRAM = 1 << 16
+
+# Records in a datagram or ring are length-prefixed encoded state messages
+_RECORD = struct.Struct('<I')
+# A length that tells the ring reader the rest of the buffer is unused and the next record starts at 0
+_WRAP = 0xFFFFFFFF
+
+
+def pack_records(records: Iterable[bytes]) -> bytes:
+    return b''.join(_RECORD.pack(len(record)) + record for record in records)
+
+
+def unpack_records(data: bytes) -> list[bytes]:
+    records = []
+    offset = 0
+    while offset < len(data):
+        (length,) = _RECORD.unpack_from(data, offset)
+        offset += _RECORD.size
+        records.append(bytes(data[offset:offset + length]))
+        offset += length
+    return records
+
+
+def pack_datagrams(records: Iterable[bytes], max_size: int = MAX_DATAGRAM) -> list[bytes]:
+    """Packs records into as few datagrams of at most max_size bytes as they fit in, keeping their order."""
+    datagrams = []
+    current = []
+    size = 0
+    for record in records:
+        record_size = _RECORD.size + len(record)
+        if record_size > max_size:
+            logging.error(f"Dropping a {len(record)} byte record, too large for a {max_size} byte datagram")
+            continue
+        if size + record_size > max_size:
+            datagrams.append(pack_records(current))
+            current = []
+            size = 0
+        current.append(record)
+        size += record_size
+    if current:
+        datagrams.append(pack_records(current))
+    return datagrams
+
+
+def unix_socket_writer(path: str = DEFAULT_SOCKET_PATH, codec: Codec = Codec.BINARY,
+                       delta_encoder: DeltaEncoder = None) -> Callable[[list[StateMessage]], None]:
+    """
+    A BackgroundSink writer sending each batch to the UnixSocketSource bound at path, in datagrams of at most
+    MAX_DATAGRAM bytes.
+
+    Unix datagram sockets are reliable and keep message boundaries, and a send blocks rather than drops while
+    the aggregator's receive buffer is full. Sending fails while no aggregator is bound, and the sink retries;
+    a retried batch resumes after the datagrams already sent, so none is delivered twice.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    encoder = BatchEncoder(codec, delta_encoder)
+    records = None
+    unsent: list[bytes] = []
+
+    def write(batch: list[StateMessage]) -> None:
+        nonlocal records, unsent
+        encoded = encoder.encode(batch)
+        if encoded is not records:
+            records = encoded
+            unsent = pack_datagrams(encoded)
+        while unsent:
+            sock.sendto(unsent[0], path)
+            unsent.pop(0)
+    return write
+
+
+class ShmRing:
+    """
+    A single-producer, single-consumer ring of length-prefixed records in a named shared memory segment.
+
+    The producer only ever advances the write position and the consumer the read position, each a monotonically
+    increasing byte count in its own cache line of the header, so neither side needs a lock. The consumer owns
+    the segment: it creates it and leaves it in place when it stops, so a restarted consumer resumes from where
+    the previous one stopped reading. Call unlink to remove it.
+    """
+
+    _HEADER_SIZE = 128
+    _WRITE_OFFSET = 0
+    _READ_OFFSET = 64
+    _CAPACITY_OFFSET = 8
+    _POSITION = struct.Struct('<Q')
+
+    def __init__(self, name: str, size: int = SHM_RING_SIZE, create: bool = False) -> None:
+        try:
+            self._shm = shared_memory.SharedMemory(name, create=create, size=self._HEADER_SIZE + size if create else 0)
+            if create:
+                self._shm.buf[:self._HEADER_SIZE] = bytes(self._HEADER_SIZE)
+                self._POSITION.pack_into(self._shm.buf, self._CAPACITY_OFFSET, size)
+        except FileExistsError:
+            self._shm = shared_memory.SharedMemory(name)
+        # the segment outlives this process, so stop the resource tracker unlinking it at exit
+        resource_tracker.unregister(self._shm._name, 'shared_memory')
+        self.name = name
+        self.capacity = self._POSITION.unpack_from(self._shm.buf, self._CAPACITY_OFFSET)[0]
+        self._data = self._shm.buf[self._HEADER_SIZE:self._HEADER_SIZE + self.capacity]
+
+    def _position(self, offset: int) -> int:
+        return self._POSITION.unpack_from(self._shm.buf, offset)[0]
+
+    def _set_position(self, offset: int, value: int) -> None:
+        self._POSITION.pack_into(self._shm.buf, offset, value)
+
+    def write(self, records: list[bytes]) -> None:
+        """Appends every record, or none of them with BufferError if they do not all fit."""
+        write = self._position(self._WRITE_OFFSET)
+        free = self.capacity - (write - self._position(self._READ_OFFSET))
+        needed = 0
+        position = write
+        for record in records:
+            size = _RECORD.size + len(record)
+            index = position % self.capacity
+            if index + size > self.capacity:
+                # the record would straddle the end, so skip to the start and leave a wrap marker
+                needed += self.capacity - index
+                position += self.capacity - index
+            needed += size
+            position += size
+        if needed > free:
+            raise BufferError(f"Shared memory ring {self.name} is full ({free} of {self.capacity} bytes free)")
+
+        position = write
+        for record in records:
+            index = position % self.capacity
+            size = _RECORD.size + len(record)
+            if index + size > self.capacity:
+                if self.capacity - index >= _RECORD.size:
+                    _RECORD.pack_into(self._data, index, _WRAP)
+                position += self.capacity - index
+                index = 0
+            _RECORD.pack_into(self._data, index, len(record))
+            self._data[index + _RECORD.size:index + size] = record
+            position += size
+        # publish the records only once they are completely written
+        self._set_position(self._WRITE_OFFSET, position)
+
+    def read(self, max_records: int = 1024) -> list[bytes]:
+        """Removes and returns up to max_records records, oldest first."""
+        read = self._position(self._READ_OFFSET)
+        write = self._position(self._WRITE_OFFSET)
+        records = []
+        while read < write and len(records) < max_records:
+            index = read % self.capacity
+            if self.capacity - index < _RECORD.size or _RECORD.unpack_from(self._data, index)[0] == _WRAP:
+                read += self.capacity - index
+                continue
+            (length,) = _RECORD.unpack_from(self._data, index)
+            records.append(bytes(self._data[index + _RECORD.size:index + _RECORD.size + length]))
+            read += _RECORD.size + length
+        self._set_position(self._READ_OFFSET, read)
+        return records
+
+    def close(self) -> None:
+        self._data.release()
+        self._shm.close()
+
+    def unlink(self) -> None:
+        # SharedMemory.unlink unregisters the segment from the resource tracker, which __init__ already did
+        resource_tracker.register(self._shm._name, 'shared_memory')
+        self._shm.unlink()
+
+
+def shm_ring_name(name: str, ring: int) -> str:
+    return f'{name}_{ring}'
+
+
+def shm_ring_writer(name: str, codec: Codec = Codec.BINARY,
+                    delta_encoder: DeltaEncoder = None) -> Callable[[list[StateMessage]], None]:
+    """
+    A BackgroundSink writer appending each batch to the shared memory ring called name.
+
+    Every producer needs a ring of its own (see shm_ring_name). Writing fails until the aggregator has created
+    the ring, and while the ring is full, and the sink retries.
+    """
+    ring = None
+    encoder = BatchEncoder(codec, delta_encoder)
+
+    def write(batch: list[StateMessage]) -> None:
+        nonlocal ring
+        if ring is None:
+            ring = ShmRing(name)
+        ring.write(encoder.encode(batch))
+    return write
@@ -0,0 +1,87 @@
+import heapq
+import logging
+import os
+import struct
+import zlib
+from typing import BinaryIO, Callable, Iterator
+
+from mk8cv.data.codec import Codec, decode_state_message, encode_state_message
+from mk8cv.data.state import StateMessage
+from mk8cv.sinks.ipc import pack_records, unpack_records
+
+# A recording is a sequence of blocks, each a batch of binary-encoded messages packed as records and compressed
+# with zlib, prefixed by its compressed length
+_BLOCK_LENGTH = struct.Struct('<I')
+
+
+def recording_path(path: str, worker: int) -> str:
+    """Every frame processor appends to a recording of its own."""
+    return f'{path}.{worker}'
+
+
+def _complete_blocks_end(f: BinaryIO) -> int:
+    """The offset just past the last block of a recording that was written whole."""
+    size = f.seek(0, os.SEEK_END)
+    end = 0
+    while end + _BLOCK_LENGTH.size <= size:
+        f.seek(end)
+        (length,) = _BLOCK_LENGTH.unpack(f.read(_BLOCK_LENGTH.size))
+        if end + _BLOCK_LENGTH.size + length > size:
+            break
+        end += _BLOCK_LENGTH.size + length
+    return end
+
+
+def recording_writer(path: str, level: int = 6) -> Callable[[list[StateMessage]], None]:
+    """
+    A BackgroundSink writer appending each batch as one compressed block to the recording at path.
+
+    Messages are recorded in full, whatever codec is published, so a recording replays on its own. A block is
+    written with a single call on a file opened for appending, so a crash leaves at most a truncated last block,
+    which read_recording skips, and which is cut off when the recording is next appended to, so the blocks after
+    it can be read. The file is closed by write.close, which BackgroundSink calls when it closes.
+    """
+    f = open(path, 'ab', buffering=0)
+    with open(path, 'rb') as existing:
+        end = _complete_blocks_end(existing)
+    if end < os.path.getsize(path):
+        logging.warning(f"Recording {path} ends in a truncated block, cutting it off before appending")
+        f.truncate(end)
+
+    def write(batch: list[StateMessage]) -> None:
+        block = zlib.compress(pack_records(encode_state_message(message, Codec.BINARY) for message in batch), level)
+        f.write(_BLOCK_LENGTH.pack(len(block)) + block)
+    write.close = f.close
+    return write
+
+
+def read_recording(path: str) -> Iterator[StateMessage]:
+    """Yields the messages of a recording in the order they were recorded."""
+    with open(path, 'rb') as f:
+        while header := f.read(_BLOCK_LENGTH.size):
+            length = _BLOCK_LENGTH.unpack(header)[0] if len(header) == _BLOCK_LENGTH.size else -1
+            block = f.read(length) if length >= 0 else b''
+            if len(block) != length:
+                logging.warning(f"Recording {path} ends in a truncated block, ignoring it")
+                return
+            try:
+                records = unpack_records(zlib.decompress(block))
+            except zlib.error as e:
+                logging.warning(f"Recording {path} has a corrupt block, ignoring it and the rest: {e}")
+                return
+            for record in records:
+                yield decode_state_message(record)
+
+
+def read_recordings(paths: list[str]) -> Iterator[StateMessage]:
+    """
+    Yields the messages of several recordings merged by frame number.
+
+    Each frame processor's recording is in the order it processed frames, and merging them by frame number
+    interleaves the devices' messages much as they arrived live. The order only depends on the files, so replays
+    of the same recordings are identical.
+    """
+    for path in paths:
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"No recording at {path}")
+    return heapq.merge(*(read_recording(path) for path in paths), key=lambda message: message.frame_number)
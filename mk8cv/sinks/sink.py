@@ -1,15 +1,135 @@
-import json
+import sqlite3
 from enum import Enum
+from typing import Callable
 
 import redis
 
-from mk8cv.data.state import StateMessage, StateEncoder
+from mk8cv.data.codec import BatchEncoder, Codec, DeltaEncoder, encode_state_message
+from mk8cv.data.state import StateMessage
+from mk8cv.processing.races import first_race_id
+
+# Entries kept per stream partition; XADD trims approximately, so a stream may briefly hold a few more
+STREAM_MAXLEN = 10000
+# Redis key of the race id counter shared by every setup publishing to the server
+RACE_ID_KEY = 'mk8cv:race_id'
+# SQLite database holding the race id counter of sinks without a server, the one the aggregator writes by default
+RACE_ID_DB = 'mk8cv.db'
 
 
 class SinkType(Enum):
     NONE = 0
     REDIS = 1
+    REDIS_STREAM = 2
+    UNIX_SOCKET = 3
+    SHARED_MEMORY = 4
+    # Corrected and written to SQLite by an aggregator thread in main.py, no broker involved
+    SQLITE = 5
+
+
+class PartitionKey(str, Enum):
+    """What decides the stream partition of a message. Every message of a device always lands in the same partition."""
+    DEVICE = 'device'
+    RACE = 'race'
+
+
+class RedisRaceIds:
+    """
+    Allocates race ids from a counter on the Redis server the sink publishes to, so setups sharing the server
+    never reuse each other's ids. The counter starts from first_race_id, above any id allocated before it existed.
+    Holds no connection, so it can be passed to the frame processors.
+    """
+
+    def __init__(self, host: str = 'localhost', port: int = 6379, key: str = RACE_ID_KEY) -> None:
+        self.host = host
+        self.port = port
+        self.key = key
+
+    def allocate(self) -> int:
+        client = redis.Redis(host=self.host, port=self.port)
+        try:
+            with client.pipeline() as pipe:
+                pipe.set(self.key, first_race_id() - 1, nx=True)
+                pipe.incr(self.key)
+                return int(pipe.execute()[-1])
+        finally:
+            client.close()
+
+
+class SqliteRaceIds:
+    """Allocates race ids from a counter in a SQLite database, for sinks without a server; see RedisRaceIds."""
+
+    def __init__(self, db_file: str = RACE_ID_DB) -> None:
+        self.db_file = db_file
+
+    def allocate(self) -> int:
+        conn = sqlite3.connect(self.db_file, timeout=30.0)
+        try:
+            # the first statement takes the write lock, so concurrent allocations are serialised
+            with conn:
+                conn.execute('CREATE TABLE IF NOT EXISTS race_sequence (next_id INT NOT NULL);')
+                conn.execute('INSERT INTO race_sequence (next_id) SELECT ? WHERE NOT EXISTS '
+                             '(SELECT 1 FROM race_sequence);', (first_race_id(),))
+                return conn.execute('UPDATE race_sequence SET next_id = next_id + 1 RETURNING next_id - 1;'
+                                    ).fetchone()[0]
+        finally:
+            conn.close()
+
+
+def race_id_allocator(sink_type: SinkType) -> RedisRaceIds | SqliteRaceIds:
+    """Where a sink's race ids come from: the Redis server it publishes to, or the local SQLite database."""
+    if sink_type in (SinkType.REDIS, SinkType.REDIS_STREAM):
+        return RedisRaceIds()
+    return SqliteRaceIds()
+
+
+def _encode(message: StateMessage, codec: Codec, delta_encoder: DeltaEncoder = None) -> bytes:
+    if codec == Codec.DELTA:
+        return delta_encoder.encode(message)
+    return encode_state_message(message, codec)
+
+
+def stream_key(stream: str, partition: int) -> str:
+    return f'{stream}:{partition}'
+
+
+def message_partition(message: StateMessage, num_partitions: int, partition_by: PartitionKey = PartitionKey.DEVICE) -> int:
+    return (message.device_id if partition_by == PartitionKey.DEVICE else message.race_id) % num_partitions
+
 
 # Option 1: Redis Pub/Sub
-def publish_to_redis(redis_client: redis.Redis, channel: str, message: StateMessage):
-    redis_client.publish(channel, json.dumps(message, cls=StateEncoder))
\ No newline at end of file
+def publish_to_redis(redis_client: redis.Redis, channel: str, message: StateMessage, codec: Codec = Codec.BINARY,
+                     delta_encoder: DeltaEncoder = None):
+    redis_client.publish(channel, _encode(message, codec, delta_encoder))
+
+
+# Option 2: Redis Streams, read by aggregators through a consumer group so nothing is lost while they are down
+def publish_to_redis_stream(redis_client: redis.Redis, stream: str, message: StateMessage, codec: Codec = Codec.BINARY,
+                            delta_encoder: DeltaEncoder = None, num_partitions: int = 1,
+                            partition_by: PartitionKey = PartitionKey.DEVICE, maxlen: int = STREAM_MAXLEN):
+    key = stream_key(stream, message_partition(message, num_partitions, partition_by))
+    redis_client.xadd(key, {'data': _encode(message, codec, delta_encoder)}, maxlen=maxlen, approximate=True)
+
+
+def redis_writer(redis_client: redis.Redis, sink_type: SinkType, channel: str, codec: Codec = Codec.BINARY,
+                 delta_encoder: DeltaEncoder = None, num_partitions: int = 1,
+                 partition_by: PartitionKey = PartitionKey.DEVICE,
+                 maxlen: int = STREAM_MAXLEN) -> Callable[[list[StateMessage]], None]:
+    """
+    A BackgroundSink writer sending each batch of messages in one pipelined round-trip.
+
+    A batch is encoded once and the same bytes are resent if the sink retries it, so a DeltaEncoder never
+    advances past messages that were not delivered.
+    """
+    encoder = BatchEncoder(codec, delta_encoder)
+
+    def write(batch: list[StateMessage]) -> None:
+        records = encoder.encode(batch)
+        with redis_client.pipeline(transaction=False) as pipe:
+            for message, data in zip(batch, records):
+                if sink_type == SinkType.REDIS_STREAM:
+                    key = stream_key(channel, message_partition(message, num_partitions, partition_by))
+                    pipe.xadd(key, {'data': data}, maxlen=maxlen, approximate=True)
+                else:
+                    pipe.publish(channel, data)
+            pipe.execute()
+    return write
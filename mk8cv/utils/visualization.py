@@ -18,10 +18,11 @@ def add_text(frame: cv2.typing.MatLike, text: str, position: Tuple[int, int], co
         thickness=thickness
     )
 
-def visualize(frame: MatLike, states: dict[Player, PlayerState], device_id: int, stop_event) -> None:
+def visualize(frame: MatLike, states: dict[Player, PlayerState], device_id: int, stop_event,
+              layout_coords=CROP_COORDS) -> None:
     height, width, channels = frame.shape
-    for player in [Player.P1, Player.P2]:
-        crop_coords = CROP_COORDS[player]
+    for player in states:
+        crop_coords = layout_coords[player]
         coins_text_position = (
             round(frame.shape[1] * crop_coords[Stat.COINS][0]),
             round(frame.shape[0] * (crop_coords[Stat.COINS][2] - 0.015))
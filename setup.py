@@ -11,6 +11,10 @@ setup(
         # Add other dependencies here
     ],
     extras_require={
+        # archiving finished races to Parquet, see mk8cv.aggregator.archive
+        "archive": [
+            "pyarrow",
+        ],
         "dev": [
             "pytest",
             "flake8",
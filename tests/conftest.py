@@ -1,6 +1,8 @@
 import cv2
 import pytest
 
+from mk8cv.data.state import Item, PlayerState, StateMessage
+
 
 @pytest.fixture
 def video_capture(video_file):
@@ -8,3 +10,13 @@ def video_capture(video_file):
     yield cap
     cap.release()
 
+
+@pytest.fixture
+def state_message():
+    """Builds a two-player StateMessage whose first player's position changes with the frame."""
+    def build(device_id: int, frame_number: int, race_id: int = 7, capture_time: float = None) -> StateMessage:
+        return StateMessage(device_id, frame_number, race_id,
+                            PlayerState(frame_number % 12 + 1, Item.BANANA, Item.NONE, 3, 1, 3),
+                            PlayerState(5, Item.NONE, Item.COIN, 0, 1, 3),
+                            capture_time=capture_time)
+    return build
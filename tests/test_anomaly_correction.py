@@ -0,0 +1,42 @@
+import random
+from collections import Counter
+
+import pytest
+
+from mk8cv.aggregator.anomaly_correction import SlidingWindowAnomalyCorrector
+from mk8cv.data.state import Item, PlayerState
+
+FIELDS = ('position', 'item1', 'item2', 'coins', 'lap', 'race_laps')
+
+
+def majority_vote(window: dict[int, PlayerState]) -> tuple:
+    return tuple(Counter(getattr(state, field) for state in window.values()).most_common(1)[0][0] for field in FIELDS)
+
+
+class TestSlidingWindowAnomalyCorrector:
+
+    @pytest.mark.parametrize('window_size', [1, 5, 9, 60])
+    def test_matches_majority_vote(self, window_size):
+        rng = random.Random(window_size)
+        corrector = SlidingWindowAnomalyCorrector(None, window_size)
+        windows: dict[int, dict[int, PlayerState]] = {}
+        timestamp = 0
+        for _ in range(2000):
+            # mostly in order, with the duplicates and reordering several frame processors produce
+            timestamp += rng.choice([1, 1, 1, 2, 0, -1, -3])
+            player_id = rng.randint(0, 3)
+            state = PlayerState(rng.choice([0, 1, 2, 3]), rng.choice([None, Item.BANANA, Item.RED_SHELL]),
+                                rng.choice([Item.NONE, Item.COIN]), rng.randint(0, 2), rng.randint(1, 2), 3)
+
+            window = windows.setdefault(player_id, {})
+            position = state.position
+            if position == 0 and window:
+                position = window[list(window)[-1]].position
+            if timestamp not in window:
+                window[timestamp] = PlayerState(position, state.item1, state.item2, state.coins, state.lap,
+                                                state.race_laps)
+            while len(window) > window_size:
+                del window[min(window)]
+
+            corrected = corrector.correct_anomalies(timestamp, player_id, state)
+            assert tuple(getattr(corrected, field) for field in FIELDS) == majority_vote(window)
@@ -0,0 +1,93 @@
+import os
+import sqlite3
+
+import pytest
+
+pytest.importorskip('pyarrow')
+
+from mk8cv.aggregator.archive import archive_race, scan, vacuum
+from mk8cv.aggregator.db import SqliteDB
+
+SCHEMA = os.path.join(os.path.dirname(__file__), '..', 'mk8cv-db', 'schema.sql')
+
+
+def _write_races(database: SqliteDB, race_ids, frames: int = 100, end: bool = True) -> None:
+    for race_id in race_ids:
+        for frame in range(0, frames, 10):
+            for player_id in (1, 2):
+                database.write_event(race_id, frame, player_id, 1, player_id, frame // 10 % 11,
+                                     'BANANA' if frame < 50 else 'NONE', 'NONE')
+        if end:
+            database.end_race(race_id)
+    database.close()
+
+
+class TestArchive:
+
+    def test_archive_and_scan(self, tmp_path):
+        db_file = str(tmp_path / 'race.db')
+        _write_races(SqliteDB(db_file, SCHEMA), (1, 2))
+
+        root = str(tmp_path / 'archive')
+        conn = sqlite3.connect(db_file)
+        assert archive_race(conn, root, 1, '2025-01-01') == 20
+        assert archive_race(conn, root, 2, '2025-02-01') == 20
+        assert conn.execute('SELECT COUNT(*) FROM race_data').fetchone() == (0,)
+        conn.close()
+
+        table = scan(root, ['race_id', 'frame', 'item_1'], race_ids=[2], player_ids=[1])
+        assert table.column('race_id').to_pylist() == [2] * 10
+        assert table.column('frame').to_pylist() == list(range(0, 100, 10))
+        assert table.column('item_1').to_pylist() == ['BANANA'] * 5 + ['NONE'] * 5
+        assert scan(root, ['frame'], since='2025-01-15').num_rows == 20
+
+    def test_rearchive_replaces_earlier_file(self, tmp_path):
+        db_file = str(tmp_path / 'race.db')
+        _write_races(SqliteDB(db_file, SCHEMA), (1,))
+        root = str(tmp_path / 'archive')
+        conn = sqlite3.connect(db_file)
+        assert archive_race(conn, root, 1, '2025-01-01', delete=False) == 20
+        assert archive_race(conn, root, 1, '2025-01-02') == 20
+        conn.close()
+        assert scan(root, ['date']).column('date').to_pylist() == ['2025-01-02'] * 20
+        assert not [name for _, _, files in os.walk(root) for name in files if name.endswith('.tmp')]
+
+    def test_unfinished_races_are_refused(self, tmp_path):
+        db_file = str(tmp_path / 'race.db')
+        _write_races(SqliteDB(db_file, SCHEMA), (1,), end=False)
+        _write_races(SqliteDB(db_file, SCHEMA), (2,))
+        # a device still sending to race 2 after it ended
+        database = SqliteDB(db_file, SCHEMA)
+        database.write_event(2, 200, 1, 2, 1, 0, 'NONE', 'NONE')
+        database.close()
+
+        root = str(tmp_path / 'archive')
+        conn = sqlite3.connect(db_file)
+        assert archive_race(conn, root, 1) == 0
+        assert archive_race(conn, root, 2) == 0
+        assert conn.execute('SELECT COUNT(*) FROM race_data').fetchone() == (41,)
+        assert archive_race(conn, root, 1, force=True) == 20
+        conn.close()
+
+    def test_archived_rows_shrink_the_database(self, tmp_path):
+        for name, auto_vacuum in (('new.db', 2), ('old.db', 0)):
+            db_file = str(tmp_path / name)
+            if not auto_vacuum:
+                # a database created before SqliteDB enabled incremental vacuuming
+                with open(SCHEMA) as f:
+                    old = sqlite3.connect(db_file)
+                    old.executescript(f.read())
+                    old.close()
+            _write_races(SqliteDB(db_file, SCHEMA), (1, 2), frames=20000)
+            conn = sqlite3.connect(db_file)
+            assert conn.execute('PRAGMA auto_vacuum').fetchone()[0] == auto_vacuum
+            pages = conn.execute('PRAGMA page_count').fetchone()[0]
+            archive_race(conn, str(tmp_path / 'archive'), 1)
+            if not auto_vacuum:
+                # archiving never rewrites the whole file under the aggregator; that takes an offline --vacuum
+                assert conn.execute('PRAGMA freelist_count').fetchone()[0] > 0
+                vacuum(conn)
+            assert conn.execute('PRAGMA freelist_count').fetchone()[0] == 0
+            assert conn.execute('PRAGMA page_count').fetchone()[0] < pages
+            assert conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2
+            conn.close()
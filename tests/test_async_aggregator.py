@@ -0,0 +1,114 @@
+import threading
+import time
+
+import pytest
+
+from mk8cv.aggregator.aggregator import AsyncEventAggregator
+from mk8cv.aggregator.anomaly_correction import AnomalyCorrector
+from mk8cv.aggregator.db import Database
+from mk8cv.aggregator.sources import EventSource, SourceType
+from mk8cv.aggregator.standings import Standings
+from mk8cv.data.codec import DeltaEncoder
+from mk8cv.data.state import Item, PlayerState, StateMessage, global_player_id
+
+
+class _Committed(Database):
+    """Buffers rows like SqliteDB, committing them a few at a time or when forced."""
+
+    def __init__(self, batch_rows: int = 8) -> None:
+        super().__init__()
+        self.batch_rows = batch_rows
+        self.buffered = []
+        self.committed = set()
+        self.ended = []
+
+    def write_event(self, race_id, timestamp, player_id, lap, position, coins, item_1, item_2):
+        self.buffered.append((race_id, timestamp, player_id))
+
+    def flush(self, force=False):
+        if force or len(self.buffered) >= self.batch_rows:
+            self.committed.update(self.buffered)
+            self.buffered = []
+        return not self.buffered
+
+    def end_race(self, race_id):
+        self.ended.append(race_id)
+
+    def get_previous_events(self, race_id, player_id, num_rows=1):
+        return []
+
+
+class _AsIs(AnomalyCorrector):
+    def correct_anomalies(self, timestamp, player_id, state):
+        return state
+
+
+class _Source(EventSource):
+    """One device's messages, read a few at a time with a blocking wait, checking each ack against the database."""
+
+    def __init__(self, device_id: int, database: _Committed, frames: int = 60, batch: int = 5,
+                 races: list[int] = None) -> None:
+        encoder = DeltaEncoder()
+        self.device_id = device_id
+        self.database = database
+        self.races = races or [10 + device_id] * frames
+        self.entries = [encoder.encode(StateMessage(device_id, frame, self.races[frame],
+                                                    PlayerState(frame % 12 + 1, Item.NONE, Item.NONE, frame % 11, 1, 3)))
+                        for frame in range(frames)]
+        self.batch = batch
+        self.next = 0
+        self.acked = []
+        self.threads = set()
+
+    def read(self, timeout):
+        self.threads.add(threading.current_thread().name)
+        time.sleep(0.005)
+        messages = [((self.device_id, frame), self.entries[frame])
+                    for frame in range(self.next, min(self.next + self.batch, len(self.entries)))]
+        self.next += len(messages)
+        self.finished = not messages
+        return messages
+
+    def ack(self, ids):
+        for device_id, frame in ids:
+            assert (self.races[frame], frame, global_player_id(device_id, 1)) in self.database.committed
+        self.acked.extend(ids)
+
+
+class _Aggregator(AsyncEventAggregator):
+    def __init__(self, sources: dict[str, EventSource], database: Database, snapshot_path: str = None,
+                 standings: Standings = None) -> None:
+        # not a Redis source type, so listen does not ping a server
+        super().__init__('localhost', 6379, list(sources), SourceType.SHARED_MEMORY, handle_signals=False,
+                         database=database, standings=standings, anomaly_corrector=_AsIs(), snapshot_path=snapshot_path,
+                         snapshot_interval=0.02, flush_interval=0.01)
+        self.sources = sources
+
+    def _open_source(self, channel: str = None) -> EventSource:
+        return self.sources[channel]
+
+
+class TestAsyncEventAggregator:
+
+    @pytest.mark.parametrize('snapshot', [False, True])
+    def test_acks_follow_commits(self, tmp_path, snapshot):
+        database = _Committed()
+        sources = {f'setup{i}': _Source(i, database) for i in range(4)}
+        _Aggregator(sources, database, str(tmp_path / 'aggregator.snapshot') if snapshot else None).listen()
+
+        for device_id, source in enumerate(sources.values()):
+            assert sorted(source.acked) == [(device_id, frame) for frame in range(60)]
+            # reads wait on the readers' own threads, never the default executor the writer commits and acks on
+            assert all(thread.startswith('reader') for thread in source.threads)
+        assert not database.buffered
+
+    def test_setups_reusing_device_ids_keep_their_races(self):
+        database = _Committed()
+        # both setups number their only device 0; the first moves on to its next race halfway through
+        sources = {'setup0': _Source(0, database, races=[20] * 30 + [22] * 30),
+                   'setup1': _Source(0, database, races=[21] * 60)}
+        standings = Standings()
+        _Aggregator(sources, database, standings=standings).listen()
+        assert database.ended == [20]
+        # race 20's last rows are written before it is forgotten, so they do not bring it back
+        assert sorted(standings._players) == [21, 22]
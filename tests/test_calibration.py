@@ -0,0 +1,68 @@
+import itertools
+
+import numpy as np
+
+from mk8cv.processing import calibration
+from mk8cv.processing.aois import Layout
+from mk8cv.processing.calibration import DeviceAois, SharedDeviceAois
+
+
+class TestDeviceAois:
+
+    def test_processors_share_each_devices_detected_layout(self, monkeypatch, tmp_path):
+        # each processor's first frame of a device would be detected differently
+        guesses = itertools.cycle([Layout.FOUR_PLAYER, Layout.TWO_PLAYER])
+        monkeypatch.setattr(calibration, 'detect_layout', lambda frame: next(guesses))
+        shared = SharedDeviceAois(num_devices=2)
+        processors = [DeviceAois([None], str(tmp_path), shared=shared) for _ in range(3)]
+        frame = np.zeros((360, 640, 3), np.uint8)
+
+        for device_id in range(2):
+            players = {len(processor.get(device_id, frame).players) for processor in processors}
+            assert len(players) == 1
+        assert [processors[2]._device_layouts[device_id] for device_id in range(2)] == [Layout.FOUR_PLAYER,
+                                                                                        Layout.TWO_PLAYER]
+
+    def test_one_processor_calibrates_each_device(self, monkeypatch, tmp_path):
+        calibrated = []
+
+        def calibrate(frame, layout, templates):
+            calibrated.append(layout)
+            return calibration.HudCorrection(0.9, 0.05, 0.05)
+        monkeypatch.setattr(calibration, 'calibrate', calibrate)
+        monkeypatch.setattr(calibration, 'load_templates', lambda path: {})
+        shared = SharedDeviceAois(num_devices=1)
+        # with --recalibrate, no processor may take the stale cached table, nor overwrite another's
+        calibration.save_calibration(str(tmp_path), 0, Layout.TWO_PLAYER, calibration.HudCorrection())
+        processors = [DeviceAois([Layout.TWO_PLAYER], str(tmp_path), recalibrate=True, shared=shared)
+                      for _ in range(3)]
+        frame = np.zeros((360, 640, 3), np.uint8)
+
+        tables = [processor.get(0, frame) for processor in processors]
+        assert len(calibrated) == 1
+        expected = calibration.HudCorrection(0.9, 0.05, 0.05).apply(calibration.LAYOUTS[Layout.TWO_PLAYER])
+        assert tables[0].crop_coords == expected
+        # the others were handed the device after it was calibrated, so they load the saved table straight away
+        for processor, table in zip(processors[1:], tables[1:]):
+            assert table.crop_coords == expected
+            assert processor.get(0, frame) is table
+
+    def test_others_use_the_nominal_aois_until_the_calibration_is_saved(self, monkeypatch, tmp_path):
+        # the first attempt is on a menu, the next shows the HUD
+        corrections = iter([None, calibration.HudCorrection(0.9, 0.05, 0.05)])
+        monkeypatch.setattr(calibration, 'calibrate', lambda frame, layout, templates: next(corrections))
+        monkeypatch.setattr(calibration, 'load_templates', lambda path: {})
+        shared = SharedDeviceAois(num_devices=1)
+        first, second = (DeviceAois([Layout.TWO_PLAYER], str(tmp_path), calibrate=True, shared=shared)
+                         for _ in range(2))
+        frame = np.zeros((360, 640, 3), np.uint8)
+        nominal = calibration.LAYOUTS[Layout.TWO_PLAYER]
+
+        assert first.get(0, frame).crop_coords == nominal
+        assert second.get(0, frame).crop_coords == nominal
+        for _ in range(calibration.CALIBRATION_INTERVAL):
+            calibrated = first.get(0, frame)
+            waiting = second.get(0, frame)
+        assert calibrated.crop_coords != nominal
+        # the second processor checks back on its own interval, after the first saved the table
+        assert waiting.crop_coords == calibrated.crop_coords
@@ -0,0 +1,154 @@
+import struct
+
+import pytest
+
+from mk8cv.data.codec import (BINARY_MAGIC, Codec, DeltaDecoder, DeltaEncoder, decode_state_message,
+                              encode_state_message)
+from mk8cv.data.state import Item, PlayerState, StateMessage
+
+
+def _is_keyframe(data: bytes) -> bool:
+    # the byte after the magic is the message kind, 0 for a keyframe
+    return data[1] == 0
+
+
+def _round_trip(encoder: DeltaEncoder, decoder: DeltaDecoder, messages: list[StateMessage]) -> list[bool]:
+    """Encodes and decodes every message, checking each comes back whole; returns which were keyframes."""
+    keyframes = []
+    for message in messages:
+        data = encoder.encode(message)
+        assert repr(decoder.decode(data)) == repr(message)
+        keyframes.append(_is_keyframe(data))
+    return keyframes
+
+
+def _unextracted() -> StateMessage:
+    """A message with every stat left unextracted, as None or as -1, and no items read."""
+    return StateMessage(1, 5, 3, PlayerState(None, None, None, None, None, None),
+                        PlayerState(-1, None, Item.NONE, -1, -1, -1), capture_time=None)
+
+
+class TestBinaryCodec:
+
+    @pytest.mark.parametrize('codec', [Codec.BINARY, Codec.JSON])
+    def test_round_trip(self, codec, state_message):
+        message = state_message(3, 1234, capture_time=1000.25)
+        assert repr(decode_state_message(encode_state_message(message, codec))) == repr(message)
+
+    def test_unextracted_stats_and_unknown_items(self):
+        decoded = decode_state_message(encode_state_message(_unextracted(), Codec.BINARY))
+        # None stats go over the wire as -1, unknown items as 0 and back as None, and an unknown time as NaN
+        assert [(state.position, state.lap, state.race_laps, state.coins) for state in decoded.player_states] == \
+            [(-1, -1, -1, -1)] * 2
+        assert [(state.item1, state.item2) for state in decoded.player_states] == [(None, None), (None, Item.NONE)]
+        assert decoded.capture_time is None
+
+    def test_json_keeps_unextracted_stats_as_they_were(self):
+        message = _unextracted()
+        assert repr(decode_state_message(encode_state_message(message, Codec.JSON))) == repr(message)
+
+    def test_version_1_messages_still_decode(self):
+        # as recorded before capture times were sent
+        player = struct.Struct('<bbbBBb')
+        data = b''.join([struct.pack('<BBiHqB', BINARY_MAGIC, 1, 7, 2, 99, 2),
+                         player.pack(4, 2, 3, Item.BANANA.value, 0, 5), player.pack(-1, -1, -1, 0, 0, -1)])
+        decoded = decode_state_message(data)
+        assert (decoded.race_id, decoded.device_id, decoded.frame_number, decoded.capture_time) == (7, 2, 99, None)
+        assert repr(decoded.player_states) == repr((PlayerState(4, Item.BANANA, None, 5, 2, 3),
+                                                    PlayerState(-1, None, None, -1, -1, -1)))
+
+    def test_player_count_mismatch(self, state_message):
+        data = encode_state_message(state_message(0, 1), Codec.BINARY)
+        with pytest.raises(ValueError, match='declares 2 players but carries 1'):
+            decode_state_message(data[:-struct.calcsize('<bbbBBb')])
+
+    def test_unsupported_version(self, state_message):
+        data = bytearray(encode_state_message(state_message(0, 1), Codec.BINARY))
+        data[1] = 3
+        with pytest.raises(ValueError, match='Unsupported binary StateMessage version 3'):
+            decode_state_message(bytes(data))
+
+    def test_delta_and_unknown_encodings_are_refused(self, state_message):
+        with pytest.raises(ValueError, match='DeltaDecoder'):
+            decode_state_message(DeltaEncoder().encode(state_message(0, 1)))
+        with pytest.raises(ValueError, match='Unrecognised StateMessage encoding'):
+            decode_state_message(b'\x00\x01')
+
+
+class TestDeltaCodec:
+
+    def test_keyframes_on_the_interval(self, state_message):
+        encoder = DeltaEncoder(keyframe_interval=4, keyframe_seconds=60)
+        messages = [state_message(0, frame) for frame in range(10)]
+        assert _round_trip(encoder, DeltaDecoder(), messages) == [frame % 4 == 0 for frame in range(10)]
+
+    def test_keyframes_on_the_clock(self, state_message):
+        encoder = DeltaEncoder(keyframe_interval=120, keyframe_seconds=0)
+        assert all(_round_trip(encoder, DeltaDecoder(), [state_message(0, frame) for frame in range(3)]))
+
+    def test_keyframes_on_race_and_player_count_changes(self, state_message):
+        encoder = DeltaEncoder(keyframe_interval=120, keyframe_seconds=60)
+        one_player = StateMessage(0, 3, 8, PlayerState(2, Item.MUSHROOM, Item.NONE, 4, 2, 3))
+        messages = [state_message(0, 0), state_message(0, 1), state_message(0, 2, race_id=8), one_player,
+                    StateMessage(0, 4, 8, PlayerState(1, Item.MUSHROOM, Item.NONE, 4, 2, 3))]
+        assert _round_trip(encoder, DeltaDecoder(), messages) == [True, False, True, True, False]
+
+    def test_devices_have_streams_of_their_own(self, state_message):
+        encoder = DeltaEncoder(keyframe_interval=120, keyframe_seconds=60)
+        messages = [state_message(device_id, frame) for frame in range(3) for device_id in range(2)]
+        assert _round_trip(encoder, DeltaDecoder(), messages) == [True, True] + [False] * 4
+
+    def test_missed_message_waits_for_the_next_keyframe(self, state_message):
+        encoder = DeltaEncoder(keyframe_interval=4, keyframe_seconds=60)
+        decoder = DeltaDecoder()
+        encoded = [encoder.encode(state_message(0, frame)) for frame in range(7)]
+        decoded = [decoder.decode(data) for frame, data in enumerate(encoded) if frame != 2]
+        # frame 3 is a delta on frame 2, which never arrived
+        assert [message.frame_number if message else None for message in decoded] == [0, 1, None, 4, 5, 6]
+        # another decoder joining mid-stream also waits
+        late = DeltaDecoder()
+        assert [late.decode(data) for data in encoded[1:4]] == [None, None, None]
+        assert repr(late.decode(encoded[4])) == repr(state_message(0, 4))
+
+    def test_gaps_too_large_for_a_delta_force_a_keyframe(self, state_message):
+        encoder = DeltaEncoder(keyframe_interval=1 << 20, keyframe_seconds=60)
+        messages = [
+            state_message(0, 0, capture_time=1000.0),
+            state_message(0, 1, capture_time=1000.016),
+            # more frames than a delta counts
+            state_message(0, 0x10001, capture_time=1001.0),
+            state_message(0, 0x10002, capture_time=1001.016),
+            # more capture time than a delta counts, then time going backwards
+            state_message(0, 0x10003, capture_time=1001.016 + 5000),
+            state_message(0, 0x10004, capture_time=1000.0),
+            # the capture time going missing
+            state_message(0, 0x10005),
+            state_message(0, 0x10006),
+            # and a frame number going backwards, as a restarted capture's would
+            state_message(0, 10),
+        ]
+        keyframes = [True, False, True, False, True, True, True, False, True]
+        decoder = DeltaDecoder()
+        for message, keyframe in zip(messages, keyframes):
+            data = encoder.encode(message)
+            decoded = decoder.decode(data)
+            assert _is_keyframe(data) == keyframe
+            assert decoded.frame_number == message.frame_number
+            if message.capture_time is None:
+                assert decoded.capture_time is None
+            else:
+                assert abs(decoded.capture_time - message.capture_time) < 1e-6
+
+    def test_decoded_states_are_not_shared_between_messages(self, state_message):
+        encoder = DeltaEncoder(keyframe_interval=120, keyframe_seconds=60)
+        decoder = DeltaDecoder()
+        # only the first player's position changes from frame to frame
+        first = decoder.decode(encoder.encode(state_message(0, 0)))
+        first.player_states[1].coins = 9
+        first.player_states[0].position = 12
+        second = decoder.decode(encoder.encode(state_message(0, 1)))
+        assert repr(second) == repr(state_message(0, 1))
+        second.player_states[1].item1 = Item.STAR
+        third = decoder.decode(encoder.encode(state_message(0, 2)))
+        assert repr(third) == repr(state_message(0, 2))
+        assert first.player_states[1].coins == 9
@@ -0,0 +1,51 @@
+import random
+
+from mk8cv.aggregator.anomaly_correction import SlidingWindowAnomalyCorrector
+from mk8cv.aggregator.hmm import HmmAnomalyCorrector, benchmark
+from mk8cv.data.state import Item, PlayerState
+
+
+def _race(frames: int = 600) -> list[PlayerState]:
+    """A player's true states: moving up the field, collecting coins, and on to the next lap every 200 frames."""
+    return [PlayerState(max(1, 8 - frame // 80), Item.BANANA if frame % 150 < 100 else Item.NONE, Item.NONE,
+                        min(10, frame // 50), frame // 200 + 1, 3) for frame in range(frames)]
+
+
+class TestHmmAnomalyCorrector:
+
+    def test_misreads_are_corrected_after_the_lag(self):
+        truth = _race()
+        corrector = HmmAnomalyCorrector(lag=3)
+        rng = random.Random(1)
+        published = []
+        for frame, state in enumerate(truth):
+            reading = PlayerState(state.position, state.item1, state.item2, state.coins, state.lap, state.race_laps)
+            if frame % 17 == 5:
+                reading.position, reading.lap, reading.coins = rng.randint(1, 12), rng.randint(1, 3), rng.randint(0, 10)
+            published.append(corrector.correct_anomalies(frame, (0, 1), reading))
+        for frame in range(3, len(truth)):
+            assert published[frame] == truth[frame - 3]
+
+    def test_unread_stats_pass_through(self):
+        corrector = HmmAnomalyCorrector(lag=2)
+        for frame in range(5):
+            corrected = corrector.correct_anomalies(frame, (0, 1), PlayerState(-1, Item.NONE, Item.NONE, -1, -1, -1))
+        assert (corrected.position, corrected.coins, corrected.lap, corrected.race_laps) == (-1, -1, -1, -1)
+
+    def test_old_frames_get_the_last_state(self):
+        corrector = HmmAnomalyCorrector(lag=0)
+        latest = corrector.correct_anomalies(10, (0, 1), PlayerState(4, Item.STAR, Item.NONE, 3, 2, 3))
+        assert corrector.correct_anomalies(9, (0, 1), PlayerState(9, Item.BOO, Item.NONE, 0, 1, 3)) is latest
+
+    def test_beats_majority_vote(self):
+        truth = _race()
+        rng = random.Random(2)
+        readings = [(frame, PlayerState(*(rng.choice([value, None, 0]) if rng.random() < 0.15 else value
+                                          for value in (state.position, state.item1, state.item2, state.coins,
+                                                        state.lap, state.race_laps))))
+                    for frame, state in enumerate(truth)]
+        results = benchmark({1: readings}, {'window': lambda: SlidingWindowAnomalyCorrector(None, 9),
+                                            'hmm': lambda: HmmAnomalyCorrector(lag=3)}, {1: truth})
+        for field in ('position', 'coins', 'lap'):
+            assert results['hmm']['accuracy'][field] >= results['window']['accuracy'][field]
+            assert results['hmm']['delay'][field] <= results['window']['delay'][field]
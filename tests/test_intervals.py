@@ -0,0 +1,54 @@
+import os
+import random
+import sqlite3
+
+from mk8cv.aggregator.db import SqliteDB
+from mk8cv.aggregator.intervals import compact, query_intervals
+
+SCHEMA = os.path.join(os.path.dirname(__file__), '..', 'mk8cv-db', 'schema.sql')
+
+
+def _intervals(conn: sqlite3.Connection) -> list[tuple]:
+    return conn.execute('SELECT * FROM race_intervals ORDER BY race_id, player_id, stat, start_frame').fetchall()
+
+
+class TestIntervals:
+
+    def test_incremental_matches_compaction(self, tmp_path):
+        rng = random.Random(0)
+        db_file = str(tmp_path / 'race.db')
+        database = SqliteDB(db_file, SCHEMA, batch_rows=7)
+        for frame in range(500):
+            for player_id in (1, 2):
+                if rng.random() < 0.3:
+                    database.write_event(3, frame, player_id, rng.randint(1, 3), rng.randint(1, 12), rng.randint(0, 2),
+                                         rng.choice(['NONE', 'BANANA']), 'NONE')
+        database.close()
+
+        conn = sqlite3.connect(db_file)
+        incremental = _intervals(conn)
+        assert compact(conn) == len(incremental)
+        assert _intervals(conn) == incremental
+
+        # every frame of a stat lies in exactly one interval, the one starting at its latest change
+        rows = conn.execute('SELECT timestamp, coins FROM race_data WHERE player_id = 1 ORDER BY timestamp').fetchall()
+        for start, coins in rows:
+            covering = query_intervals(conn, 3, 1, 'coins', start, start)
+            assert len(covering) == 1 and covering[0][2] == coins and covering[0][0] <= start
+        conn.close()
+
+    def test_resumes_open_intervals(self, tmp_path):
+        db_file = str(tmp_path / 'race.db')
+        database = SqliteDB(db_file, SCHEMA)
+        database.write_event(1, 10, 1, 1, 5, 0, 'NONE', 'NONE')
+        database.close()
+
+        database = SqliteDB(db_file, SCHEMA)
+        database.write_event(1, 10, 1, 1, 5, 0, 'NONE', 'NONE')  # redelivered
+        database.write_event(1, 20, 1, 1, 4, 0, 'NONE', 'NONE')
+        database.close()
+
+        conn = sqlite3.connect(db_file)
+        assert query_intervals(conn, 1, 1, 'position', 0, 100) == [(10, 20, 5), (20, None, 4)]
+        assert query_intervals(conn, 1, 1, 'lap', 0, 100) == [(10, None, 1)]
+        conn.close()
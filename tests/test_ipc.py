@@ -0,0 +1,94 @@
+import os
+import socket
+import tempfile
+
+import pytest
+
+from mk8cv.aggregator.sources import UnixSocketSource
+from mk8cv.data.codec import Codec, decode_state_message
+from mk8cv.sinks.ipc import MAX_DATAGRAM, ShmRing, pack_datagrams, pack_records, unix_socket_writer, \
+    unpack_records
+
+
+@pytest.fixture
+def ring():
+    ring = ShmRing(f'mk8cv_test_{os.getpid()}', size=64, create=True)
+    yield ring
+    ring.close()
+    ring.unlink()
+
+
+@pytest.fixture
+def socket_path():
+    # unix socket paths are limited to about 100 bytes, which pytest's tmp_path can exceed
+    path = os.path.join(tempfile.gettempdir(), f'mk8cv_test_{os.getpid()}.sock')
+    yield path
+    if os.path.exists(path):
+        os.remove(path)
+
+
+class TestShmRing:
+
+    def test_record_past_the_end_leaves_a_wrap_marker(self, ring):
+        ring.write([b'a' * 20, b'b' * 20])
+        assert ring.read() == [b'a' * 20, b'b' * 20]
+        # 16 bytes are left before the end, too few for the 24 byte record, so it starts over at 0
+        ring.write([b'c' * 20])
+        assert bytes(ring._data[48:52]) == b'\xff' * 4
+        assert bytes(ring._data[4:24]) == b'c' * 20
+        assert ring.read() == [b'c' * 20]
+
+    def test_end_too_short_for_a_marker_is_skipped(self, ring):
+        ring.write([b'x' * 26, b'y' * 27])
+        assert ring.read() == [b'x' * 26, b'y' * 27]
+        # 3 bytes are left, not enough for a length, so the reader skips them without a marker
+        ring.write([b'z' * 10, b'w' * 10])
+        assert ring.read(max_records=1) == [b'z' * 10]
+        assert ring.read() == [b'w' * 10]
+        assert ring.read() == []
+
+    def test_full_ring_takes_none_of_the_batch(self, ring):
+        ring.write([b'a' * 30])
+        with pytest.raises(BufferError):
+            ring.write([b'b' * 20, b'c' * 20])
+        assert ring.read() == [b'a' * 30]
+        ring.write([b'b' * 20, b'c' * 20])
+        assert ring.read() == [b'b' * 20, b'c' * 20]
+
+
+class TestUnixSocket:
+
+    def test_large_batch_is_split_into_datagrams(self, socket_path, state_message):
+        source = UnixSocketSource(socket_path)
+        try:
+            # about 100 KiB of JSON, too much for one datagram
+            batch = [state_message(device_id, frame) for frame in range(200) for device_id in range(2)]
+            write = unix_socket_writer(socket_path, Codec.JSON)
+            write(batch)
+            received = []
+            while len(received) < len(batch):
+                messages = source.read(timeout=1.0)
+                assert messages
+                received.extend(decode_state_message(data) for _, data in messages)
+            assert [repr(message) for message in received] == [repr(message) for message in batch]
+        finally:
+            source.close()
+
+    def test_pack_datagrams_keeps_each_under_the_limit(self):
+        records = [bytes([i]) * 1000 for i in range(200)]
+        datagrams = pack_datagrams(records)
+        assert len(datagrams) > 1
+        assert all(len(datagram) <= MAX_DATAGRAM for datagram in datagrams)
+        assert [record for datagram in datagrams for record in unpack_records(datagram)] == records
+
+    def test_truncated_datagram_is_dropped(self, socket_path):
+        source = UnixSocketSource(socket_path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            sock.sendto(pack_records([b'x' * MAX_DATAGRAM]), socket_path)
+            sock.sendto(pack_records([b'ok']), socket_path)
+            # the oversized datagram's record would be cut off, so only the next one is read
+            assert source.read(timeout=1.0) == [(None, b'ok')]
+        finally:
+            sock.close()
+            source.close()
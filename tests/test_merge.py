@@ -0,0 +1,54 @@
+from mk8cv.aggregator.reorder import TimelineMerger
+from mk8cv.data.codec import Codec, DeltaDecoder, DeltaEncoder, decode_state_message, encode_state_message
+
+
+def _times(released) -> list[float]:
+    return [event.capture_time for _, event in released]
+
+
+class TestTimelineMerger:
+
+    def test_merges_devices_in_capture_order(self, state_message):
+        merger = TimelineMerger(max_latency=10.0)
+        # device 1 started a little later, so its frame numbers are behind for the same moment
+        released = merger.merge([(0, state_message(0, 0, capture_time=100.00)),
+                                 (1, state_message(0, 1, capture_time=100.02))])
+        assert released == []  # device 1 might still send something captured before
+        released = merger.merge([(2, state_message(1, 0, capture_time=100.01))])
+        assert _times(released) == [100.00, 100.01]
+        released += merger.merge([(3, state_message(1, 1, capture_time=100.03))])
+        released += merger.drain()
+        assert _times(released) == [100.00, 100.01, 100.02, 100.03]
+        assert merger.late == 0
+
+    def test_stalled_device_releases_after_latency(self, state_message):
+        merger = TimelineMerger(max_latency=0.25)
+        assert merger.merge([(0, state_message(1, 0, capture_time=99.0))]) == []
+        released = merger.merge([(1, state_message(0, frame, capture_time=99.0 + frame * 0.1))
+                                 for frame in range(1, 6)])
+        # device 1 has said nothing since 99.0, so only what is max_latency older than the newest event leaves
+        assert _times(released) == [99.0, 99.1, 99.2]
+        released = merger.merge([(2, state_message(1, 1, capture_time=99.05))])
+        assert [tag for tag, _ in released] == [2]
+        assert merger.late == 1
+
+    def test_untimed_and_late_events_pass_through(self, state_message):
+        merger = TimelineMerger()
+        untimed = state_message(0, 3)
+        assert merger.merge([(0, untimed), (1, None)]) == [(0, untimed), (1, None)]
+
+
+class TestCaptureTime:
+
+    def test_codecs_keep_capture_time(self, state_message):
+        for codec in (Codec.BINARY, Codec.JSON):
+            for capture_time in (1537849600.016667, None):
+                message = state_message(2, 40, capture_time=capture_time)
+                assert repr(decode_state_message(encode_state_message(message, codec))) == repr(message)
+
+    def test_delta_keeps_capture_time(self, state_message):
+        encoder, decoder = DeltaEncoder(), DeltaDecoder()
+        messages = [state_message(0, frame, capture_time=1537849600.0 + frame / 60) for frame in range(10)]
+        for message in messages:
+            decoded = decoder.decode(encoder.encode(message))
+            assert abs(decoded.capture_time - message.capture_time) < 1e-6
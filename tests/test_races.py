@@ -0,0 +1,86 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+
+from mk8cv.data.state import Item, PlayerState
+from mk8cv.processing.races import RaceIds, first_race_id, hud_visible
+from mk8cv.sinks.sink import SqliteRaceIds
+
+
+def _frames(race_ids: RaceIds, device_id: int, start: float, seconds: float, hud: bool, fps: int = 10) -> list:
+    return [race_ids.race_for(device_id, start + frame / fps, hud) for frame in range(int(seconds * fps))]
+
+
+def _lap_crop(digit: int = None) -> np.ndarray:
+    """A lap digit crop lighting the segments of digit the way the HUD draws them, or a blank one for None."""
+    from mk8cv.models.lap_classifier import SevenSegmentLapClassifier
+    width, height = SevenSegmentLapClassifier.SIZE
+    image = np.zeros((height, width, 3), dtype=np.uint8)
+    # the segments of 2, in the classifier's order: top, top-right, middle, bottom-left and bottom
+    points = {2: [(0.5, 0.25), (0.7, 0.4), (0.45, 0.55), (0.25, 0.65), (0.4, 0.8)]}.get(digit, [])
+    for x, y in points:
+        image[int(height * y) - 2:int(height * y) + 3, int(width * x) - 2:int(width * x) + 3] = 255
+    return image
+
+
+class TestRaceIds:
+
+    def test_races_advance_with_the_hud(self):
+        race_ids = RaceIds(1, first_id=40, end_gap=5.0)
+        assert set(_frames(race_ids, 0, 0.0, 10.0, hud=False)) == {None}
+        assert set(_frames(race_ids, 0, 10.0, 60.0, hud=True)) == {40}
+        # the HUD dropping out briefly mid race, e.g. behind an item, does not end it
+        assert set(_frames(race_ids, 0, 70.0, 2.0, hud=False)) == {40}
+        assert set(_frames(race_ids, 0, 72.0, 10.0, hud=True)) == {40}
+        results = _frames(race_ids, 0, 82.0, 30.0, hud=False)
+        # the race ends RACE_END_GAP seconds after the HUD was last seen
+        assert set(results[:45]) == {40} and set(results[55:]) == {None}
+        assert set(_frames(race_ids, 0, 112.0, 60.0, hud=True)) == {41}
+
+    def test_devices_share_a_race(self):
+        race_ids = RaceIds(2, first_id=7)
+        assert race_ids.race_for(0, 100.0, True) == 7
+        assert race_ids.race_for(1, 101.5, True) == 7
+        # a device starting long after the others is in a race of its own
+        assert race_ids.race_for(1, 200.0, False) is None
+        assert race_ids.race_for(1, 200.1, True) == 8
+        assert race_ids.race_for(0, 200.2, True) == 7
+
+    def test_late_frames_keep_their_race(self):
+        race_ids = RaceIds(1, first_id=1, end_gap=5.0)
+        _frames(race_ids, 0, 0.0, 20.0, hud=True)
+        assert race_ids.race_for(0, 30.0, False) is None
+        assert race_ids.race_for(0, 40.0, True) == 2
+        # captured during race 1 but handled after race 2 started
+        assert race_ids.race_for(0, 19.0, True) == 1
+        assert race_ids.race_for(0, 35.0, False) is None
+
+    def test_hud_visible(self):
+        assert hud_visible((PlayerState(1, Item.NONE, Item.NONE, 0, None, None),
+                            PlayerState(2, Item.NONE, Item.NONE, 0, 2, 3)))
+        assert not hud_visible((PlayerState(1, Item.NONE, Item.NONE, 0, None, None),))
+
+    def test_frames_without_a_lap_counter_start_no_race(self):
+        pytest.importorskip('cv2')
+        from mk8cv.models.lap_classifier import SevenSegmentLapClassifier
+        classifier = SevenSegmentLapClassifier()
+        assert classifier._predict(_lap_crop(2)) == 2
+        # a menu or results screen, dark or bright where the counter would be, reads as no lap at all
+        for crop in (_lap_crop(), np.full_like(_lap_crop(), 90), np.full_like(_lap_crop(), 255)):
+            lap = classifier._predict(crop)
+            assert lap is None
+            state = PlayerState(-1, Item.NONE, Item.NONE, -1, lap, classifier._predict(crop))
+            assert not hud_visible((state,))
+            assert RaceIds(1, first_id=3).race_for(0, 10.0, hud_visible((state,))) is None
+
+    def test_setups_sharing_an_allocator_never_collide(self, tmp_path):
+        allocator = SqliteRaceIds(str(tmp_path / 'races.db'))
+        # two setups started in the same minute
+        first, second = (RaceIds(1, allocate=allocator.allocate) for _ in range(2))
+        start = first.race_for(0, 10.0, True)
+        assert start >= first_race_id() - 1
+        assert second.race_for(0, 10.0, True) == start + 1
+        with ThreadPoolExecutor(8) as pool:
+            ids = list(pool.map(lambda _: allocator.allocate(), range(64)))
+        assert sorted(ids) == list(range(start + 2, start + 66))
@@ -0,0 +1,64 @@
+import os
+
+import pytest
+
+from mk8cv.sinks.background import BackgroundSink
+from mk8cv.sinks.recording import read_recording, read_recordings, recording_path, recording_writer
+
+
+class TestRecording:
+
+    def test_round_trip_and_merge(self, tmp_path, state_message):
+        path = str(tmp_path / 'states')
+        for worker in range(2):
+            write = recording_writer(recording_path(path, worker))
+            # each worker processed every other frame of both devices
+            for frames in ([worker, worker + 2], [worker + 4]):
+                write([state_message(device_id, frame) for frame in frames for device_id in range(2)])
+
+        messages = list(read_recording(recording_path(path, 1)))
+        assert [repr(message) for message in messages] == [repr(state_message(device_id, frame))
+                                                           for frame in (1, 3, 5) for device_id in range(2)]
+
+        merged = list(read_recordings([recording_path(path, worker) for worker in range(2)]))
+        assert [message.frame_number for message in merged] == sorted(frame for frame in range(6) for _ in range(2))
+
+    def test_truncated_block_is_ignored(self, tmp_path, state_message):
+        path = str(tmp_path / 'states.0')
+        recording_writer(path)([state_message(0, 0), state_message(0, 1)])
+        recording_writer(path)([state_message(0, 2)])
+        with open(path, 'r+b') as f:
+            f.truncate(f.seek(0, 2) - 3)
+        assert [message.frame_number for message in read_recording(path)] == [0, 1]
+
+    def test_append_after_a_crash_cuts_off_the_truncated_block(self, tmp_path, state_message):
+        path = str(tmp_path / 'states.0')
+        recording_writer(path)([state_message(0, 0), state_message(0, 1)])
+        recording_writer(path)([state_message(0, 2)])
+        with open(path, 'r+b') as f:
+            f.truncate(f.seek(0, 2) - 5)
+        # the restarted processor's blocks would otherwise be read as the rest of the torn one
+        recording_writer(path)([state_message(0, 3)])
+        assert [message.frame_number for message in read_recording(path)] == [0, 1, 3]
+
+    def test_corrupt_block_ends_the_recording(self, tmp_path, state_message):
+        path = str(tmp_path / 'states.0')
+        recording_writer(path)([state_message(0, 0)])
+        end = os.path.getsize(path)
+        recording_writer(path)([state_message(0, 1)])
+        recording_writer(path)([state_message(0, 2)])
+        with open(path, 'r+b') as f:
+            f.seek(end + 4)
+            f.write(b'\xff' * 4)
+        assert [message.frame_number for message in read_recording(path)] == [0]
+
+    def test_sink_close_closes_the_file(self, tmp_path, state_message):
+        path = str(tmp_path / 'states.0')
+        write = recording_writer(path)
+        sink = BackgroundSink(write, batch_size=2)
+        for frame in range(5):
+            sink.put(state_message(0, frame))
+        sink.close()
+        assert [message.frame_number for message in read_recording(path)] == list(range(5))
+        with pytest.raises(ValueError):
+            write([state_message(0, 5)])
@@ -0,0 +1,82 @@
+import pytest
+
+fakeredis = pytest.importorskip('fakeredis')
+
+from mk8cv.aggregator.sources import StreamSource
+from mk8cv.data.codec import Codec, DeltaDecoder, DeltaEncoder
+from mk8cv.processing.races import first_race_id
+from mk8cv.sinks import sink
+from mk8cv.sinks.sink import RedisRaceIds, SinkType, publish_to_redis_stream, redis_writer
+
+
+class _FlakyRedis:
+    """Wraps a client so the first pipeline it hands out fails on execute, as when the connection drops."""
+
+    def __init__(self, client) -> None:
+        self.client = client
+        self.lost = None
+
+    def pipeline(self, transaction=True):
+        pipe = self.client.pipeline(transaction=transaction)
+        if self.lost is None:
+            def execute():
+                self.lost = [args for args, _ in pipe.command_stack]
+                pipe.reset()
+                raise ConnectionError('connection lost')
+            pipe.execute = execute
+        return pipe
+
+
+class TestRedisStream:
+
+    def test_partitions_and_redelivery(self, state_message):
+        client = fakeredis.FakeRedis()
+        encoder = DeltaEncoder()
+        for frame_number in range(10):
+            for device_id in range(2):
+                publish_to_redis_stream(client, 'states', state_message(device_id, frame_number), Codec.DELTA, encoder,
+                                        num_partitions=2)
+
+        source = StreamSource(client, 'states', [1], consumer='a')
+        messages = source.read(timeout=0.1)
+        decoder = DeltaDecoder()
+        events = [decoder.decode(data) for _, data in messages]
+        assert [event.device_id for event in events] == [1] * 10
+        assert [event.frame_number for event in events] == list(range(10))
+        assert repr(events[-1]) == repr(state_message(1, 9))
+
+        # nothing was acked, so a restart under the same consumer name gets the same entries back
+        restarted = StreamSource(client, 'states', [1], consumer='a')
+        redelivered = restarted.read(timeout=0.1)
+        assert [message_id for message_id, _ in redelivered] == [message_id for message_id, _ in messages]
+
+        restarted.ack([message_id for message_id, _ in redelivered])
+        assert restarted.read(timeout=0.1) == []
+        assert StreamSource(client, 'states', [1], consumer='a').read(timeout=0.1) == []
+
+    def test_retried_batch_is_resent_unchanged(self, state_message):
+        client = fakeredis.FakeRedis()
+        flaky = _FlakyRedis(client)
+        write = redis_writer(flaky, SinkType.REDIS_STREAM, 'states', Codec.DELTA, DeltaEncoder())
+        batch = [state_message(0, frame_number) for frame_number in range(5)]
+        with pytest.raises(ConnectionError):
+            write(batch)
+        # BackgroundSink retries the same batch, then carries on with the next
+        write(batch)
+        write([state_message(0, frame_number) for frame_number in range(5, 10)])
+
+        source = StreamSource(client, 'states', [0], consumer='a')
+        messages = source.read(timeout=0.1)
+        # the retry sent the bytes encoded for the lost attempt, not a re-encoding
+        assert [data for _, data in messages[:5]] == [args[-1] for args in flaky.lost]
+        decoder = DeltaDecoder()
+        events = [decoder.decode(data) for _, data in messages]
+        assert [repr(event) for event in events] == [repr(state_message(0, frame_number)) for frame_number in range(10)]
+
+    def test_race_ids_are_counted_on_the_server(self, monkeypatch):
+        server = fakeredis.FakeServer()
+        monkeypatch.setattr(sink.redis, 'Redis', lambda host, port: fakeredis.FakeRedis(server=server))
+        # one allocator per setup, sharing the server
+        setups = [RedisRaceIds(), RedisRaceIds()]
+        ids = [setup.allocate() for setup in setups * 2]
+        assert ids[0] >= first_race_id() - 1 and ids == [ids[0] + i for i in range(4)]
@@ -0,0 +1,51 @@
+import time
+
+from mk8cv.aggregator.reorder import ReorderBuffer
+
+
+def _frames(released) -> list[int]:
+    return [event.frame_number for _, event in released]
+
+
+class TestReorderBuffer:
+
+    def test_releases_in_order_behind_the_watermark(self, state_message):
+        buffer = ReorderBuffer(lateness=2)
+        released = []
+        for frame in (0, 2, 1, 3, 5, 4, 6):
+            released += buffer.push(state_message(0, frame), frame)
+        # everything up to the newest frame less lateness is out, in frame order
+        assert _frames(released) == [0, 1, 2, 3, 4]
+        assert [tag for tag, _ in released] == [0, 1, 2, 3, 4]
+        assert buffer.reordered == 2
+        # another device's frames have a watermark of their own
+        assert buffer.push(state_message(1, 0), 'a') == []
+        assert _frames(buffer.drain()) == [5, 6, 0]
+
+    def test_late_frames_are_dropped_and_counted(self, state_message):
+        buffer = ReorderBuffer(lateness=1)
+        for frame in range(4):
+            buffer.push(state_message(0, frame))
+        # frame 2 is out, so a redelivered frame 1 is too late; it is passed on without its event to be acked
+        assert buffer.push(state_message(0, 1), 'late') == [('late', None)]
+        assert buffer.late == 1
+        assert _frames(buffer.drain()) == [3]
+
+    def test_gaps_count_missing_frames_by_stride(self, state_message):
+        buffer = ReorderBuffer(lateness=0, frame_stride=2)
+        for frame in (0, 2, 4, 10, 12):
+            buffer.push(state_message(0, frame))
+        # frames 6 and 8 never arrived; odd frames were never captured
+        assert buffer.gaps == 2
+        assert buffer.released == 5
+
+    def test_quiet_devices_expire_after_max_delay(self, state_message):
+        buffer = ReorderBuffer(lateness=8, max_delay=0.05)
+        buffer.push(state_message(0, 0), 0)
+        buffer.push(state_message(0, 1), 1)
+        assert buffer.expire() == []
+        time.sleep(0.06)
+        buffer.push(state_message(1, 0), 2)
+        # device 0 has been quiet for max_delay, device 1 has just sent
+        assert [tag for tag, _ in buffer.expire()] == [0, 1]
+        assert _frames(buffer.drain()) == [0]
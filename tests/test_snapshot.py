@@ -0,0 +1,113 @@
+import os
+
+from mk8cv.aggregator.aggregator import EventAggregator
+from mk8cv.aggregator.db import Database
+from mk8cv.aggregator.snapshot import read_snapshot
+from mk8cv.aggregator.sources import EventSource, SourceType
+from mk8cv.data.codec import DeltaEncoder
+from mk8cv.data.state import Item, PlayerState, StateMessage
+
+
+class _Rows(Database):
+    def __init__(self) -> None:
+        super().__init__()
+        self.rows = []
+
+    def write_event(self, race_id, timestamp, player_id, lap, position, coins, item_1, item_2):
+        self.rows.append((race_id, timestamp, player_id, lap, position, coins, item_1, item_2))
+
+    def get_previous_events(self, race_id, player_id, num_rows=1):
+        return []
+
+
+class _Stream(EventSource):
+    """A one-partition stream that, like a consumer group, re-delivers whatever was not acked to a new reader."""
+
+    def __init__(self, entries: list[bytes], acked: set, batch: int = 7) -> None:
+        self.entries = entries
+        self.acked = acked
+        self.batch = batch
+        self.skip_until = -1
+        self.next = 0
+
+    def read(self, timeout):
+        while self.next < len(self.entries) and (self.next in self.acked or self.next <= self.skip_until):
+            self.next += 1
+        messages = [(('states', i), self.entries[i]) for i in range(self.next, min(self.next + self.batch,
+                                                                                     len(self.entries)))]
+        self.next += len(messages)
+        self.finished = not messages
+        return messages
+
+    def ack(self, ids):
+        self.acked.update(i for _, i in ids)
+
+    def offset(self, message_id):
+        return message_id
+
+    def seek(self, offsets):
+        self.skip_until = offsets.get('states', -1)
+
+
+class _Aggregator(EventAggregator):
+    def __init__(self, source: EventSource, database: Database, snapshot_path: str = None) -> None:
+        # not a Redis source type, so listen does not ping a server
+        super().__init__('localhost', 6379, 'states', SourceType.UNIX_SOCKET, handle_signals=False, database=database,
+                         snapshot_path=snapshot_path, snapshot_interval=0.0)
+        self.source = source
+
+    def _open_source(self, channel: str = None) -> EventSource:
+        return self.source
+
+
+def _entries(frames: int = 120) -> list[bytes]:
+    encoder = DeltaEncoder(keyframe_interval=30)
+    entries = []
+    for frame in range(frames):
+        for device_id in range(2):
+            message = StateMessage(device_id, frame, 3,
+                                   PlayerState((frame // 20 + device_id) % 12 + 1, Item.BANANA, Item.NONE,
+                                               frame // 10 % 11, frame // 40 + 1, 3),
+                                   PlayerState(7, Item.NONE, Item.NONE, 0, 1, 3),
+                                   capture_time=1000 + frame / 60)
+            entries.append(encoder.encode(message))
+    return entries
+
+
+class TestSnapshots:
+
+    def test_restart_resumes_without_duplicate_writes(self, tmp_path):
+        entries = _entries()
+        expected = _Rows()
+        _Aggregator(_Stream(entries, set()), expected).listen()
+
+        path = str(tmp_path / 'aggregator.snapshot')
+        acked = set()
+        first = _Rows()
+        aggregator = _Aggregator(_Stream(entries, acked), first, path)
+        aggregator._restore([aggregator.source])
+        # handle part of the stream, snapshot, handle a little more, then die without cleaning up
+        for _ in range(10):
+            messages = aggregator.source.read(1.0)
+            aggregator._track_offsets(aggregator.source, messages)
+            aggregator.source.ack(aggregator._handle(messages))
+        aggregator._checkpoint()
+        covered = len(first.rows)
+        for _ in range(3):
+            messages = aggregator.source.read(1.0)
+            aggregator._track_offsets(aggregator.source, messages)
+            aggregator._handle(messages)
+        assert os.path.exists(path) and read_snapshot(path)['offsets'] == {'states': 69}
+
+        second = _Rows()
+        _Aggregator(_Stream(entries, acked), second, path).listen()
+        # rows written after the snapshot are written again, the same, and nothing before it is
+        assert first.rows[:covered] + second.rows == expected.rows
+
+    def test_unreadable_snapshot_starts_cold(self, tmp_path):
+        path = tmp_path / 'aggregator.snapshot'
+        path.write_bytes(b'not a snapshot')
+        assert read_snapshot(str(path)) is None
+        rows = _Rows()
+        _Aggregator(_Stream(_entries(10), set()), rows, str(path)).listen()
+        assert rows.rows and read_snapshot(str(path)) is not None
@@ -0,0 +1,84 @@
+import http.client
+import json
+import os
+import sqlite3
+
+from mk8cv.aggregator.db import SqliteDB
+from mk8cv.aggregator.standings import Standings, StandingsServer
+from mk8cv.data.state import Item, PlayerState
+
+SCHEMA = os.path.join(os.path.dirname(__file__), '..', 'mk8cv-db', 'schema.sql')
+
+
+def _next_event(response: http.client.HTTPResponse) -> dict:
+    """The data of the next server-sent event, skipping keepalives."""
+    data = None
+    while True:
+        line = response.fp.readline().rstrip(b'\n')
+        if line.startswith(b'data: '):
+            data = json.loads(line[len(b'data: '):])
+        elif not line and data is not None:
+            return data
+
+
+class TestStandings:
+
+    def test_latest_state_in_position_order(self):
+        standings = Standings()
+        standings.update(1, 10, 1, PlayerState(2, Item.BANANA, Item.NONE, 3, 1, 3))
+        standings.update(1, 10, 2, PlayerState(1, Item.NONE, Item.NONE, 0, 1, 3))
+        standings.update(1, 20, 1, PlayerState(1, Item.NONE, Item.NONE, 4, 1, 3))
+        standings.update(1, 12, 2, PlayerState(2, Item.STAR, Item.NONE, 1, 1, 3))
+        standings.update(1, 5, 1, PlayerState(9, Item.NONE, Item.NONE, 0, 1, 3))  # older than what is shown
+
+        version, body = standings.snapshot(1)
+        assert standings.snapshot(1)[1] is body
+        assert [(player['player_id'], player['frame']) for player in json.loads(body)['players']] == [(1, 20), (2, 12)]
+        assert not standings.wait(1, version, timeout=0.01)
+        standings.update(1, 30, 2, PlayerState(1, Item.NONE, Item.NONE, 1, 1, 3))
+        assert standings.wait(1, version, timeout=0.01)
+
+    def test_ended_race_is_forgotten(self):
+        standings = Standings()
+        standings.update(1, 10, 1, PlayerState(2, Item.BANANA, Item.NONE, 3, 1, 3))
+        standings.update(2, 10, 5, PlayerState(1, Item.NONE, Item.NONE, 0, 1, 3))
+        standings.snapshot(1)
+        standings.snapshot(2)
+        standings.end_race(1)
+        assert json.loads(standings.snapshot(1)[1])['players'] == []
+        assert list(standings._players) == list(standings._versions) == list(standings._encoded) == [2]
+
+    def test_stream_coalesces_updates(self):
+        standings = Standings()
+        standings.update(1, 0, 1, PlayerState(5, Item.NONE, Item.NONE, 0, 1, 3))
+        server = StandingsServer(standings, port=0, max_rate=5.0, keepalive=0.05)
+        server.start()
+        connection = http.client.HTTPConnection('localhost', server.server_address[1], timeout=5)
+        try:
+            connection.request('GET', '/standings/stream?race_id=1')
+            response = connection.getresponse()
+            assert response.getheader('Content-Type') == 'text/event-stream'
+            assert _next_event(response)['version'] == 1
+            # all sent while the stream waits out its max_rate interval, so they arrive as one event
+            for frame in range(1, 51):
+                standings.update(1, frame, 1, PlayerState(frame % 12 + 1, Item.NONE, Item.NONE, 0, 1, 3))
+            event = _next_event(response)
+            assert event['version'] == 51 and event['players'][0]['frame'] == 50
+            standings.end_race(1)
+            assert _next_event(response) == {'race_id': 1, 'version': 0, 'players': []}
+        finally:
+            connection.close()
+            server.close()
+
+    def test_materialised_table(self, tmp_path):
+        db_file = str(tmp_path / 'race.db')
+        database = SqliteDB(db_file, SCHEMA)
+        database.write_event(1, 20, 1, 1, 3, 0, 'NONE', 'NONE')
+        database.write_event(1, 10, 1, 1, 7, 0, 'NONE', 'NONE')
+        database.write_event(1, 15, 2, 1, 4, 2, 'STAR', 'NONE')
+        database.close()
+
+        conn = sqlite3.connect(db_file)
+        assert conn.execute('SELECT player_id, frame, position FROM race_standings ORDER BY position').fetchall() == \
+            [(1, 20, 3), (2, 15, 4)]
+        conn.close()
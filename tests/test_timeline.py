@@ -0,0 +1,40 @@
+import json
+import os
+import sqlite3
+
+from mk8cv.aggregator.db import SqliteDB
+from mk8cv.aggregator.timeline import downsample, export_race
+
+SCHEMA = os.path.join(os.path.dirname(__file__), '..', 'mk8cv-db', 'schema.sql')
+
+
+class TestTimeline:
+
+    def test_downsample(self):
+        intervals = [(0, 5, 'a'), (5, 6, 'b'), (6, 20, 'c'), (20, None, 'a')]
+        assert downsample(intervals, 30, 1) == [(0, 'a'), (5, 'b'), (6, 'c'), (20, 'a')]
+        assert downsample(intervals, 30, 4) == [(0, 'a'), (4, 'c'), (20, 'a')]
+        assert downsample(intervals, 30, 16) == [(0, 'c'), (16, 'a')]
+
+    def test_export_levels(self, tmp_path):
+        db_file = str(tmp_path / 'race.db')
+        database = SqliteDB(db_file, SCHEMA)
+        for frame in range(0, 5000, 10):
+            database.write_event(2, frame, 1, 1 + frame // 2000, 1 + frame // 1000 % 12, frame // 300 % 10,
+                                 'BANANA' if 300 <= frame % 700 < 320 else 'NONE', 'NONE')
+        database.close()
+
+        conn = sqlite3.connect(db_file)
+        manifest = export_race(conn, 2, str(tmp_path / 'races'), max_buckets=100)
+        conn.close()
+        assert [level['resolution'] for level in manifest['levels']] == [1, 4, 16, 64]
+        assert manifest['start_frame'] == 0 and manifest['end_frame'] == 4991
+
+        with open(tmp_path / 'races' / '2' / 'lod1.json') as f:
+            full = json.load(f)['players']['1']
+        assert full['lap'] == {'start': [0, 2000, 4000], 'value': [1, 2, 3]}
+        with open(tmp_path / 'races' / '2' / 'lod64.json') as f:
+            coarse = json.load(f)['players']['1']
+        # bananas held for 20 frames never fill half a bucket and disappear; lap 3 loses a tie
+        assert coarse['item_1'] == {'start': [0], 'value': ['NONE']}
+        assert coarse['lap'] == {'start': [0, 1984, 4032], 'value': [1, 2, 3]}